@@ -7,28 +7,57 @@ import os
 import re
 import shutil
 import sys
+import time
+from functools import partial
 from pathlib import Path
 
-import flywheel_gear_toolkit
-from flywheel_gear_toolkit.interfaces.command_line import (
-    build_command_list,
-    exec_command,
+from utils.autotune import autotune, will_run_recon_all
+from utils.command import run_command
+from utils.disk_space import (
+    SpaceGuard,
+    check_free_space,
+    forecast_disk_use,
+    list_input_images,
+    work_is_saved,
 )
-from flywheel_gear_toolkit.utils.zip_tools import unzip_archive, zip_output
-
-from utils.bids.download_run_level import download_bids_for_runlevel
-from utils.bids.run_level import get_analysis_run_level_and_hierarchy
 from utils.dry_run import pretend_it_ran
 from utils.fly.environment import get_and_log_environment
 from utils.fly.make_file_name_safe import make_file_name_safe
+from utils.fly.resources import detect_resources
 from utils.fly.set_performance_config import set_mem_mb, set_n_cpus
 from utils.freesurfer import install_freesurfer_license
+from utils.monitor.sampler import ProcessTreeSampler
+from utils.monitor.spans import PhaseRecorder
+from utils.results.incremental_zip import OutputArchiver
+from utils.results.work_store import (
+    publish_work_dir,
+    restore_work_dir,
+    result_options,
+)
 from utils.results.zip_htmls import zip_htmls
 from utils.results.zip_intermediate import (
     zip_all_intermediate_output,
     zip_intermediate_selected,
 )
-from utils.singularity import run_in_tmp_dir
+from utils.retry import FailureProbe, plan_retry
+from utils.scheduler import (
+    ParticipantScheduler,
+    find_finished_participants,
+    find_participants,
+    number_of_slots,
+    share_resources,
+)
+from utils.scratch import place_work_dir
+from utils.setup_steps import SetupStep, run_setup_steps
+from utils.singularity import read_writable_dir, run_in_tmp_dir
+from utils.supervisor import become_subreaper, forward_signals
+from utils.templateflow import (
+    get_required_templates,
+    get_shared_templateflow,
+    stage_templateflow,
+)
+from utils.unzip_selected import unzip_selected
+from utils.watchdog import RunWatchdog, parse_duration
 
 log = logging.getLogger(__name__)
 
@@ -49,6 +78,8 @@ DOWNLOAD_SOURCE = False
 
 # Constants that do not need to be changed
 FREESURFER_LICENSE = "./freesurfer/license.txt"
+DEFAULT_WORK_GB = 30  # when the size of the work directory can't be forecast
+ORIG_TEMPLATEFLOW = Path("/home/fmriprep/.cache/templateflow/")
 
 
 def generate_command(config, work_dir, output_analysis_id_dir, errors, warnings):
@@ -67,9 +98,6 @@ def generate_command(config, work_dir, output_analysis_id_dir, errors, warnings)
 
     # start with the command itself:
     cmd = [
-        "/usr/bin/time",
-        "-v",
-        "--output=time_output.txt",
         BIDS_APP,
         os.path.join(work_dir, "bids"),
         str(output_analysis_id_dir),
@@ -97,6 +125,9 @@ def generate_command(config, work_dir, output_analysis_id_dir, errors, warnings)
         elif not skip_pattern.match(key):
             command_parameters[key] = val
 
+    # the SDK takes a while to import and isn't needed until now
+    from flywheel_gear_toolkit.interfaces.command_line import build_command_list
+
     # Validate the command parameter dictionary - make sure everything is
     # ready to run so errors will appear before launching the actual gear
     # code.  Add descriptions of problems to errors & warnings lists.
@@ -123,6 +154,9 @@ def main(gtk_context):
     FWV0 = Path.cwd()
     log.info("Running gear in %s", FWV0)
 
+    # time and resources used by each phase of the gear
+    phases = PhaseRecorder()
+
     # Errors and warnings will always be logged when they are detected.
     # Keep a list of errors and warning to print all in one place at end of log
     # Any errors will prevent the command from running and will cause exit(1)
@@ -143,6 +177,9 @@ def main(gtk_context):
     # Given the destination container, figure out if running at the project,
     # subject, or session level.
     destination_id = gtk_context.destination["id"]
+    phases.phase("hierarchy")
+    from utils.bids.run_level import get_analysis_run_level_and_hierarchy
+
     hierarchy = get_analysis_run_level_and_hierarchy(gtk_context.client, destination_id)
 
     # This is the label of the project, subject or session and is used
@@ -162,26 +199,82 @@ def main(gtk_context):
     else:
         Path(output_analysis_id_dir).mkdir()
 
+    phases.phase("setup")
     environ = get_and_log_environment()
 
-    # set # threads and max memory to use
+    # set # threads and max memory to use, limited by the cgroup, LSF or Slurm
+    resources = detect_resources(config)
+    log.info(
+        "This job may use %d cpus (from %s) and %d MB of memory (from %s)",
+        resources["n_cpus"],
+        resources["n_cpus from"],
+        resources["mem_mb"],
+        resources["mem_mb from"],
+    )
+    gtk_context.metadata.update_container(
+        gtk_context.destination["type"], info={"resources detected": resources}
+    )
     config["n_cpus"], config["omp-nthreads"] = set_n_cpus(
-        config.get("n_cpus"), config.get("omp-nthreads")
+        config.get("n_cpus"), config.get("omp-nthreads"), resources["n_cpus"]
     )
-    config["mem"] = set_mem_mb(config.get("mem_mb"))
+    config["mem"] = set_mem_mb(config.get("mem_mb"), resources["mem_mb"])
 
     environ["OMP_NUM_THREADS"] = str(config["omp-nthreads"])
 
+    # forecast the disk space the run will need before downloading anything
+    forecast = None
+    disk_forecast = config.get("gear-disk-forecast", "warn")
+    if disk_forecast != "off":
+        phases.phase("forecast")
+        try:
+            images = list_input_images(
+                gtk_context.client, destination_id, DOWNLOAD_MODALITIES
+            )
+            forecast = forecast_disk_use(
+                images,
+                config,
+                recon_all=will_run_recon_all(
+                    config, gtk_context.get_input_path("fs-subjects-dir")
+                ),
+            )
+            log.info("Disk use forecast: %s", forecast)
+            gtk_context.metadata.update_container(
+                gtk_context.destination["type"], info={"disk forecast": forecast}
+            )
+        except Exception as exc:
+            log.warning("Could not forecast disk use: %s", exc)
+
+    # put work/ on the fastest scratch space that can hold it
+    placed_work_dir = None
+    if config.get("gear-place-work", True):
+        phases.phase("scratch")
+        work_gb = config.get("gear-work-gb") or DEFAULT_WORK_GB
+        if forecast and not config.get("gear-work-gb"):
+            work_gb = forecast["bids GB"] + forecast["work GB"]
+        placed_work_dir, scratch = place_work_dir(
+            work_dir,
+            configured=config.get("gear-scratch-dirs", "").split(),
+            work_gb=work_gb,
+            spare_memory_gb=(resources["mem_mb"] - config["mem"]) / 1024,
+        )
+        gtk_context.metadata.update_container(
+            gtk_context.destination["type"], info={"scratch": scratch}
+        )
+
+    if forecast:
+        for problem in check_free_space(forecast, work_dir, output_dir):
+            if disk_forecast == "refuse":
+                log.error(problem)
+                errors.append(problem)
+            else:
+                log.warning(problem)
+                warnings.append(problem)
+
     # All writeable directories need to be set up in the current working directory
 
     orig_subject_dir = Path(environ["SUBJECTS_DIR"])
     subjects_dir = FWV0 / "freesurfer/subjects"
     environ["SUBJECTS_DIR"] = str(subjects_dir)
-    if not subjects_dir.exists():  # needs to be created unless testing
-        subjects_dir.mkdir(parents=True)
-        (subjects_dir / "fsaverage").symlink_to(orig_subject_dir / "fsaverage")
-        (subjects_dir / "fsaverage5").symlink_to(orig_subject_dir / "fsaverage5")
-        (subjects_dir / "fsaverage6").symlink_to(orig_subject_dir / "fsaverage6")
 
     bids_filter_file_path = gtk_context.get_input_path("bids-filter-file")
     if bids_filter_file_path:
@@ -189,142 +282,370 @@ def main(gtk_context):
         log.info("Using provided PyBIDS filter file %s", str(paths[0]))
         config["bids-filter-file"] = str(paths[0])
 
-    subject_zip_file_path = gtk_context.get_input_path("fs-subjects-dir")
-    if subject_zip_file_path:
-        paths = list(Path("input/fs-subjects-dir").glob("*"))
-        log.info("Using provided Freesurfer subject file %s", str(paths[0]))
-        unzip_dir = FWV0 / "unzip-fs-subjects-dir"
-        unzip_dir.mkdir(parents=True)
-        unzip_archive(paths[0], unzip_dir)
-        for a_subject in unzip_dir.glob("*/*"):
-            if (subjects_dir / a_subject.name).exists():
-                log.info("Found %s but using existing", a_subject.name)
-            else:
-                log.info("Found %s", a_subject.name)
-                a_subject.rename(subjects_dir / a_subject.name)
-        config["fs-subjects-dir"] = subjects_dir
-
-    previous_results_zip_file_path = gtk_context.get_input_path("previous-results")
-    if previous_results_zip_file_path:
-        paths = list(Path("input/previous-results").glob("*"))
-        log.info("Using provided fMRIPrep previous results file %s", str(paths[0]))
-        unzip_dir = FWV0 / "unzip-previous-results"
-        unzip_dir.mkdir(parents=True)
-        unzip_archive(paths[0], unzip_dir)
-        for a_dir in unzip_dir.glob("*/*"):
-            log.info("Found %s", a_dir.name)
-            a_dir.rename(output_analysis_id_dir / a_dir.name)
-
     config_file = gtk_context.get_input_path("config-file")
     if config_file:
         config["config-file"] = config_file
 
     environ["FS_LICENSE"] = str(FWV0 / "freesurfer/license.txt")
 
-    license_list = list(Path("input/freesurfer_license").glob("*"))
-    if len(license_list) > 0:
-        fs_license_path = license_list[0]
-    else:
-        fs_license_path = ""
-    install_freesurfer_license(
-        str(fs_license_path),
-        config.get("gear-FREESURFER_LICENSE"),
-        gtk_context.client,
-        destination_id,
-        FREESURFER_LICENSE,
-    )
-
     # TemplateFlow seems to be baked in to the container since 2021-10-07 16:25:12 so this is not needed...actually, it is for now...
     templateflow_dir = FWV0 / "templateflow"
-    templateflow_dir.mkdir()
     environ["SINGULARITYENV_TEMPLATEFLOW_HOME"] = str(templateflow_dir)
     environ["TEMPLATEFLOW_HOME"] = str(templateflow_dir)
-    orig = Path("/home/fmriprep/.cache/templateflow/")
-    # Fill writable templateflow directory with existing templates so they don't have to be downloaded
-    templates = list(orig.glob("*"))
-    for tt in templates:
-        # (templateflow_dir / tt.name).symlink_to(tt)
-        shutil.copytree(tt, templateflow_dir / tt.name)
 
-    command = generate_command(
-        config, work_dir, output_analysis_id_dir, errors, warnings
-    )
+    # The setup steps below are independent (except where "after" says so) so
+    # they run at the same time, each in its own thread.
 
-    # Download BIDS Formatted data
-    if len(errors) == 0:
+    def download_bids():
+        """Download BIDS Formatted data and maybe validate it."""
+        # flywheel_bids takes a while to import, do it while other steps run
+        from utils.bids.download_run_level import download_bids_for_runlevel
 
         # Create HTML file that shows BIDS "Tree" like output
-        tree = True
-        tree_title = f"{gear_name} BIDS Tree"
-
-        error_code = download_bids_for_runlevel(
+        return download_bids_for_runlevel(
             gtk_context,
             hierarchy,
-            tree=tree,
-            tree_title=tree_title,
+            tree=True,
+            tree_title=f"{gear_name} BIDS Tree",
             src_data=DOWNLOAD_SOURCE,
             folders=DOWNLOAD_MODALITIES,
             dry_run=dry_run,
             do_validate_bids=config.get("gear-run-bids-validation"),
         )
-        if error_code > 0 and not config.get("gear-ignore-bids-errors"):
-            errors.append(f"BIDS Error(s) detected.  Did not run {CONTAINER}")
 
+    def install_license():
+        license_list = list(Path("input/freesurfer_license").glob("*"))
+        if len(license_list) > 0:
+            fs_license_path = license_list[0]
+        else:
+            fs_license_path = ""
+        install_freesurfer_license(
+            str(fs_license_path),
+            config.get("gear-FREESURFER_LICENSE"),
+            gtk_context.client,
+            destination_id,
+            FREESURFER_LICENSE,
+        )
+
+    def fill_templateflow():
+        # Fill writable templateflow directory with existing templates so they don't have to be downloaded.
+        # Only the templates this job needs are materialized, the rest are symlinked.
+        templateflow_dir.mkdir()
+        required_templates = get_required_templates(config)
+        writable_dir = Path(config.get("gear-writable-dir", "/var/tmp"))
+        cache_gb = config.get("gear-templateflow-cache-gb", 20)
+        if writable_dir in FWV0.parents and cache_gb > 0:
+            # Running in a scratch directory on shared hardware so use the node-wide cache
+            get_shared_templateflow(
+                ORIG_TEMPLATEFLOW,
+                writable_dir,
+                templateflow_dir,
+                required_templates,
+                cache_gb,
+            )
+        else:
+            stage_templateflow(ORIG_TEMPLATEFLOW, templateflow_dir, required_templates)
+
+    def make_subjects_dir():
+        if not subjects_dir.exists():  # needs to be created unless testing
+            subjects_dir.mkdir(parents=True)
+            (subjects_dir / "fsaverage").symlink_to(orig_subject_dir / "fsaverage")
+            (subjects_dir / "fsaverage5").symlink_to(orig_subject_dir / "fsaverage5")
+            (subjects_dir / "fsaverage6").symlink_to(orig_subject_dir / "fsaverage6")
+
+    def unzip_fs_subjects_dir():
+        paths = list(Path("input/fs-subjects-dir").glob("*"))
+        log.info("Using provided Freesurfer subject file %s", str(paths[0]))
+        unzip_selected(
+            paths[0],
+            subjects_dir,
+            subjects=[hierarchy["subject_label"]],
+            n_threads=config["n_cpus"],
+        )
+
+    def unzip_previous_results():
+        paths = list(Path("input/previous-results").glob("*"))
+        log.info("Using provided fMRIPrep previous results file %s", str(paths[0]))
+        unzip_selected(
+            paths[0],
+            output_analysis_id_dir,
+            subjects=[hierarchy["subject_label"]],
+            sessions=[hierarchy["session_label"]],
+            n_threads=config["n_cpus"],
+        )
+
+    def restore_work():
+        log.info(
+            "Using finished steps from work directory %s", Path(work_dir_path).name
+        )
+        try:
+            return restore_work_dir(
+                work_dir_path,
+                work_dir,
+                store_dir=config.get("gear-work-store") or None,
+                subjects=[hierarchy["subject_label"]],
+                options=result_options(config),
+                n_threads=config["n_cpus"],
+            )
+        except (OSError, ValueError) as exc:
+            msg = f"Could not restore the work directory, starting from scratch: {exc}"
+            log.warning(msg)
+            warnings.append(msg)
+
+    # the download usually takes longest so it is started first
+    steps = []
+    if len(errors) == 0:
+        steps.append(SetupStep("download and validate", download_bids))
     else:
         log.info("Did not download BIDS because of previous errors")
-        print(errors)
+    steps += [
+        SetupStep("license", install_license),
+        SetupStep("templateflow", fill_templateflow),
+        SetupStep("freesurfer subjects dir", make_subjects_dir),
+    ]
+    subject_zip_file_path = gtk_context.get_input_path("fs-subjects-dir")
+    if subject_zip_file_path:
+        # the fsaverage links have to be there so they are not unzipped over
+        steps.append(
+            SetupStep(
+                "unzip fs-subjects-dir",
+                unzip_fs_subjects_dir,
+                after=["freesurfer subjects dir"],
+            )
+        )
+    previous_results_zip_file_path = gtk_context.get_input_path("previous-results")
+    if previous_results_zip_file_path:
+        steps.append(SetupStep("unzip previous-results", unzip_previous_results))
+    work_dir_path = gtk_context.get_input_path("work-dir")
+    if work_dir_path:
+        steps.append(SetupStep("restore work-dir", restore_work))
+
+    phases.phase("setup steps")
+    results = run_setup_steps(steps, errors, phases)
+
+    if "unzip fs-subjects-dir" in results:
+        config["fs-subjects-dir"] = subjects_dir
+
+    if results.get("restore work-dir"):
+        gtk_context.metadata.update_container(
+            gtk_context.destination["type"],
+            info={"work restored": results["restore work-dir"]},
+        )
+
+    error_code = results.get("download and validate", 0)
+    if error_code > 0 and not config.get("gear-ignore-bids-errors"):
+        errors.append(f"BIDS Error(s) detected.  Did not run {CONTAINER}")
+
+    command = generate_command(
+        config, work_dir, output_analysis_id_dir, errors, warnings
+    )
 
+    # Fit n_cpus, omp-nthreads and mem to the data, the config values are limits
+    if config.get("gear-autotune", False) and (work_dir / "bids").is_dir():
+        phases.phase("autotune")
+        tuning = autotune(
+            work_dir / "bids",
+            config,
+            fs_subjects_dir=gtk_context.get_input_path("fs-subjects-dir"),
+        )
+        environ["OMP_NUM_THREADS"] = str(config["omp-nthreads"])
+        gtk_context.metadata.update_container(
+            gtk_context.destination["type"], info={"autotune": tuning}
+        )
+        command = generate_command(
+            config, work_dir, output_analysis_id_dir, errors, warnings
+        )
+
+    if config.get("gear-save-output-as-subfolders"):
+        # zip output/<analysis_id>/fmriprep folder into
+        #  <gear_name>_<project|subject|session label>_<analysis.id>_fmriprep.zip
+        # and zip output/<analysis_id>/freesurfer folder into
+        #  <gear_name>_<project|subject|session label>_<analysis.id>_freesurfer.zip
+        zip_names = {
+            sub_dir: gear_name + f"_{run_label}_{destination_id}_{sub_dir}.zip"
+            for sub_dir in ["fmriprep", "freesurfer"]
+        }
+    else:
+        # zip entire output/<analysis_id> folder into
+        #  <gear_name>_<project|subject|session label>_<analysis.id>.zip
+        zip_names = {None: gear_name + f"_{run_label}_{destination_id}.zip"}
+    archiver = OutputArchiver(output_dir, destination_id, zip_names, config["n_cpus"])
+    if config.get("gear-zip-while-running", True) and not dry_run:
+        # participants that finish are zipped while the others are still running
+        archiver.start()
+
+    phases.phase(BIDS_APP)
     return_code = 0
     num_tries = 0
 
-    # Don't run if there were errors or if this is a dry run
+    # Sample resources used by the BIDS App and everything it runs, from the
+    # first try on
+    sampler = ProcessTreeSampler(
+        output_dir / f"{gear_name}_resources_{run_label}_{destination_id}.tsv.gz",
+        config.get("gear-resource-sample-seconds", 10),
+        config["n_cpus"],
+    )
+
+    # Maybe run several participants at the same time, each in its own process
+    scheduler = None
+    parallel = config.get("gear-parallel-participants", 1)
+    if parallel != 1 and not dry_run:
+        if previous_results_zip_file_path:
+            log.info("Running participants together because of previous-results")
+        else:
+            costs = find_participants(work_dir / "bids")
+            slots = number_of_slots(
+                len(costs), parallel, config["n_cpus"], config["mem"]
+            )
+            if slots > 1:
+                scheduler = ParticipantScheduler(
+                    costs, slots, work_dir / "participants", output_analysis_id_dir
+                )
+
+    def participant_command(
+        n_cpus,
+        omp_nthreads,
+        mem_mb,
+        label,
+        participant_work_dir,
+        participant_output_dir,
+    ):
+        """Build the command for one participant when using the scheduler.
+
+        n_cpus, omp_nthreads and mem_mb are each participant's share (see
+        share_resources).  The scheduler passes the rest.
+        """
+        participant_config = dict(config)
+        participant_config["n_cpus"] = n_cpus
+        participant_config["omp-nthreads"] = omp_nthreads
+        participant_config["mem"] = mem_mb
+        participant_config["participant-label"] = label
+        participant_config["work-dir"] = str(participant_work_dir)
+        cmd = generate_command(
+            participant_config, work_dir, participant_output_dir, errors, warnings
+        )
+        if "gear-timeout" in config:
+            cmd = [f"timeout {config['gear-timeout']}"] + cmd
+        return cmd
+
+    # Don't run if there were errors
+    max_tries = config.get("gear-max-tries", 2)
     if len(errors) > 0:
         return_code = 1
         log.info("Command was NOT run because of previous errors.")
-        num_tries == 2  # don't try to run
+        max_tries = 0  # don't try to run
+
+    # stop a little before gear-timeout would, leaving time to save what was done
+    deadline_seconds = 0
+    if "gear-timeout" in config:
+        timeout_seconds = parse_duration(config["gear-timeout"])
+        margin_seconds = config.get("gear-timeout-margin-minutes", 30) * 60
+        if timeout_seconds and margin_seconds and timeout_seconds > margin_seconds:
+            deadline_seconds = timeout_seconds - margin_seconds
+
+    # when the disk gets full, remove the work of participants that finished
+    guard = SpaceGuard(
+        work_dir,
+        output_analysis_id_dir,
+        config.get("gear-min-free-gb", 10),
+        prune=not work_is_saved(config),
+    )
 
-    while num_tries < 2:
+    attempts = []  # what happened on each try, saved in metadata
+    exit_status = 0
+    while num_tries < max_tries:
 
-        try:
-
-            num_tries += 1
-            if num_tries > 1:
-                log.info("Trying a second time")
+        num_tries += 1
+        if num_tries > 1:
+            log.info("Trying again (try %d of %d)", num_tries, max_tries)
+            command = generate_command(
+                config, work_dir, output_analysis_id_dir, errors, warnings
+            )
 
-            if dry_run:
-                e = "gear-dry-run is set: Command was NOT run."
-                log.warning(e)
-                warnings.append(e)
-                pretend_it_ran(destination_id)
+        if dry_run:
+            e = "gear-dry-run is set: Command was NOT run."
+            log.warning(e)
+            warnings.append(e)
+            pretend_it_ran(destination_id)
+            break
+
+        if "gear-timeout" in config:
+            command = [f"timeout {config['gear-timeout']}"] + command
+
+        if not sampler.started:
+            sampler.start()
+
+        if config["gear-log-level"] != "INFO":
+            # show what's in the current working directory just before running
+            os.system("tree -alh .")
+
+        # save the output in output/log#.txt.gz instead of showing it
+        log_file = None
+        if config.get("gear-log-to-file"):
+            log_file = f"output/log{num_tries}.txt"
+
+        attempt = {
+            "try": num_tries,
+            "n_cpus": config["n_cpus"],
+            "omp-nthreads": config["omp-nthreads"],
+            "mem": config["mem"],
+            "low-mem": bool(config.get("low-mem")),
+        }
+        attempts.append(attempt)
+        probe = FailureProbe()
+        start = time.monotonic()
+
+        # stop early if it stalls or crashes instead of running until the timeout,
+        # the work directory changes (and gets crash files) when nothing else does
+        watchdog = RunWatchdog(
+            [output_analysis_id_dir],
+            stall_seconds=config.get("gear-stall-minutes", 240) * 60,
+            max_crashes=config.get("gear-abort-after-crashes", 0),
+            deadline_seconds=deadline_seconds,
+            shallow_dirs=[work_dir],
+        )
+        watchdog.start()
+        guard.start()
 
+        try:
+            # This is what it is all about
+            if scheduler:
+                (
+                    participant_n_cpus,
+                    participant_omp_nthreads,
+                    participant_mem_mb,
+                ) = share_resources(config, scheduler.slots)
+                participant_environ = dict(
+                    environ, OMP_NUM_THREADS=str(participant_omp_nthreads)
+                )
+                scheduler.run(
+                    partial(
+                        participant_command,
+                        participant_n_cpus,
+                        participant_omp_nthreads,
+                        participant_mem_mb,
+                    ),
+                    participant_environ,
+                    log_file=(
+                        f"output/log{num_tries}_sub-{{label}}.txt" if log_file else None
+                    ),
+                    watchdog=watchdog,
+                )
             else:
-
-                if "gear-timeout" in config:
-                    command = [f"timeout {config['gear-timeout']}"] + command
-
-                if config["gear-log-level"] != "INFO":
-                    # show what's in the current working directory just before running
-                    os.system("tree -alh .")
-
-                if config.get("gear-log-to-file"):
-                    if command[-1] == "output/log1.txt":
-                        command[-1] = "output/log2.txt"
-                    else:
-                        command = command + [">", "output/log1.txt"]
-
-                # This is what it is all about
-                exec_command(
+                run_command(
                     command,
                     environ=environ,
-                    dry_run=dry_run,
                     shell=True,
-                    cont_output=True,
+                    log_file=log_file,
+                    watchdog=watchdog,
                 )
-                break
+            attempt["exit status"] = exit_status = 0
+            attempt["seconds"] = round(time.monotonic() - start)
+            return_code = 0
+            break
 
         except RuntimeError as exc:
-            if num_tries == 2:
-                return_code = 1
+            return_code = 1
             errors.append(exc)
             log.critical(exc)
             log.exception("Unable to execute command.")
@@ -333,24 +654,51 @@ def main(gtk_context):
             os.system("echo Disk Information on Failure")
             os.system("df -h")
 
+            exit_status = getattr(exc, "returncode", 1)
+            output = getattr(exc, "stderr", "")
+            if watchdog.cause == "deadline":
+                failure, evidence = "deadline", watchdog.reason
+            elif watchdog.reason:
+                failure, evidence = "watchdog", watchdog.reason
+            else:
+                failure, evidence = probe.classify(exit_status, output)
+            decision, retry = plan_retry(
+                failure, config, set_mem_mb(None, resources["mem_mb"])
+            )
+            environ["OMP_NUM_THREADS"] = str(config["omp-nthreads"])
+            attempt["exit status"] = exit_status
+            attempt["seconds"] = round(time.monotonic() - start)
+            attempt["failure"] = failure
+            attempt["evidence"] = evidence
+            attempt["decision"] = decision if retry else "stop: " + decision
+            log.info("Failure was %s (%s), %s", failure, evidence, attempt["decision"])
+            if not retry:
+                break
+
+        finally:
+            watchdog.stop()
+            attempt["watchdog"] = watchdog.summary()
+            guard.stop()
+
+    if attempts:
+        gtk_context.metadata.update_container(
+            gtk_context.destination["type"],
+            info={"attempts": attempts, "space guard": guard.summary()},
+        )
+
+    # what was done can be saved to start from next time
+    resumable = bool(attempts) and attempts[-1].get("failure") == "deadline"
+
+    archiver.stop()
+
+    sampler.stop()
+
     # Save time, etc. resources used in metadata on analysis
-    if Path("time_output.txt").exists():  # some tests won't have this file
+    if sampler.started:
         metadata = {
-            "resources used": {},
+            "resources used": sampler.resources_used(command, exit_status),
+            "resource samples": sampler.summary(),
         }
-        with open("time_output.txt") as file:
-            for line in file:
-                if ":" in line:
-                    if (
-                        "Elapsed" in line
-                    ):  # special case "Elapsed (wall clock) time (h:mm:ss or m:ss): 0:08.11"
-                        sline = re.split(r"\):", line)
-                        sline[0] += ")"
-                    else:
-                        sline = line.split(":")
-                    key = sline[0].strip()
-                    val = sline[1].strip(' "\n')
-                    metadata["resources used"][key] = val
         gtk_context.metadata.update_container(
             gtk_context.destination["type"], info=metadata
         )
@@ -358,6 +706,7 @@ def main(gtk_context):
     # Cleanup, move all results to the output directory
 
     # Remove all fsaverage* directories
+    phases.phase("fsaverage cleanup")
     if not config.get("gear-keep-fsaverage"):
         path = output_analysis_id_dir / "freesurfer"
         fsavg_dirs = path.glob("fsaverage*")
@@ -367,40 +716,80 @@ def main(gtk_context):
     else:
         log.info("Keeping fsaverage directories")
 
-    if config.get("gear-save-output-as-subfolders"):
-        # zip output/<analysis_id>/fmriprep folder into
-        #  <gear_name>_<project|subject|session label>_<analysis.id>_fmriprep.zip
-        # and zip output/<analysis_id>/freesurfer folder into
-        #  <gear_name>_<project|subject|session label>_<analysis.id>_freesurfer.zip
-        sub_dirs = ["fmriprep", "freesurfer"]
-        for sub_dir in sub_dirs:
-            zip_file_name = gear_name + f"_{run_label}_{destination_id}_{sub_dir}.zip"
-            zip_output(
-                str(output_dir),
-                f"{destination_id}/{sub_dir}",
-                zip_file_name,
-                dry_run=False,
-                exclude_files=None,
-            )
-    else:
-        # zip entire output/<analysis_id> folder into
-        #  <gear_name>_<project|subject|session label>_<analysis.id>.zip
-        zip_file_name = gear_name + f"_{run_label}_{destination_id}.zip"
-        zip_output(
-            str(output_dir),
-            destination_id,
-            zip_file_name,
-            dry_run=False,
-            exclude_files=None,
-        )
+    # zip whatever was not zipped while running
+    phases.phase("zip output")
+    archiver.finish()
 
     # Make archives for result *.html files for easy display on platform
-    zip_htmls(output_dir, destination_id, output_analysis_id_dir / BIDS_APP)
+    phases.phase("html archives")
+    html_sizes = zip_htmls(
+        output_dir,
+        destination_id,
+        output_analysis_id_dir / BIDS_APP,
+        n_workers=config["n_cpus"],
+    )
+    if html_sizes:
+        gtk_context.metadata.update_container(
+            gtk_context.destination["type"], info={"html archives": html_sizes}
+        )
 
     # possibly save ALL intermediate output
-    if config.get("gear-save-intermediate-output"):
-        zip_all_intermediate_output(
-            destination_id, gear_name, output_dir, work_dir, run_label
+    phases.phase("intermediate output")
+    if config.get("gear-save-intermediate-output") or resumable:
+        policy = config.get("gear-save-intermediate-policy", "everything")
+        if not config.get("gear-save-intermediate-output"):
+            policy = "resumable"  # only what lets the next run skip finished steps
+        work_stats = zip_all_intermediate_output(
+            destination_id,
+            gear_name,
+            output_dir,
+            work_dir,
+            run_label,
+            n_workers=config["n_cpus"],
+            volume_gb=config.get("gear-save-intermediate-volume-gb", 20),
+            policy=policy,
+        )
+        gtk_context.metadata.update_container(
+            gtk_context.destination["type"], info={"work archive": work_stats}
+        )
+
+    # keep the finished steps in the store to restore them with the work-dir input
+    work_store = config.get("gear-work-store")
+    if work_store and attempts:
+        try:
+            snapshot, store_stats = publish_work_dir(
+                Path(work_store),
+                work_dir.parent,
+                work_dir.name,
+                f"{gear_name}_work_{run_label}_{destination_id}",
+                result_options(config),
+                n_workers=config["n_cpus"],
+            )
+            shutil.copy(snapshot, output_dir)  # to use as the work-dir input
+            gtk_context.metadata.update_container(
+                gtk_context.destination["type"], info={"work store": store_stats}
+            )
+        except OSError as exc:
+            msg = f"Could not save the work directory in {work_store}: {exc}"
+            log.warning(msg)
+            warnings.append(msg)
+
+    if resumable:
+        finished = find_finished_participants(output_analysis_id_dir)
+        log.info(
+            "Stopped before gear-timeout, saved the work directory to resume from.  "
+            "Finished participants: %s",
+            ", ".join(finished) or "none",
+        )
+        gtk_context.metadata.update_container(
+            gtk_context.destination["type"],
+            info={
+                "resumable": {
+                    "stopped because": attempts[-1]["evidence"],
+                    "work snapshot": f"{gear_name}_work_{run_label}_{destination_id}.zip",
+                    "finished participants": finished,
+                }
+            },
         )
 
     # possibly save intermediate files and folders
@@ -412,6 +801,17 @@ def main(gtk_context):
         output_dir,
         work_dir,
         run_label,
+        n_workers=config["n_cpus"],
+        list_only=config.get("gear-intermediate-list-only"),
+    )
+
+    phases.stop()
+    phases.write_chrome_trace(
+        output_dir / f"{gear_name}_trace_{run_label}_{destination_id}.json"
+    )
+    gtk_context.metadata.update_container(
+        gtk_context.destination["type"],
+        info={"resources by phase": phases.summary()},
     )
 
     # clean up: remove output that was zipped
@@ -421,6 +821,12 @@ def main(gtk_context):
     else:
         log.info("Output directory does not exist so it cannot be removed")
 
+    # the work directory is not in the gear's directory so it has to be removed
+    if placed_work_dir:
+        log.debug('removing work directory "%s"', str(placed_work_dir))
+        shutil.rmtree(placed_work_dir, ignore_errors=True)
+        work_dir.unlink()
+
     # Report errors and warnings at the end of the log so they can be easily seen.
     if len(warnings) > 0:
         msg = "Previous warnings:\n"
@@ -439,15 +845,15 @@ def main(gtk_context):
                 msg += f"  {err_type}: {str(err)}\n"
         log.info(msg)
 
-    if num_tries == 1:
+    if num_tries == 1 and return_code == 0:
         log.info("Happily, fMRIPrep worked on the first try.")
-    else:
-        msg = (
-            "first try but it did on the second"
-            if return_code == 0
-            else "first or second try"
+    elif return_code == 0:
+        log.info(
+            "Sadly, fMRIPrep did not work on the first try but it did on try %d.",
+            num_tries,
         )
-        log.info("Sadly, fMRIPrep did not work on the %s.", msg)
+    else:
+        log.info("Sadly, fMRIPrep did not work after %d tries.", num_tries)
 
     log.info("%s Gear is done.  Returning %s", CONTAINER, return_code)
 
@@ -457,13 +863,18 @@ def main(gtk_context):
 if __name__ == "__main__":
 
     # make sure /flywheel/v0 is writable, use a scratch directory if not
-    with flywheel_gear_toolkit.GearToolkitContext() as gtk_context:
-        gtk_context.log_config()
-        scratch_dir = run_in_tmp_dir(gtk_context.config["gear-writable-dir"])
+    scratch_dir = run_in_tmp_dir(read_writable_dir())
+
+    # orphaned processes started by fMRIPrep become children of the gear so they
+    # can be stopped, and signals (e.g. cancelling the job) are passed on to it
+    become_subreaper()
+
+    # Only instantiated after changing directories, so the context's paths are
+    # in the directory the gear runs in.  The SDK is imported only now because
+    # that takes a while.
+    from flywheel_gear_toolkit import GearToolkitContext
 
-    # Has to be instantiated twice here, since parent directories might have
-    # changed
-    with flywheel_gear_toolkit.GearToolkitContext() as gtk_context:
+    with GearToolkitContext() as gtk_context, forward_signals():
         gtk_context.init_logging()
         gtk_context.log_config()
         return_code = main(gtk_context)
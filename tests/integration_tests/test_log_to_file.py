@@ -1,3 +1,4 @@
+import gzip
 import json
 import logging
 import os
@@ -35,15 +36,20 @@ def test_log_to_file_works(
         status = run.main(gtk_context)
 
         assert status == 1
-        log_path = Path("/flywheel/v0/output/log2.txt")
-        assert log_path.exists()
+        # the output of each try is in gzipped segments: log1.txt.gz,
+        # log1.001.txt.gz, ...  whether there is a second try depends on why
+        # the first one failed, so look at the first one
+        log_paths = sorted(Path("/flywheel/v0/output").glob("log1*.txt.gz"))
+        assert log_paths[0].name == "log1.txt.gz"
         found_it = False
-        with open(log_path, "r") as ff:
-            for line in ff:
-                if "Running fMRIPREP" in line:
-                    found_it = True
-                    break
-                if "Running fMRIPrep version" in line:
-                    found_it = True
-                    break
+        for log_path in log_paths:
+            with gzip.open(log_path, "rt") as ff:
+                for line in ff:
+                    if "Running fMRIPREP" in line:
+                        found_it = True
+                        break
+                    if "Running fMRIPrep version" in line:
+                        found_it = True
+                        break
         assert found_it
+        assert not list(Path("/flywheel/v0/output").glob("log*.txt"))
@@ -0,0 +1,99 @@
+import gzip
+import logging
+import struct
+
+import pytest
+
+from utils.autotune import autotune, find_bold_runs, read_nifti_shape, run_mem_mb
+
+
+def write_nifti(path, shape, endian="<"):
+    """Write just a NIfTI-1 header with the given dimensions."""
+    header = bytearray(352)
+    struct.pack_into(endian + "i", header, 0, 348)
+    dims = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    struct.pack_into(endian + "8h", header, 40, *dims)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    opener = gzip.open if path.name.endswith(".gz") else open
+    with opener(path, "wb") as fp:
+        fp.write(bytes(header))
+
+
+def test_read_nifti_shape(tmp_path):
+
+    write_nifti(tmp_path / "a.nii.gz", (64, 64, 32, 200))
+    write_nifti(tmp_path / "b.nii", (10, 20, 30), endian=">")
+    (tmp_path / "c.nii").write_bytes(b"not a nifti")
+
+    assert read_nifti_shape(tmp_path / "a.nii.gz") == (64, 64, 32, 200)
+    assert read_nifti_shape(tmp_path / "b.nii") == (10, 20, 30)
+    assert read_nifti_shape(tmp_path / "c.nii") is None
+
+
+def test_find_bold_runs_counts_echoes(tmp_path):
+
+    func = tmp_path / "sub-01/ses-1/func"
+    for echo in [1, 2, 3]:
+        write_nifti(
+            func / f"sub-01_ses-1_task-rest_echo-{echo}_bold.nii.gz", (64, 64, 32, 200)
+        )
+    write_nifti(func / "sub-01_ses-1_task-motor_bold.nii.gz", (64, 64, 32, 100))
+
+    runs = find_bold_runs(tmp_path)
+
+    assert len(runs) == 2
+    assert sorted(run["echoes"] for run in runs) == [1, 3]
+    # 3 echoes x twice the timepoints x (200 / 100 + 4) vs. (max(1, 100 / 100) + 4)
+    assert run_mem_mb(runs[1]) == pytest.approx(run_mem_mb(runs[0]) * 36 / 5)
+
+
+def test_autotune_small_dataset_uses_fewer_threads(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+    write_nifti(
+        tmp_path / "sub-01/func/sub-01_task-rest_bold.nii.gz", (64, 64, 32, 200)
+    )
+    config = {"n_cpus": 32, "omp-nthreads": 32, "mem": 64000}
+
+    tuning = autotune(tmp_path, config)
+
+    assert config["omp-nthreads"] == 8
+    assert config["n_cpus"] == 10  # 2 for the run + 8 for omp
+    assert config["mem"] == 57600
+    assert "low-mem" not in config
+    assert tuning["recon-all"]
+    assert search_caplog(caplog, "1 BOLD runs keep about 10 cpus busy")
+    assert search_caplog(caplog, "changing omp-nthreads from 32 to 8")
+
+
+def test_autotune_big_data_little_memory(tmp_path):
+
+    for run in range(1, 5):
+        write_nifti(
+            tmp_path / f"sub-01/func/sub-01_task-rest_run-{run}_bold.nii.gz",
+            (128, 128, 80, 600),
+        )
+    config = {"n_cpus": 16, "omp-nthreads": 16, "mem": 32000, "fs-no-reconall": True}
+
+    tuning = autotune(tmp_path, config)
+
+    # each run needs ~ 3 GB * 10, more than the 28.8 GB - 6 GB left
+    assert config["low-mem"]
+    assert config["n_cpus"] == 8
+    assert not tuning["recon-all"]
+
+
+def test_autotune_config_values_are_caps(tmp_path):
+
+    for run in range(1, 9):
+        write_nifti(
+            tmp_path / f"sub-01/func/sub-01_task-rest_run-{run}_bold.nii.gz",
+            (64, 64, 32, 200),
+        )
+    config = {"n_cpus": 6, "omp-nthreads": 2, "mem": 100000}
+
+    autotune(tmp_path, config, fs_subjects_dir="input/fs-subjects-dir/fs.zip")
+
+    assert config["n_cpus"] == 6
+    assert config["omp-nthreads"] == 2
+    assert config["mem"] <= 100000
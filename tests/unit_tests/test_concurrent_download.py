@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from utils.bids.concurrent_download import (
+    DeferredDownloads,
+    DownloadError,
+    FileDownload,
+    backoff_seconds,
+    download_files,
+    make_session,
+    percentiles,
+)
+
+LATENCY = 0.05  # seconds the fake server waits before answering
+FILES = {f"/files/sub-01_run-{n}_bold.nii.gz": os.urandom(50000) for n in range(16)}
+
+
+class FakeServer(BaseHTTPRequestHandler):
+    """Serves FILES slowly, failing the first requests listed in fail."""
+
+    fail = {}  # path: number of 503 responses to send first
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("Authorization")))
+        time.sleep(LATENCY)
+        if self.fail.get(self.path):
+            self.fail[self.path] -= 1
+            self.send_error(503)
+            return
+        if self.path not in FILES:
+            self.send_error(404)
+            return
+        body = FILES[self.path]
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    FakeServer.fail = {}
+    FakeServer.requests = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeServer)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_downloads(url, tmp_path, paths=FILES):
+    return [
+        FileDownload(url + path, tmp_path / os.path.basename(path), len(FILES[path]))
+        for path in paths
+    ]
+
+
+def test_percentiles():
+
+    assert percentiles([]) == {}
+    assert percentiles([3, 1, 2, 4], points=(50, 100)) == {"p50": 2, "p100": 4}
+    assert percentiles(list(range(1, 101))) == {"p50": 50, "p90": 90, "p99": 99}
+
+
+def test_backoff_is_random_and_capped():
+
+    waits = [backoff_seconds(3, base=1, cap=5) for _ in range(100)]
+
+    assert all(0 <= wait <= 5 for wait in waits)
+    assert len(set(waits)) > 1
+
+
+def test_downloading_at_the_same_time_is_quicker(server, tmp_path):
+
+    with make_session(1) as session:
+        one = download_files(
+            session, make_downloads(server, tmp_path / "one"), n_workers=1
+        )
+    with make_session(8) as session:
+        eight = download_files(
+            session, make_downloads(server, tmp_path / "eight"), n_workers=8
+        )
+
+    assert one["files"] == eight["files"] == len(FILES)
+    assert eight["seconds"] * 3 < one["seconds"]
+    assert eight["MB/s"] > one["MB/s"]
+    assert set(eight["latency s"]) == {"p50", "p90", "p99"}
+    for path, body in FILES.items():
+        assert (tmp_path / "eight" / os.path.basename(path)).read_bytes() == body
+    assert not list(tmp_path.glob("*/.*.part"))
+
+
+def test_failures_are_tried_again(server, tmp_path, monkeypatch):
+
+    monkeypatch.setattr(
+        "utils.bids.concurrent_download.backoff_seconds", lambda attempt: 0.01
+    )
+    paths = list(FILES)[:2]
+    FakeServer.fail = {paths[0]: 2}
+
+    with make_session(2) as session:
+        report = download_files(session, make_downloads(server, tmp_path, paths))
+
+    assert report["files"] == 2
+    assert report["retries"] == 2
+    assert (tmp_path / os.path.basename(paths[0])).read_bytes() == FILES[paths[0]]
+
+
+def test_wrong_size_is_not_kept(server, tmp_path, monkeypatch):
+
+    monkeypatch.setattr(
+        "utils.bids.concurrent_download.backoff_seconds", lambda attempt: 0.01
+    )
+    path = list(FILES)[0]
+    downloads = [FileDownload(server + path, tmp_path / "wrong.nii.gz", size=1)]
+    missing = [FileDownload(server + "/missing", tmp_path / "missing.nii.gz")]
+
+    with make_session(2) as session:
+        with pytest.raises(DownloadError) as error:
+            download_files(session, downloads + missing, retries=2)
+
+    assert sorted(error.value.paths) == [
+        tmp_path / "missing.nii.gz",
+        tmp_path / "wrong.nii.gz",
+    ]
+    assert len(FakeServer.requests) == 3 + 1  # 404 is not tried again
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_deferred_downloads_collects_then_downloads(server, tmp_path):
+
+    name = "sub-01_run-0_bold.nii.gz"
+    configuration = SimpleNamespace(
+        host=server + "/api",
+        get_api_key_with_prefix=lambda identifier: "scitran-user key",
+    )
+    acquisition = {"_id": "acq1", "files": [{"name": name, "size": 50000}]}
+    fw = SimpleNamespace(
+        api_client=SimpleNamespace(configuration=configuration),
+        get_acquisition=lambda acquisition_id: acquisition,
+        get_project=lambda project_id: "the project",
+    )
+    served = {f"/api/acquisitions/acq1/files/{name}": FILES[f"/files/{name}"]}
+    FILES.update(served)
+    sidecar = tmp_path / "sub-01_run-0_bold.json"
+    try:
+        downloads = DeferredDownloads(fw)
+        assert downloads.get_project("p") == "the project"
+        downloads.get_acquisition("acq1")
+        downloads.download_file_from_acquisition("acq1", name, str(tmp_path / name))
+        downloads.download_file_from_acquisition("acq1", "x.json", str(sidecar))
+        os.utime(tmp_path / name, (1000, 1000))
+        sidecar.write_text("{}")  # written by flywheel_bids after "downloading"
+
+        report = downloads.run()
+    finally:
+        for path in served:
+            del FILES[path]
+
+    assert report["files"] == 1
+    assert (tmp_path / name).read_bytes() == FILES[f"/files/{name}"]
+    assert (tmp_path / name).stat().st_mtime == 1000
+    assert sidecar.read_text() == "{}"
+    assert FakeServer.requests == [
+        (f"/api/acquisitions/acq1/files/{name}", "scitran-user key")
+    ]
+    assert downloads.run() is None
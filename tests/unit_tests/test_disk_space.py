@@ -0,0 +1,182 @@
+import logging
+import os
+import time
+from types import SimpleNamespace
+
+from utils.disk_space import (
+    GB,
+    SpaceGuard,
+    check_free_space,
+    count_output_spaces,
+    finished_work_dirs,
+    forecast_disk_use,
+    list_input_images,
+    work_is_saved,
+)
+
+IMAGES = [
+    ("sub-01_T1w.nii.gz", "anat", GB // 10),
+    ("sub-01_task-rest_bold.nii.gz", "func", GB),
+    ("sub-02_T1w.nii.gz", "anat", GB // 10),
+    ("sub-02_task-rest_bold.nii.gz", "func", GB),
+]
+
+
+def test_count_output_spaces():
+
+    assert count_output_spaces({}) == 1
+    assert count_output_spaces({"output-spaces": "MNI152NLin2009cAsym T1w"}) == 2
+    assert (
+        count_output_spaces({"output-spaces": "T1w fsnative", "use-aroma": True}) == 2.2
+    )
+
+
+def test_forecast_grows_with_spaces_and_saved_work():
+
+    one = forecast_disk_use(IMAGES, {})
+    two = forecast_disk_use(IMAGES, {"output-spaces": "MNI152NLin2009cAsym T1w"})
+    saved = forecast_disk_use(IMAGES, {"gear-save-intermediate-output": True})
+
+    assert one["bids GB"] == 2.2
+    assert one["bold runs"] == 2
+    assert one["subjects"] == 2
+    assert two["work GB"] > one["work GB"]
+    assert two["output GB"] > one["output GB"]
+    assert saved["archives GB"] > one["archives GB"]
+    assert forecast_disk_use(IMAGES, {}, recon_all=False)["work GB"] < one["work GB"]
+
+
+def test_check_free_space_finds_what_does_not_fit(tmp_path):
+
+    forecast = forecast_disk_use(IMAGES, {})
+    huge = dict(forecast, **{"work GB": 10**9})
+
+    assert check_free_space({k: 0 for k in forecast}, tmp_path, tmp_path) == []
+    problems = check_free_space(huge, tmp_path, tmp_path)
+    assert len(problems) == 1
+    assert "GB are free" in problems[0]
+
+
+def test_list_input_images_uses_bids_info():
+
+    def file_entry(name, folder, size, ignore=False):
+        info = {"BIDS": {"Filename": name, "Folder": folder, "ignore": ignore}}
+        return SimpleNamespace(info=info, size=size)
+
+    acquisition = SimpleNamespace(
+        container_type="acquisition",
+        files=[
+            file_entry("sub-01_T1w.nii.gz", "anat", 10),
+            file_entry("sub-01_task-rest_bold.nii.gz", "func", 100),
+            file_entry("sub-01_task-rest_bold.json", "func", 1),
+            file_entry("sub-01_dwi.nii.gz", "dwi", 50, ignore=True),
+            SimpleNamespace(info={}, size=5),
+        ],
+    )
+    analysis = SimpleNamespace(parent=SimpleNamespace(id="acq"))
+    fw = SimpleNamespace(get=lambda id: analysis if id == "analysis" else acquisition)
+
+    assert list_input_images(fw, "analysis", []) == [
+        ("sub-01_T1w.nii.gz", "anat", 10),
+        ("sub-01_task-rest_bold.nii.gz", "func", 100),
+    ]
+    assert list_input_images(fw, "analysis", ["anat"]) == [
+        ("sub-01_T1w.nii.gz", "anat", 10)
+    ]
+
+
+def make_work(tmp_path):
+
+    work_dir = tmp_path / "work"
+    output_dir = tmp_path / "output" / "analysis_id"
+    (output_dir / "fmriprep").mkdir(parents=True)
+    (output_dir / "fmriprep" / "sub-01.html").write_text("done")
+    for label in ["01", "02"]:
+        (work_dir / "participants" / f"sub-{label}" / "work").mkdir(parents=True)
+        (work_dir / "fmriprep_wf" / f"single_subject_{label}_wf").mkdir(parents=True)
+    return work_dir, output_dir
+
+
+def test_finished_work_dirs(tmp_path):
+
+    work_dir, output_dir = make_work(tmp_path)
+
+    dirs = finished_work_dirs(work_dir, output_dir)
+
+    assert [str(path.relative_to(work_dir)) for path in dirs] == [
+        "participants/sub-01/work",
+        "fmriprep_wf/single_subject_01_wf",
+    ]
+
+
+def test_space_guard_prunes_finished_participants(tmp_path, caplog):
+
+    caplog.set_level(logging.INFO)
+    work_dir, output_dir = make_work(tmp_path)
+    guard = SpaceGuard(work_dir, output_dir, min_free_gb=10, interval=0.01)
+    guard.started -= 60  # the report was written during this try
+    guard.free_gb = lambda: 5
+
+    assert guard.check() == 5
+
+    assert not (work_dir / "participants" / "sub-01" / "work").exists()
+    assert not (work_dir / "fmriprep_wf" / "single_subject_01_wf").exists()
+    assert (work_dir / "participants" / "sub-02" / "work").exists()
+    assert (work_dir / "fmriprep_wf" / "single_subject_02_wf").exists()
+    summary = guard.summary()
+    assert summary["lowest free GB"] == 5
+    assert len(summary["pruned"]) == 2
+    assert "nothing more can be removed" in caplog.text
+
+
+def test_space_guard_leaves_work_alone_with_room(tmp_path):
+
+    work_dir, output_dir = make_work(tmp_path)
+    guard = SpaceGuard(work_dir, output_dir, min_free_gb=10, interval=0.01)
+    guard.free_gb = lambda: 50
+
+    guard.start()
+    guard.stop()
+    guard.start()  # started again for the next try
+    guard.check()
+    guard.stop()
+
+    assert guard.summary() == {"lowest free GB": 50, "pruned": [], "pruned GB": 0}
+    assert (work_dir / "participants" / "sub-01" / "work").exists()
+
+
+def test_reports_from_before_do_not_count(tmp_path):
+
+    work_dir, output_dir = make_work(tmp_path)
+    (output_dir / "fmriprep" / "sub-02.html").write_text("from previous-results")
+    hour_ago = time.time() - 3600
+    os.utime(output_dir / "fmriprep" / "sub-02.html", (hour_ago, hour_ago))
+    guard = SpaceGuard(work_dir, output_dir, min_free_gb=10)
+    guard.started -= 60
+    guard.free_gb = lambda: 5
+
+    guard.check()
+
+    assert guard.pruned == [
+        os.path.join("participants", "sub-01", "work"),
+        os.path.join("fmriprep_wf", "single_subject_01_wf"),
+    ]
+    assert (work_dir / "participants" / "sub-02" / "work").exists()
+    assert (work_dir / "fmriprep_wf" / "single_subject_02_wf").exists()
+
+
+def test_saved_work_is_not_pruned(tmp_path):
+
+    work_dir, output_dir = make_work(tmp_path)
+    config = {"gear-save-intermediate-output": False, "gear-work-store": "/store"}
+    guard = SpaceGuard(work_dir, output_dir, 10, prune=not work_is_saved(config))
+    guard.started -= 60
+    guard.free_gb = lambda: 5
+
+    guard.check()
+
+    assert work_is_saved(config)
+    assert not work_is_saved({"gear-save-intermediate-output": False})
+    assert work_is_saved({"gear-save-intermediate-output": True})
+    assert guard.summary() == {"lowest free GB": 5, "pruned": [], "pruned GB": 0}
+    assert (work_dir / "fmriprep_wf" / "single_subject_01_wf").exists()
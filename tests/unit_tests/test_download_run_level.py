@@ -506,10 +506,7 @@ def test_download_bids_for_runlevel_nothing_downloaded_detected(
         return_value=Acquisition(),
     ):
 
-        with patch(
-            "flywheel_gear_toolkit.GearToolkitContext.download_project_bids",
-            return_value="nowhere",
-        ):
+        with patch("utils.bids.download_run_level.download_bids_dir"):
 
             gtk_context = flywheel_gear_toolkit.GearToolkitContext(
                 input_args=["-d aex:analysis"], gear_path=tmp_path
@@ -0,0 +1,38 @@
+import json
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+# Importing any of these would make run.py (and so every gear start) slower: the
+# SDK (flywheel, flywheel_bids) alone adds 0.4 s.  They are imported where used.
+HEAVY = re.compile(
+    r"^(flywheel|flywheel_gear_toolkit|flywheel_bids|fw_\w+|nipype|niworkflows"
+    r"|fmriprep|nibabel|numpy|pandas|scipy|requests|urllib3)(\.|$)"
+)
+REPO = Path(__file__).resolve().parents[2]
+
+
+def imported_by(module):
+    """Names of the modules importing module imports, in a new interpreter."""
+
+    code = (
+        "import json, sys; before = set(sys.modules); "
+        f"import {module}; print(json.dumps(sorted(set(sys.modules) - before)))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout)
+
+
+def test_run_does_not_import_heavy_modules():
+
+    modules = imported_by("run")
+
+    assert "run" in modules
+    assert not [name for name in modules if HEAVY.match(name)]
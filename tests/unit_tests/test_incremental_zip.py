@@ -0,0 +1,90 @@
+import logging
+import os
+import time
+from zipfile import ZipFile
+
+from utils.results.incremental_zip import OutputArchiver
+
+
+def make_participant(output_dir, label):
+    fmriprep = output_dir / "5f00/fmriprep"
+    (fmriprep / label / "anat").mkdir(parents=True)
+    (fmriprep / label / "anat" / f"{label}_T1w.nii.gz").write_bytes(b"nifti")
+    (output_dir / "5f00/freesurfer" / label / "mri").mkdir(parents=True)
+    (output_dir / "5f00/freesurfer" / label / "mri/orig.mgz").write_bytes(b"mgz")
+    (fmriprep / f"{label}.html").write_text("<html/>")
+
+
+def test_output_archiver_archives_stable_reports_only(tmp_path):
+
+    make_participant(tmp_path, "sub-old")  # e.g. from previous-results
+    old = time.time() - 3600
+    os.utime(tmp_path / "5f00/fmriprep/sub-old.html", (old, old))
+
+    archiver = OutputArchiver(tmp_path, "5f00", {None: "all.zip"}, 2)
+    archiver._started = time.time() - 10
+    make_participant(tmp_path, "sub-01")
+
+    assert archiver.finished_participants() == []  # first time seen
+    assert archiver.finished_participants() == ["sub-01"]
+
+    archiver.archive_participant("sub-01")
+
+    assert archiver.finished_participants() == []
+    archiver.finish()
+
+
+def test_output_archiver_background_then_finish(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.DEBUG)
+
+    (tmp_path / "5f00/fmriprep/logs").mkdir(parents=True)
+    (tmp_path / "5f00/fmriprep/logs/CITATION.md").write_text("cite")
+    zip_names = {
+        "fmriprep": "gear_fmriprep.zip",
+        "freesurfer": "gear_freesurfer.zip",
+    }
+    archiver = OutputArchiver(tmp_path, "5f00", zip_names, 2, poll_interval=0.05)
+    archiver.start()
+    make_participant(tmp_path, "sub-01")
+    for _ in range(100):
+        if archiver.archived:
+            break
+        time.sleep(0.05)
+    archiver.stop()
+    make_participant(tmp_path, "sub-02")  # finished after the "run"
+
+    archiver.finish()
+
+    assert archiver.archived == ["sub-01"]
+    with ZipFile(tmp_path / "gear_fmriprep.zip") as zip_file:
+        assert zip_file.testzip() is None
+        names = zip_file.namelist()
+    assert len(names) == len(set(names))
+    assert "5f00/fmriprep/sub-01/anat/sub-01_T1w.nii.gz" in names
+    assert "5f00/fmriprep/sub-02.html" in names
+    assert "5f00/fmriprep/logs/CITATION.md" in names
+    assert not any("freesurfer" in name for name in names)
+    with ZipFile(tmp_path / "gear_freesurfer.zip") as zip_file:
+        names = zip_file.namelist()
+    assert "5f00/freesurfer/sub-01/mri/orig.mgz" in names
+    assert "5f00/freesurfer/sub-02/mri/orig.mgz" in names
+    assert search_caplog(caplog, "finished participant sub-01")
+
+
+def test_output_archiver_finish_zips_changed_files_again(tmp_path):
+
+    archiver = OutputArchiver(tmp_path, "5f00", {None: "all.zip"}, 2)
+    make_participant(tmp_path, "sub-01")
+    archiver.archive_participant("sub-01")
+    report = tmp_path / "5f00/fmriprep/sub-01.html"
+    report.write_text("<html>tried again</html>")
+    later = time.time() + 10
+    os.utime(report, (later, later))
+
+    archiver.finish()
+
+    with ZipFile(tmp_path / "all.zip") as zip_file:
+        names = zip_file.namelist()
+        assert zip_file.read("5f00/fmriprep/sub-01.html") == b"<html>tried again</html>"
+    assert len(names) == len(set(names))
@@ -0,0 +1,62 @@
+import gzip
+import sys
+
+import pytest
+
+from utils.command import CommandFailed, run_command
+from utils.log_pump import LogPump, segment_name
+
+
+def read_segments(pump):
+    return "".join(gzip.open(name, "rt").read() for name in pump.segments)
+
+
+def test_similar_lines_are_collapsed(tmp_path):
+
+    with LogPump(tmp_path / "log1.txt") as pump:
+        pump.write("Starting")
+        for free in range(100):
+            pump.write(f"[MultiProc] Running 4 tasks. Free memory (GB): {free}/60")
+        pump.write("Done")
+
+    assert read_segments(pump) == (
+        "Starting\n"
+        "[MultiProc] Running 4 tasks. Free memory (GB): 0/60\n"
+        "[... 98 similar lines ...]\n"
+        "[MultiProc] Running 4 tasks. Free memory (GB): 99/60\n"
+        "Done\n"
+    )
+    assert pump.collapsed == 98
+
+
+def test_segments_and_tail(tmp_path):
+
+    pump = LogPump(tmp_path / "log1.txt", segment_bytes=100, tail_lines=3)
+    for number in range(50):
+        pump.write(f"{chr(ord('a') + number % 26)} line")
+    pump.close()
+
+    assert pump.segments[0] == tmp_path / "log1.txt.gz"
+    assert pump.segments[1] == segment_name(tmp_path / "log1.txt", 1)
+    assert pump.segments[1].name == "log1.001.txt.gz"
+    assert len(pump.segments) == 4  # 7 bytes a line, 15 lines a segment
+    assert read_segments(pump).count("\n") == 50
+    assert pump.tail() == "v line\nw line\nx line\n"
+
+
+def test_run_command_saves_output_and_shows_the_end(tmp_path, caplog):
+
+    script = (
+        "import sys; print('to stdout'); "
+        "print('Cannot allocate memory', file=sys.stderr); sys.exit(3)"
+    )
+
+    with pytest.raises(CommandFailed) as exc_info:
+        run_command([sys.executable, "-c", script], log_file=str(tmp_path / "log1.txt"))
+
+    saved = gzip.open(tmp_path / "log1.txt.gz", "rt").read()
+    assert "to stdout" in saved
+    assert "Cannot allocate memory" in saved
+    assert exc_info.value.returncode == 3
+    assert "to stdout" in exc_info.value.stderr
+    assert "Cannot allocate memory" in exc_info.value.stderr
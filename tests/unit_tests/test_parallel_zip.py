@@ -0,0 +1,166 @@
+import os
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+import pytest
+
+import utils.results.parallel_zip as parallel_zip
+from utils.results.parallel_zip import (
+    ParallelZipFile,
+    parallel_zip_output,
+    prepare_entry,
+)
+
+
+@pytest.fixture
+def output_tree(tmp_path):
+    root_dir = tmp_path / "output"
+    files = {
+        "5f00/fmriprep/sub-01.html": b"<html>" + b"report " * 1000 + b"</html>",
+        "5f00/fmriprep/sub-01/anat/sub-01_desc-brain_mask.nii.gz": os.urandom(5000),
+        "5f00/fmriprep/sub-01/figures/sub-01_dseg.svg": b"<svg/>" * 500,
+        "5f00/fmriprep/sub-01/figures/sub-01_carpet.png": os.urandom(3000),
+        "5f00/fmriprep/logs/empty.txt": b"",
+        "5f00/freesurfer/sub-01/mri/nu.txt": os.urandom(2000),  # incompressible
+    }
+    for name, data in files.items():
+        path = root_dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    (root_dir / "5f00/fmriprep/empty_dir").mkdir()
+    yield root_dir, files
+
+
+def test_parallel_zip_output_round_trips(output_tree):
+
+    root_dir, files = output_tree
+
+    parallel_zip_output(str(root_dir), "5f00", "out.zip", n_workers=3)
+
+    with ZipFile(root_dir / "out.zip") as zip_file:
+        assert zip_file.testzip() is None
+        names = zip_file.namelist()
+        for name, data in files.items():
+            assert zip_file.read(name) == data
+        assert "5f00/fmriprep/empty_dir/" in names
+        infos = {info.filename: info for info in zip_file.infolist()}
+    html = infos["5f00/fmriprep/sub-01.html"]
+    assert html.compress_type == ZIP_DEFLATED
+    assert html.compress_size < html.file_size
+    nifti = infos["5f00/fmriprep/sub-01/anat/sub-01_desc-brain_mask.nii.gz"]
+    assert nifti.compress_type == ZIP_STORED
+    assert infos["5f00/fmriprep/sub-01/figures/sub-01_carpet.png"].compress_type == (
+        ZIP_STORED
+    )
+    assert infos["5f00/freesurfer/sub-01/mri/nu.txt"].compress_type == ZIP_STORED
+
+
+def test_parallel_zip_output_excludes_files(output_tree):
+
+    root_dir, files = output_tree
+
+    parallel_zip_output(
+        str(root_dir),
+        "5f00/fmriprep",
+        str(root_dir / "fmriprep.zip"),
+        exclude_files=["5f00/fmriprep/sub-01.html"],
+    )
+
+    with ZipFile(root_dir / "fmriprep.zip") as zip_file:
+        names = zip_file.namelist()
+    assert "5f00/fmriprep/sub-01.html" not in names
+    assert "5f00/fmriprep/logs/empty.txt" in names
+    assert not any(name.startswith("5f00/freesurfer") for name in names)
+
+
+def test_parallel_zip_file_zip64(output_tree, monkeypatch):
+
+    root_dir, files = output_tree
+    monkeypatch.setattr(parallel_zip, "ZIP64_LIMIT", 100)
+    monkeypatch.setattr(parallel_zip, "ZIP_FILECOUNT_LIMIT", 3)
+
+    with ParallelZipFile(root_dir / "big.zip", n_workers=2) as outzip:
+        outzip.write_paths(
+            (str(root_dir / name), name) for name in sorted(files) if files[name]
+        )
+
+    with ZipFile(root_dir / "big.zip") as zip_file:
+        assert zip_file.testzip() is None
+        for name, data in files.items():
+            if data:
+                assert zip_file.read(name) == data
+
+
+def test_parallel_zip_file_skips_names_already_written(output_tree):
+
+    root_dir, files = output_tree
+    name = "5f00/fmriprep/sub-01.html"
+
+    with ParallelZipFile(root_dir / "twice.zip") as outzip:
+        first = outzip.write_paths([(str(root_dir / name), name)])
+        second = outzip.write_paths([(str(root_dir / name), name)])
+
+    assert (first, second) == (1, 0)
+    with ZipFile(root_dir / "twice.zip") as zip_file:
+        assert zip_file.namelist() == [name]
+
+
+def test_parallel_zip_file_writes_changed_files_again(output_tree):
+
+    root_dir, files = output_tree
+    name = "5f00/fmriprep/sub-01.html"
+    path = root_dir / name
+
+    with ParallelZipFile(root_dir / "changed.zip") as outzip:
+        first = outzip.write_paths([(str(path), name)])
+        path.write_text("<html>tried again</html>")
+        os.utime(path, ns=(0, path.stat().st_mtime_ns + 1))
+        second = outzip.write_paths([(str(path), name)])
+
+    assert (first, second) == (1, 1)
+    with ZipFile(root_dir / "changed.zip") as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == [name]
+        assert zip_file.read(name) == b"<html>tried again</html>"
+
+
+def test_file_growing_while_it_is_read_is_read_again(output_tree, monkeypatch):
+
+    root_dir, files = output_tree
+    name = "5f00/fmriprep/sub-01.html"
+    path = root_dir / name
+    checksum = parallel_zip._checksum
+    reads = []
+
+    def growing(fp, compress):
+        result = checksum(fp, compress)
+        if not reads:
+            with open(path, "ab") as grow:
+                grow.write(b"<!-- more -->")
+        reads.append(result[1])
+        return result
+
+    monkeypatch.setattr(parallel_zip, "_checksum", growing)
+
+    entry = prepare_entry(str(path), name)
+
+    assert reads == [len(files[name]), len(files[name]) + 13]
+    assert entry.file_size == len(files[name]) + 13
+
+
+def test_stored_file_changed_before_it_is_written(output_tree):
+
+    root_dir, files = output_tree
+    name = "5f00/fmriprep/sub-01/figures/sub-01_carpet.png"
+    path = root_dir / name
+    changed = os.urandom(len(files[name]) + 10)
+
+    with ParallelZipFile(root_dir / "changed.zip") as outzip:
+        entry = prepare_entry(str(path), name)
+        path.write_bytes(changed)
+        written = outzip.write_entry(entry)
+
+    assert written is not entry
+    with ZipFile(root_dir / "changed.zip") as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.read(name) == changed
@@ -0,0 +1,78 @@
+import logging
+
+from utils.fly.resources import detect_resources, read_cgroup_limits, read_job_limits
+from utils.fly.set_performance_config import set_mem_mb, set_n_cpus
+
+
+def test_read_cgroup_limits_v2(tmp_path):
+
+    proc_cgroup = tmp_path / "cgroup"
+    proc_cgroup.write_text("0::/kubepods/pod1\n")
+    pod = tmp_path / "kubepods/pod1"
+    pod.mkdir(parents=True)
+    (pod / "cpu.max").write_text("400000 100000\n")
+    (pod / "memory.max").write_text(f"{16 * 1024**3}\n")
+    (pod / "memory.high").write_text("max\n")
+    (tmp_path / "kubepods/memory.max").write_text(f"{8 * 1024**3}\n")
+    (tmp_path / "cpu.max").write_text("max 100000\n")
+
+    cpus, mem_mb = read_cgroup_limits(tmp_path, proc_cgroup)
+
+    assert cpus == {"cgroup cpu max": 4}
+    assert mem_mb == {"cgroup memory max": 16384, "cgroup memory max 1 up": 8192}
+
+
+def test_read_cgroup_limits_v1_in_container(tmp_path):
+
+    proc_cgroup = tmp_path / "cgroup"
+    proc_cgroup.write_text("4:memory:/docker/abc\n2:cpu,cpuacct:/docker/abc\n")
+    # the container's own cgroup is mounted at the root
+    (tmp_path / "cpu").mkdir()
+    (tmp_path / "cpu/cpu.cfs_quota_us").write_text("150000\n")
+    (tmp_path / "cpu/cpu.cfs_period_us").write_text("100000\n")
+    (tmp_path / "memory").mkdir()
+    (tmp_path / "memory/memory.limit_in_bytes").write_text("9223372036854771712\n")
+
+    cpus, mem_mb = read_cgroup_limits(tmp_path, proc_cgroup)
+
+    assert cpus == {"cgroup cpu cfs_quota_us": 1}
+    assert mem_mb == {}  # no limit
+
+
+def test_read_job_limits():
+
+    environ = {
+        "LSB_JOBID": "1234",
+        "LSB_DJOB_NUMPROC": "8",
+        "SLURM_CPUS_ON_NODE": "6",
+        "SLURM_MEM_PER_CPU": "2000",
+    }
+
+    cpus, mem_mb = read_job_limits(environ, {"lsf-ram": "rusage[mem=12000]"})
+
+    assert cpus == {"LSB_DJOB_NUMPROC": 8, "SLURM_CPUS_ON_NODE": 6}
+    assert mem_mb == {"lsf-ram": 12000, "SLURM_MEM_PER_CPU": 12000}
+
+    # lsf-ram has a default so it only counts when running under LSF
+    assert read_job_limits({}, {"lsf-ram": "rusage[mem=12000]"}) == ({}, {})
+
+
+def test_detect_resources_takes_the_tightest(tmp_path):
+
+    environ = {"SLURM_CPUS_ON_NODE": "1", "SLURM_MEM_PER_NODE": "10"}
+
+    resources = detect_resources(environ=environ, root=tmp_path)
+
+    assert resources["n_cpus"] == 1
+    assert resources["mem_mb"] == 10
+    assert resources["mem_mb from"] == "SLURM_MEM_PER_NODE"
+    assert "available memory" in resources["mem_mb limits"]
+
+
+def test_set_performance_config_uses_what_is_available(caplog, search_caplog):
+
+    caplog.set_level(logging.DEBUG)
+
+    assert set_n_cpus(8, 0, available=4) == (4, 4)
+    assert set_mem_mb(None, available=16000) == 16000
+    assert search_caplog(caplog, "n_cpus > number available, using max 4")
@@ -0,0 +1,78 @@
+import sys
+
+import pytest
+
+import utils.retry as retry
+from utils.command import CommandFailed, run_command
+from utils.retry import FailureProbe, plan_retry
+
+
+@pytest.fixture
+def oom_kills(monkeypatch):
+    counts = {"cgroup": 0, "kernel": None}
+    monkeypatch.setattr(retry, "read_oom_kills", lambda: counts["cgroup"])
+    monkeypatch.setattr(retry, "count_kernel_oom_messages", lambda: counts["kernel"])
+    yield counts
+
+
+def test_classify_failure(oom_kills):
+
+    probe = FailureProbe()
+
+    assert probe.classify(124)[0] == "timeout"
+    assert probe.classify(1)[0] == "error"
+    assert probe.classify(143)[0] == "killed"
+    assert probe.classify(1, "concurrent.futures.process.BrokenProcessPool")[0] == (
+        "oom"
+    )
+    assert probe.classify(1, "Insufficient resources available for job")[0] == (
+        "memory cap"
+    )
+    oom_kills["cgroup"] = 2
+    assert probe.classify(137) == ("oom", "2 cgroup OOM kill(s)")
+
+
+def test_plan_retry_lowers_resources_after_oom():
+
+    config = {"n_cpus": 8, "omp-nthreads": 8, "mem": 16000}
+
+    decision, again = plan_retry("oom", config, 32000)
+    assert again
+    assert config == {"n_cpus": 4, "omp-nthreads": 4, "mem": 16000, "low-mem": True}
+    assert "--low-mem" in decision
+
+    for _ in range(2):
+        assert plan_retry("oom", config, 32000)[1]
+    assert config["n_cpus"] == 1
+    assert not plan_retry("oom", config, 32000)[1]
+
+    assert plan_retry("memory cap", config, 32000)[1]
+    assert config["mem"] == 32000
+    assert not plan_retry("memory cap", config, 32000)[1]
+    assert not plan_retry("timeout", config, 32000)[1]
+    assert plan_retry("error", config, 32000) == ("try again unchanged", True)
+
+
+def test_run_command_failure_has_exit_status(caplog, search_caplog):
+
+    with pytest.raises(CommandFailed) as exc_info:
+        run_command(
+            [
+                sys.executable,
+                "-c",
+                '\'import sys; print("oops", file=sys.stderr); ' "sys.exit(3)'",
+            ],
+            shell=True,
+        )
+
+    assert exc_info.value.returncode == 3
+    assert exc_info.value.stderr == "oops\n"
+    assert search_caplog(caplog, "Command return code: 3")
+
+
+def test_run_command_killed_by_signal():
+
+    with pytest.raises(CommandFailed) as exc_info:
+        run_command([sys.executable, "-c", "import os; os.kill(os.getpid(), 9)"])
+
+    assert exc_info.value.returncode == 137
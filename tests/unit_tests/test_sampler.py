@@ -0,0 +1,54 @@
+import gzip
+import subprocess
+import sys
+import time
+
+from utils.monitor.sampler import ALL, COLUMNS, ProcessTreeSampler, format_elapsed
+
+
+def test_process_tree_sampler_samples_children(tmp_path):
+
+    file_name = tmp_path / "resources.tsv.gz"
+    sampler = ProcessTreeSampler(file_name, 0.05, 1)
+    sampler.start()
+    child = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "x = bytearray(50 * 1024**2); import time; " "time.sleep(0.5)",
+        ]
+    )
+    time.sleep(0.3)
+    sampler.stop()
+    child.wait()
+
+    with gzip.open(file_name, "rt") as fp:
+        lines = [line.rstrip("\n").split("\t") for line in fp]
+    assert lines[0] == COLUMNS
+    rows = [dict(zip(COLUMNS, line)) for line in lines[1:]]
+    assert any(row["command"] == ALL for row in rows)
+    assert any(row["command"].startswith("python") for row in rows)
+    assert sampler.peak["rss_bytes"] > 50 * 1024**2
+    assert sampler.summary()["samples"] == sampler.samples > 0
+
+
+def test_resources_used_has_the_time_keys():
+
+    sampler = ProcessTreeSampler("not used", 0, 1)
+    sampler.start()
+    subprocess.run([sys.executable, "-c", "sum(range(10**6))"])
+    sampler.stop()
+
+    resources = sampler.resources_used(["fmriprep", "bids"], 0)
+
+    assert len(resources) == 23  # same as "/usr/bin/time -v"
+    assert resources["Command being timed"] == "fmriprep bids"
+    assert float(resources["User time (seconds)"]) > 0
+    assert int(resources["Maximum resident set size (kbytes)"]) > 0
+    assert resources["Exit status"] == "0"
+
+
+def test_format_elapsed():
+
+    assert format_elapsed(8.11) == "0:08.11"
+    assert format_elapsed(3725) == "1:02:05"
@@ -0,0 +1,102 @@
+import sys
+
+import pytest
+
+from utils.command import CommandFailed
+from utils.scheduler import (
+    ParticipantScheduler,
+    find_finished_participants,
+    find_participants,
+    merge_output,
+    number_of_slots,
+)
+
+# pretend to be fMRIPrep: write a report and a shared file into the output dir
+FAKE_FMRIPREP = (
+    "import pathlib, sys; out = pathlib.Path(sys.argv[1]) / 'fmriprep'; "
+    "out.mkdir(parents=True); (out / 'dataset_description.json').write_text('{}'); "
+    "(out / f'sub-{sys.argv[2]}').mkdir(); "
+    "(out / f'sub-{sys.argv[2]}.html').write_text('report'); "
+    "sys.exit(int(sys.argv[3]))"
+)
+
+
+def test_find_participants(tmp_path):
+
+    (tmp_path / "sub-01/anat").mkdir(parents=True)
+    (tmp_path / "sub-01/anat/sub-01_T1w.nii.gz").write_bytes(b"x" * 10)
+    (tmp_path / "sub-01/anat/sub-01_T1w.json").write_bytes(b"x" * 100)
+    (tmp_path / "sub-02/func").mkdir(parents=True)
+    (tmp_path / "sub-02/func/sub-02_bold.nii").write_bytes(b"x" * 30)
+    (tmp_path / "sub-03.txt").touch()
+
+    assert find_participants(tmp_path) == {"01": 10, "02": 30}
+
+
+def test_find_finished_participants(tmp_path):
+
+    (tmp_path / "fmriprep/sub-01").mkdir(parents=True)
+    (tmp_path / "fmriprep/sub-01.html").write_text("report")
+    (tmp_path / "fmriprep/sub-02").mkdir()  # not finished, no report yet
+
+    assert find_finished_participants(tmp_path) == ["01"]
+
+
+def test_number_of_slots():
+
+    assert number_of_slots(10, 3, 16, 64000) == 3
+    assert number_of_slots(2, 3, 16, 64000) == 2
+    assert number_of_slots(10, 0, 16, 64000) == 4  # 4 cpus each
+    assert number_of_slots(10, 0, 16, 20000) == 2  # 8 GB each
+    assert number_of_slots(10, 0, 2, 4000) == 1
+
+
+def test_merge_output_replaces_files(tmp_path):
+
+    (tmp_path / "src/fmriprep/sub-01").mkdir(parents=True)
+    (tmp_path / "src/fmriprep/sub-01/new.txt").write_text("new")
+    (tmp_path / "src/fmriprep/shared.txt").write_text("new")
+    (tmp_path / "dest/fmriprep").mkdir(parents=True)
+    (tmp_path / "dest/fmriprep/shared.txt").write_text("old")
+
+    merge_output(tmp_path / "src", tmp_path / "dest")
+
+    assert (tmp_path / "dest/fmriprep/sub-01/new.txt").read_text() == "new"
+    assert (tmp_path / "dest/fmriprep/shared.txt").read_text() == "new"
+    assert not (tmp_path / "src").exists()
+
+
+def test_scheduler_runs_and_retries_only_failed(tmp_path):
+
+    exit_status = {"01": 0, "02": 3, "03": 0}
+
+    def make_command(label, work_dir, output_dir):
+        assert work_dir.exists()
+        return [
+            sys.executable,
+            "-c",
+            f'"{FAKE_FMRIPREP}"',
+            str(output_dir),
+            label,
+            str(exit_status[label]),
+        ]
+
+    output_dir = tmp_path / "output"
+    scheduler = ParticipantScheduler(
+        {"01": 10, "02": 30, "03": 20}, 2, tmp_path / "participants", output_dir
+    )
+
+    with pytest.raises(CommandFailed) as exc_info:
+        scheduler.run(make_command, None)
+
+    assert exc_info.value.returncode == 3
+    assert sorted(scheduler.finished) == ["01", "03"]
+    for label in ["01", "02", "03"]:  # even failed output is kept
+        assert (output_dir / f"fmriprep/sub-{label}.html").exists()
+    assert (output_dir / "fmriprep/dataset_description.json").exists()
+
+    exit_status["02"] = 0
+    exit_status["01"] = 5  # would fail if it were run again
+    scheduler.run(make_command, None)
+
+    assert sorted(scheduler.finished) == ["01", "02", "03"]
@@ -0,0 +1,67 @@
+from pathlib import Path
+
+from utils.scratch import choose_scratch, find_candidates, place_work_dir, probe
+
+SLOW = {"free GB": 500, "write MB/s": 100, "file ops/s": 1000, "file system": "nfs"}
+FAST = {"free GB": 200, "write MB/s": 2000, "file ops/s": 50000, "file system": "xfs"}
+MEMORY = {
+    "free GB": 60,
+    "write MB/s": 5000,
+    "file ops/s": 200000,
+    "file system": "tmpfs",
+}
+
+
+def test_probe_measures_a_directory(tmp_path):
+
+    measurements = probe(tmp_path, probe_bytes=2 * 1024**2, probe_files=20)
+
+    assert measurements["free GB"] > 0
+    assert measurements["write MB/s"] > 0
+    assert measurements["file ops/s"] > 0
+    assert list(tmp_path.iterdir()) == []  # cleaned up
+    assert probe(tmp_path / "missing") is None
+
+
+def test_choose_the_quickest_place_with_room():
+
+    here, local, shm = Path("/flywheel/v0"), Path("/local"), Path("/dev/shm")
+    measured = {here: SLOW, local: FAST, shm: MEMORY}
+
+    assert choose_scratch(measured, 30, spare_memory_gb=100)[0] == shm
+    chosen, reasons = choose_scratch(measured, 30, spare_memory_gb=10)
+    assert chosen == local
+    assert reasons[shm] == "in memory, only 10 GB to spare"
+    assert choose_scratch(measured, 300, spare_memory_gb=0)[0] == here
+    assert choose_scratch(measured, 1000, spare_memory_gb=0)[0] is None
+
+
+def test_stay_unless_much_quicker():
+
+    here, other = Path("/here"), Path("/other")
+    a_bit_faster = dict(SLOW, **{"write MB/s": 120, "file ops/s": 1200})
+
+    assert choose_scratch({here: SLOW, other: a_bit_faster}, 30, 0)[0] == here
+
+
+def test_place_work_dir_links_to_the_new_place(tmp_path):
+
+    gear_dir = tmp_path / "gear"
+    work_dir = gear_dir / "work"
+    work_dir.mkdir(parents=True)
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+
+    candidates = find_candidates(gear_dir, [str(scratch)], environ={})
+    assert candidates[0] == gear_dir
+    assert scratch not in candidates  # same file system as gear_dir
+
+    placed, report = place_work_dir(work_dir, work_gb=0.001)
+
+    # tmp_path may or may not be on the quickest file system of this computer
+    if placed:
+        assert work_dir.is_symlink()
+        assert work_dir.resolve() == placed.resolve()
+    else:
+        assert work_dir.is_dir() and not work_dir.is_symlink()
+    assert report["candidates"][0]["path"] == str(gear_dir)
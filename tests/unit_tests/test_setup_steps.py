@@ -0,0 +1,59 @@
+import logging
+import time
+
+from utils.monitor.spans import PhaseRecorder
+from utils.setup_steps import SetupStep, run_setup_steps
+
+
+def test_independent_steps_run_at_the_same_time(caplog, search_caplog_contains):
+
+    caplog.set_level(logging.INFO)
+    phases = PhaseRecorder()
+    errors = []
+    steps = [
+        SetupStep(name, lambda name=name: time.sleep(0.5) or name)
+        for name in ["download", "license", "templateflow"]
+    ]
+
+    start = time.monotonic()
+    results = run_setup_steps(steps, errors, phases)
+
+    assert time.monotonic() - start < 1.2
+    assert results == {name: name for name in ["download", "license", "templateflow"]}
+    assert errors == []
+    assert search_caplog_contains(caplog, "Setup: templateflow started", "running")
+    assert len({phase.tid for phase in phases.phases}) == 3
+
+
+def test_steps_wait_for_the_steps_they_come_after():
+
+    done = []
+    steps = [
+        SetupStep("unzip", lambda: done.append("unzip"), after=["links"]),
+        SetupStep("links", lambda: time.sleep(0.2) or done.append("links")),
+    ]
+
+    run_setup_steps(steps, [])
+
+    assert done == ["links", "unzip"]
+
+
+def test_errors_are_collected(caplog):
+
+    def no_license():
+        raise FileNotFoundError("Could not find FreeSurfer license anywhere")
+
+    errors = []
+    ran = []
+    steps = [
+        SetupStep("license", no_license),
+        SetupStep("after license", lambda: ran.append(1), after=["license"]),
+        SetupStep("templateflow", lambda: ran.append(2)),
+    ]
+
+    results = run_setup_steps(steps, errors)
+
+    assert results == {"templateflow": None}
+    assert ran == [2]
+    assert isinstance(errors[0], FileNotFoundError)
+    assert "after license was not run" in caplog.text
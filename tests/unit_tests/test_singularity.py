@@ -0,0 +1,12 @@
+import json
+
+from utils.singularity import WRITABLE_DIR, read_writable_dir
+
+
+def test_read_writable_dir(tmp_path):
+
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({"config": {"gear-writable-dir": "/scratch"}}))
+
+    assert read_writable_dir(config_path) == "/scratch"
+    assert read_writable_dir(tmp_path / "missing.json") == WRITABLE_DIR
@@ -0,0 +1,33 @@
+import json
+import subprocess
+import sys
+
+from utils.monitor.spans import PhaseRecorder
+
+
+def test_phase_recorder_records_phases(tmp_path):
+
+    phases = PhaseRecorder()
+    phases.phase("write")
+    (tmp_path / "big").write_bytes(b"x" * 1024**2)
+    phases.phase("child")
+    subprocess.run([sys.executable, "-c", "sum(range(10**6))"])
+    phases.phase("write")
+    phases.stop()
+    phases.stop()  # nothing to stop
+
+    summary = phases.summary()
+
+    assert list(summary) == ["write", "child"]
+    assert summary["child"]["children cpu s"] > 0
+    for measurements in summary.values():
+        assert measurements["wall s"] >= 0
+        assert measurements["peak rss MiB"] > 0
+
+    phases.write_chrome_trace(tmp_path / "trace.json")
+
+    trace = json.loads((tmp_path / "trace.json").read_text())
+    events = trace["traceEvents"]
+    assert [event["name"] for event in events] == ["write", "child", "write"]
+    assert all(event["ph"] == "X" for event in events)
+    assert events[1]["ts"] >= events[0]["ts"] + events[0]["dur"]
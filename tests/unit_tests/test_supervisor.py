@@ -0,0 +1,118 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import psutil
+import pytest
+
+from utils import supervisor
+from utils.command import CommandFailed, run_command
+from utils.supervisor import find_tree, forward_signals, reap_orphans
+
+# a command that leaves a process running in the background when it ends
+LEAVES_ORPHAN = [
+    "sh",
+    "-c",
+    "'sleep 60 > /dev/null 2>&1 & echo $!'",
+]
+
+
+def test_nothing_is_left_running_after_a_command(capsys, caplog):
+
+    run_command(LEAVES_ORPHAN, shell=True)
+
+    pid = int(capsys.readouterr().out.strip())
+    if psutil.pid_exists(pid):  # it is a zombie until its new parent waits for it
+        assert psutil.Process(pid).status() == psutil.STATUS_ZOMBIE
+    assert "1 processes were still running after the command ended" in caplog.text
+
+
+def test_signals_are_passed_on_to_commands():
+
+    result = {}
+
+    def run():
+        script = "import subprocess; subprocess.run(['sleep', '60'])"
+        try:
+            run_command([sys.executable, "-c", script])
+        except CommandFailed as exc:
+            result["returncode"] = exc.returncode
+
+    with forward_signals():
+        thread = threading.Thread(target=run)
+        thread.start()
+        time.sleep(1)
+        start = time.monotonic()
+        os.kill(os.getpid(), signal.SIGTERM)
+        while thread.is_alive():  # the handler runs in this thread
+            thread.join(0.1)
+
+    assert time.monotonic() - start < 20
+    assert result["returncode"] == 128 + signal.SIGTERM
+
+
+def test_signals_reach_the_gear_when_nothing_is_running():
+
+    with forward_signals():
+        with pytest.raises(KeyboardInterrupt):
+            os.kill(os.getpid(), signal.SIGINT)
+            time.sleep(1)
+
+
+def test_signal_handler_does_not_wait_for_the_lock():
+
+    with forward_signals():
+        with supervisor._lock:  # as if the signal came while registering
+            with pytest.raises(KeyboardInterrupt):
+                os.kill(os.getpid(), signal.SIGINT)
+                time.sleep(1)
+
+
+def test_other_children_are_not_reaped():
+
+    proc = subprocess.Popen(["true"])
+    while psutil.Process(proc.pid).status() != psutil.STATUS_ZOMBIE:
+        time.sleep(0.01)
+
+    reap_orphans(os.getsid(0) + 1)  # some other command's session
+    reap_orphans(proc.pid)
+
+    assert proc.wait() == 0
+
+
+def test_signals_are_handled_outside_the_signal_handler(monkeypatch):
+
+    handled = []
+    monkeypatch.setattr(
+        supervisor,
+        "pass_on_signal",
+        lambda signum: handled.append((signum, threading.current_thread().name)),
+    )
+    proc = subprocess.Popen(["sleep", "60"], start_new_session=True)
+    supervisor.register(proc)
+    try:
+        with forward_signals():
+            os.kill(os.getpid(), signal.SIGUSR1)
+            for _ in range(100):
+                if handled:
+                    break
+                time.sleep(0.01)
+    finally:
+        supervisor.unregister(proc)
+        proc.kill()
+        proc.wait()
+
+    assert handled == [(signal.SIGUSR1, "signals")]
+
+
+def test_processes_are_found_by_session_not_pid():
+
+    proc = subprocess.Popen(["sleep", "60"])  # in this process's session
+    try:
+        assert find_tree(proc.pid) == []
+    finally:
+        proc.kill()
+        proc.wait()
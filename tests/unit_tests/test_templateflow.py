@@ -0,0 +1,139 @@
+import logging
+import os
+from pathlib import Path
+
+import pytest
+
+from utils.templateflow import (
+    CACHE_DIR,
+    evict_templateflow_cache,
+    get_required_templates,
+    get_shared_templateflow,
+    stage_templateflow,
+)
+
+
+@pytest.fixture
+def orig_templateflow(tmp_path):
+    orig = tmp_path / "orig"
+    for tpl in ["tpl-MNI152NLin2009cAsym", "tpl-OASIS30ANTs", "tpl-NKI", "tpl-fsLR"]:
+        (orig / tpl / "sub").mkdir(parents=True)
+        (orig / tpl / f"{tpl}_T1w.nii.gz").write_bytes(b"x" * 100)
+        (orig / tpl / "sub" / "nested.json").write_text("{}")
+    yield orig
+
+
+def test_get_required_templates_defaults():
+
+    required = get_required_templates(
+        {"output-spaces": "MNI152NLin2009cAsym", "skull-strip-template": "OASIS30ANTs"}
+    )
+
+    assert required == ["tpl-MNI152NLin2009cAsym", "tpl-OASIS30ANTs"]
+
+
+def test_get_required_templates_spaces_and_cifti():
+
+    required = get_required_templates(
+        {
+            "output-spaces": "MNI152NLin6Asym:res-2 anat fsnative fsaverage5 /a/tpl",
+            "skull-strip-template": "NKI",
+            "cifti-output": True,
+        }
+    )
+
+    assert required == [
+        "tpl-MNI152NLin2009cAsym",
+        "tpl-MNI152NLin6Asym",
+        "tpl-NKI",
+        "tpl-fsLR",
+        "tpl-fsaverage",
+    ]
+
+
+def test_stage_templateflow_links_required_symlinks_rest(
+    tmp_path, orig_templateflow, caplog, search_caplog
+):
+
+    caplog.set_level(logging.DEBUG)
+
+    templateflow_dir = tmp_path / "templateflow"
+    required = ["tpl-MNI152NLin2009cAsym", "tpl-OASIS30ANTs"]
+
+    stats = stage_templateflow(orig_templateflow, templateflow_dir, required)
+
+    materialized = templateflow_dir / "tpl-OASIS30ANTs"
+    assert materialized.is_dir() and not materialized.is_symlink()
+    assert (materialized / "sub/nested.json").read_text() == "{}"
+    assert (templateflow_dir / "tpl-NKI").is_symlink()
+    assert (templateflow_dir / "tpl-NKI/tpl-NKI_T1w.nii.gz").exists()
+    # same file system so everything should have been hard linked
+    assert os.stat(materialized / "tpl-OASIS30ANTs_T1w.nii.gz").st_nlink == 2
+    assert stats["templates materialized"] == 2
+    assert stats["templates symlinked"] == 2
+    assert stats["files copied"] == 0
+    assert stats["bytes not copied"] == 4 * 102
+    assert search_caplog(caplog, "Staged TemplateFlow")
+
+
+def test_get_shared_templateflow_builds_then_reuses(
+    tmp_path, orig_templateflow, caplog, search_caplog
+):
+
+    caplog.set_level(logging.DEBUG)
+
+    writable_dir = tmp_path / "writable"
+    required = ["tpl-OASIS30ANTs"]
+
+    stats1 = get_shared_templateflow(
+        orig_templateflow, writable_dir, tmp_path / "job1", required, 1
+    )
+    stats2 = get_shared_templateflow(
+        orig_templateflow, writable_dir, tmp_path / "job2", required, 1
+    )
+
+    entries = [p for p in (writable_dir / CACHE_DIR).iterdir() if p.is_dir()]
+    assert len(entries) == 1
+    assert not stats1["cache warm"]
+    assert stats2["cache warm"]
+    assert stats2["files linked"] == 2
+    # not required so symlinked to the container's original, not to the cache
+    assert os.readlink(tmp_path / "job2/tpl-NKI") == str(orig_templateflow / "tpl-NKI")
+    assert search_caplog(caplog, "Building shared TemplateFlow cache")
+
+
+def test_get_shared_templateflow_rebuilds_corrupt_cache(tmp_path, orig_templateflow):
+
+    writable_dir = tmp_path / "writable"
+    required = ["tpl-OASIS30ANTs"]
+
+    get_shared_templateflow(
+        orig_templateflow, writable_dir, tmp_path / "j1", required, 1
+    )
+    entry = next(p for p in (writable_dir / CACHE_DIR).iterdir() if p.is_dir())
+    (entry / "templates/tpl-NKI/tpl-NKI_T1w.nii.gz").write_bytes(b"short")
+
+    stats = get_shared_templateflow(
+        orig_templateflow, writable_dir, tmp_path / "j2", required, 1
+    )
+
+    assert not stats["cache warm"]
+    assert (entry / "templates/tpl-NKI/tpl-NKI_T1w.nii.gz").stat().st_size == 100
+
+
+def test_evict_templateflow_cache_removes_least_recently_used(
+    tmp_path, orig_templateflow
+):
+
+    cache_root = tmp_path / "writable" / CACHE_DIR
+    for version, last_used in [("old", 1000), ("new", 2000)]:
+        entry = cache_root / version
+        (entry / "templates").mkdir(parents=True)
+        (entry / "manifest.json").write_text('{"files": {}, "bytes": 600}')
+        (entry / ".last-used").touch()
+        os.utime(entry / ".last-used", (last_used, last_used))
+
+    evict_templateflow_cache(cache_root, 1000)
+
+    assert not (cache_root / "old").exists()
+    assert (cache_root / "new").exists()
@@ -0,0 +1,141 @@
+import logging
+import os
+import stat
+import warnings
+from pathlib import Path
+from zipfile import ZipFile, ZipInfo
+
+import pytest
+
+from utils.unzip_selected import (
+    ZipHandles,
+    bids_label,
+    extract_member,
+    is_wanted,
+    unzip_selected,
+)
+
+
+@pytest.fixture
+def previous_results_zip(tmp_path):
+    zip_path = tmp_path / "previous.zip"
+    with ZipFile(zip_path, "w") as zip_file:
+        zip_file.writestr("5f00/fmriprep/dataset_description.json", "{}")
+        zip_file.writestr("5f00/fmriprep/sub-01.html", "<html/>")
+        zip_file.writestr("5f00/fmriprep/sub-01/ses-1/anat/sub-01_ses-1_T1w.nii", "1")
+        zip_file.writestr("5f00/fmriprep/sub-01/ses-2/anat/sub-01_ses-2_T1w.nii", "2")
+        zip_file.writestr("5f00/fmriprep/sub-02.html", "<html/>")
+        zip_file.writestr("5f00/fmriprep/sub-02/anat/sub-02_T1w.nii", "3")
+        zip_file.writestr("5f00/freesurfer/sub-01/mri/orig.mgz", "4")
+        zip_file.writestr("5f00/freesurfer/sub-02/mri/orig.mgz", "5")
+    yield zip_path
+
+
+def test_bids_label_removes_prefix_and_punctuation():
+
+    assert bids_label("sub-TOME 3024") == "TOME3024"
+    assert bids_label("ses_1") == "ses1"
+
+
+def test_is_wanted_keeps_subject_independent_files():
+
+    assert is_wanted(["fmriprep", "logs", "CITATION.md"], {"01"}, set())
+    assert not is_wanted(["fmriprep", "sub-02.html"], {"01"}, set())
+    assert not is_wanted(["fmriprep", "sub-01", "ses-2"], {"01"}, {"1"})
+
+
+def test_unzip_selected_only_extracts_subject(
+    tmp_path, previous_results_zip, caplog, search_caplog
+):
+
+    caplog.set_level(logging.DEBUG)
+
+    dest = tmp_path / "output"
+    dest.mkdir()
+
+    stats = unzip_selected(previous_results_zip, dest, ["01"], ["1"], n_threads=2)
+
+    assert (dest / "fmriprep/dataset_description.json").exists()
+    assert (dest / "fmriprep/sub-01.html").exists()
+    assert (dest / "fmriprep/sub-01/ses-1/anat/sub-01_ses-1_T1w.nii").exists()
+    assert not (dest / "fmriprep/sub-01/ses-2").exists()
+    assert not (dest / "fmriprep/sub-02.html").exists()
+    assert (dest / "freesurfer/sub-01/mri/orig.mgz").exists()
+    assert not (dest / "freesurfer/sub-02").exists()
+    assert stats["extracted"] == 4
+    assert stats["skipped other subjects"] == 4
+    assert search_caplog(caplog, "Found fmriprep")
+
+
+def test_unzip_selected_skips_existing_and_symlinks(tmp_path, previous_results_zip):
+
+    dest = tmp_path / "output"
+    (dest / "fmriprep").mkdir(parents=True)
+    (dest / "fmriprep/sub-01.html").write_text("mine")
+    (tmp_path / "elsewhere").mkdir()
+    (dest / "freesurfer").symlink_to(tmp_path / "elsewhere")
+
+    stats = unzip_selected(previous_results_zip, dest)
+
+    assert (dest / "fmriprep/sub-01.html").read_text() == "mine"
+    assert (dest / "fmriprep/sub-02/anat/sub-02_T1w.nii").read_text() == "3"
+    assert list((tmp_path / "elsewhere").iterdir()) == []
+    assert stats["skipped existing"] == 3
+
+
+def test_unzip_selected_no_match_extracts_everything(
+    tmp_path, previous_results_zip, caplog, search_caplog
+):
+
+    dest = tmp_path / "output"
+    dest.mkdir()
+
+    stats = unzip_selected(previous_results_zip, dest, ["sub-42"])
+
+    assert stats["extracted"] == 8
+    assert search_caplog(caplog, "extracting everything")
+
+
+def add_symlink(zip_file, name, target):
+    info = ZipInfo(name)
+    info.external_attr = (stat.S_IFLNK | 0o777) << 16
+    zip_file.writestr(info, target)
+
+
+def test_unzip_selected_duplicate_symlinks_do_not_fail(tmp_path):
+
+    zip_path = tmp_path / "links.zip"
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # "Duplicate name"
+        with ZipFile(zip_path, "w") as zip_file:
+            zip_file.writestr("5f00/fmriprep/sub-01/anat/T1w.nii", "1")
+            add_symlink(zip_file, "5f00/fmriprep/sub-01/anat/link.nii", "T1w.nii")
+            add_symlink(zip_file, "5f00/fmriprep/sub-01/anat/link.nii", "T1w.nii")
+    dest = tmp_path / "output"
+    dest.mkdir()
+
+    stats = unzip_selected(zip_path, dest, n_threads=2)
+
+    link = dest / "fmriprep/sub-01/anat/link.nii"
+    assert link.is_symlink()
+    assert link.read_text() == "1"
+    assert stats["extracted"] == 2
+    assert stats["skipped existing"] == 1
+
+
+def test_extract_member_replaces_existing_symlink_and_closes_archive(tmp_path):
+
+    zip_path = tmp_path / "links.zip"
+    with ZipFile(zip_path, "w") as zip_file:
+        add_symlink(zip_file, "link", "new")
+    link = tmp_path / "link"
+    link.symlink_to("old")
+
+    with ZipHandles(zip_path) as handles:
+        with ZipFile(zip_path) as zip_file:
+            extract_member(handles, zip_file.getinfo("link"), link)
+        zip_file = handles.get()
+
+    assert os.readlink(link) == "new"
+    assert zip_file.fp is None  # closed
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["link", "links.zip"]
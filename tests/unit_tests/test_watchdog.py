@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+
+import psutil
+import pytest
+
+import utils.watchdog as watchdog_module
+from utils.command import CommandFailed, run_command
+from utils.retry import plan_retry
+from utils.supervisor import terminate_tree
+from utils.watchdog import RunWatchdog, parse_duration, scan_shallow
+
+
+def test_progress_from_output_and_crash_files(tmp_path):
+
+    watchdog = RunWatchdog([tmp_path], stall_seconds=3600, max_crashes=2)
+    (tmp_path / "crash-old.txt").touch()  # from an earlier try, ignored
+    watchdog.start()
+    watchdog.stop()  # check() is called directly below
+
+    watchdog.observe('[Node] Finished "fmriprep_wf.bold_wf", elapsed time 1.2s.')
+    watchdog.observe("[MultiProc] Running 4 tasks")
+    assert watchdog.finished == 1
+
+    (tmp_path / "sub-01/log/20220101").mkdir(parents=True)
+    (tmp_path / "sub-01/log/20220101/crash-a.txt").write_text("Traceback")
+    assert watchdog.check() is None
+    assert watchdog.crash_files == ["crash-a.txt"]
+
+    (tmp_path / "sub-01/log/20220101/crash-b.pklz").write_text("Traceback")
+    assert watchdog.check() == "2 crash files: crash-b.pklz"
+    assert watchdog.summary()["crash files"] == ["crash-a.txt", "crash-b.pklz"]
+
+
+def test_work_dir_growth_and_crashes_count(tmp_path):
+
+    output_dir, work_dir = tmp_path / "output", tmp_path / "work"
+    output_dir.mkdir()
+    node = work_dir / "fmriprep_wf/single_subject_01_wf/anat_preproc_wf/autorecon1"
+    node.mkdir(parents=True)
+    watchdog = RunWatchdog(
+        [output_dir], stall_seconds=3600, max_crashes=1, shallow_dirs=[work_dir]
+    )
+    watchdog.start()
+    watchdog.stop()
+    watchdog._last_progress -= 600
+
+    (node / "T1.mgz").write_bytes(b"recon-all" * 100)
+    assert watchdog.check() is None
+    assert watchdog.summary()["longest minutes without progress"] >= 10
+
+    (work_dir / "crash-recon.pklz").write_text("Traceback")
+    assert watchdog.check() == "1 crash files: crash-recon.pklz"
+
+
+def test_only_the_first_levels_of_the_work_dir_are_looked_at(tmp_path, monkeypatch):
+
+    node = tmp_path / "fmriprep_wf/single_subject_01_wf/anat_preproc_wf/n4"
+    (node / "mapflow/_n40").mkdir(parents=True)
+    (node / "mapflow/_n40/out.nii.gz").write_bytes(b"0")
+    (node / "crash-deep.txt").write_text("too deep to be looked for")
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(
+        watchdog_module.os, "scandir", lambda path: listed.append(path) or scandir(path)
+    )
+
+    latest, crash_files = scan_shallow(tmp_path)
+
+    assert str(node) not in listed
+    assert crash_files == []
+    levels = [node, *node.parents[: len(node.relative_to(tmp_path).parts)]]
+    assert latest == max(os.stat(path).st_mtime_ns for path in levels)
+
+
+def test_watchdog_stops_a_stalled_command(tmp_path):
+
+    watchdog = RunWatchdog([tmp_path], stall_seconds=0.5, interval=0.2)
+    watchdog.start()
+    script = "import subprocess, sys; subprocess.run(['sleep', '60'])"
+
+    start = time.monotonic()
+    with pytest.raises(CommandFailed) as exc_info:
+        run_command([sys.executable, "-c", script], watchdog=watchdog)
+    watchdog.stop()
+
+    assert time.monotonic() - start < 30
+    assert exc_info.value.returncode == 128 + 15
+    assert watchdog.reason == "no progress for 0 minutes"
+    assert plan_retry("watchdog", {}, 0)[1] is False
+
+
+def test_terminate_tree_kills_children():
+
+    script = "import subprocess; subprocess.run(['sleep', '60'])"
+    proc = psutil.Popen([sys.executable, "-c", script], start_new_session=True)
+    while not proc.children():
+        time.sleep(0.05)
+    child = proc.children()[0]
+
+    terminate_tree(proc.pid, grace=5)
+
+    for gone in [proc, child]:
+        assert not gone.is_running() or gone.status() == psutil.STATUS_ZOMBIE
+
+
+def test_parse_duration():
+
+    assert parse_duration("90") == 90
+    assert parse_duration("45m") == 45 * 60
+    assert parse_duration("1.5h") == 5400
+    assert parse_duration("2d") == 2 * 86400
+    assert parse_duration("soon") is None
+
+
+def test_deadline_stops_the_command(tmp_path):
+
+    watchdog = RunWatchdog([tmp_path], interval=0.2, deadline_seconds=0.5)
+    watchdog.start()
+
+    with pytest.raises(CommandFailed):
+        run_command(["sleep", "60"], watchdog=watchdog)
+    watchdog.stop()
+
+    assert watchdog.cause == "deadline"
+    decision, retry = plan_retry("deadline", {}, 0)
+    assert not retry
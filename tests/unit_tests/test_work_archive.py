@@ -0,0 +1,147 @@
+import json
+import os
+import subprocess
+from zipfile import ZipFile
+
+import pytest
+
+from utils.results.work_archive import (
+    MTIMES_FILE,
+    QUICK_BYTES,
+    archive_work_dir,
+    file_digest,
+    plan_work_archive,
+)
+
+REPORT = os.urandom(10000)
+
+
+@pytest.fixture
+def work_dir(tmp_path):
+    work = tmp_path / "work"
+    node = work / "fmriprep_wf/single_subject_01_wf/anat_preproc_wf"
+    (node / "brain_extraction").mkdir(parents=True)
+    (node / "report_copy").mkdir()
+    (work / "__pycache__").mkdir()
+    (node / "brain_extraction/report.svg").write_bytes(REPORT)
+    (node / "report_copy/report.svg").write_bytes(REPORT)  # identical copy
+    os.link(node / "brain_extraction/report.svg", node / "hardlinked.svg")
+    (node / "brain_extraction/mask.nii.gz").write_bytes(os.urandom(20000))
+    (node / "brain_extraction/result_brain_extraction.pklz").write_bytes(b"p" * 100)
+    os.symlink("brain_extraction/mask.nii.gz", node / "mask_link.nii.gz")
+    (work / "__pycache__/mod.cpython-38.pyc").write_bytes(b"c" * 100)
+    (work / "output.txt").write_bytes(os.urandom(30000))
+    yield tmp_path
+
+
+def test_archive_work_dir_links_duplicates(work_dir):
+
+    dest_zip = str(work_dir / "out/work.zip")
+    os.mkdir(work_dir / "out")
+
+    volumes, stats = archive_work_dir(str(work_dir), "work", dest_zip, n_workers=2)
+
+    assert volumes == [dest_zip]
+    assert stats["links"] == 3
+    assert stats["linked bytes"] == 20000
+    assert stats["skipped"] == 0
+    with ZipFile(dest_zip) as zip_file:
+        assert zip_file.testzip() is None
+        names = zip_file.namelist()
+    assert "work/__pycache__/mod.cpython-38.pyc" in names
+
+    subprocess.run(["unzip", "-q", dest_zip, "-d", str(work_dir / "unzipped")])
+    node = work_dir / "unzipped/work/fmriprep_wf/single_subject_01_wf/anat_preproc_wf"
+    original = work_dir / "work" / node.relative_to(work_dir / "unzipped/work")
+    for name in [
+        "report_copy/report.svg",
+        "hardlinked.svg",
+        "mask_link.nii.gz",
+    ]:
+        assert (node / name).read_bytes() == (original / name).read_bytes()
+    assert (node / "report_copy/report.svg").is_symlink()
+
+
+def test_archive_work_dir_volumes_and_policy(work_dir):
+
+    dest_zip = str(work_dir / "work.zip")
+
+    volumes, stats = archive_work_dir(
+        str(work_dir),
+        "work",
+        dest_zip,
+        volume_gb=25000 / 1024**3,
+        policy="no-result-caches",
+    )
+
+    assert volumes == [
+        dest_zip,
+        str(work_dir / "work_vol2.zip"),
+        str(work_dir / "work_vol3.zip"),
+        str(work_dir / "work_vol4.zip"),
+    ]
+    assert stats["skipped"] == 2
+    assert stats["stored again"] == 1  # the report's copies are in two volumes
+    names = []
+    for number, volume in enumerate(volumes):
+        with ZipFile(volume) as zip_file:
+            assert zip_file.testzip() is None
+            mtimes = json.loads(zip_file.read(f"work/{MTIMES_FILE}"))
+            assert set(mtimes) < set(zip_file.namelist())
+            names.extend(
+                name for name in zip_file.namelist() if not name.endswith(MTIMES_FILE)
+            )
+        # each volume unzips on its own
+        unzipped = work_dir / f"unzipped{number}"
+        subprocess.run(["unzip", "-q", volume, "-d", str(unzipped)])
+        for path in unzipped.rglob("*.svg"):
+            assert path.read_bytes() == REPORT
+    assert len(names) == len(set(names))
+    assert not any(name.endswith((".pklz", ".pyc")) for name in names)
+    assert "work/output.txt" in names
+
+
+def test_only_files_with_the_same_ends_are_read(work_dir, monkeypatch):
+
+    node = work_dir / "work/fmriprep_wf/single_subject_01_wf/anat_preproc_wf"
+    same_ends = b"a" * QUICK_BYTES + b"b" * 100 + b"a" * QUICK_BYTES
+    (node / "one.nii").write_bytes(same_ends)
+    (node / "two.nii").write_bytes(same_ends.replace(b"b", b"c"))
+    (node / "three.nii").write_bytes(b"x" + same_ends[1:])
+    read = []
+
+    def recording_digest(path):
+        read.append(os.path.basename(path))
+        return file_digest(path)
+
+    monkeypatch.setattr("utils.results.work_archive.file_digest", recording_digest)
+
+    _, stats = plan_work_archive(str(work_dir), "work", n_workers=2)
+
+    assert sorted(read) == ["one.nii", "two.nii"]
+    assert stats["links"] == 3  # the report copies, not the .nii files
+
+
+def test_resumable_policy_keeps_only_finished_nodes(work_dir):
+
+    work = work_dir / "work"
+    (work / "bids/sub-01/anat").mkdir(parents=True)
+    (work / "bids/sub-01/anat/sub-01_T1w.nii.gz").write_bytes(b"t" * 1000)
+    unfinished = work / "fmriprep_wf/single_subject_01_wf/bold_wf/bold_hmc"
+    (unfinished / "mapflow").mkdir(parents=True)
+    (unfinished / "_node.pklz").write_bytes(b"n" * 10)
+    (unfinished / "mapflow/partial.nii.gz").write_bytes(b"x" * 500)
+    dest_zip = str(work_dir / "work.zip")
+
+    _, stats = archive_work_dir(str(work_dir), "work", dest_zip, policy="resumable")
+
+    with ZipFile(dest_zip) as zip_file:
+        names = zip_file.namelist()
+    assert not any(name.startswith("work/bids") for name in names)
+    assert not any("bold_hmc" in name for name in names)
+    assert (
+        "work/fmriprep_wf/single_subject_01_wf/anat_preproc_wf/brain_extraction/"
+        "result_brain_extraction.pklz"
+    ) in names
+    assert stats["skipped"] == 4  # T1w, _node.pklz, partial.nii.gz and the .pyc
+    assert stats["skipped bytes"] == 1000 + 10 + 500 + 100
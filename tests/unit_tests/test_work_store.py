@@ -0,0 +1,155 @@
+import os
+from pathlib import Path
+from zipfile import ZipFile
+
+import pytest
+
+from utils.results.work_archive import archive_work_dir
+from utils.results.work_store import (
+    LINK_MIN_SIZE,
+    publish_work_dir,
+    read_snapshot,
+    restore_work_dir,
+    result_options,
+    select_steps,
+)
+
+WORK_DIR_ZIP = Path("tests/data/gear_tests/work-dir.zip").resolve()
+
+
+def make_node(node_dir, finished=True, files=None):
+    node_dir.mkdir(parents=True)
+    (node_dir / "_node.pklz").write_bytes(b"n" * 10)
+    (node_dir / "_0x12bbb0777b9fd669f6a49bf8e672243a.json").write_text("[]")
+    if finished:
+        (node_dir / f"result_{node_dir.name}.pklz").write_bytes(b"r" * 10)
+    for name, contents in (files or {}).items():
+        (node_dir / name).write_bytes(contents)
+
+
+@pytest.fixture
+def work_dir(tmp_path):
+    work = tmp_path / "work"
+    subject_wf = work / "fmriprep_wf/single_subject_01_wf"
+    big = os.urandom(LINK_MIN_SIZE)
+    make_node(subject_wf / "anat_preproc_wf/n4", files={"t1w_corrected.nii.gz": big})
+    make_node(subject_wf / "anat_preproc_wf/copy", files={"same.nii.gz": big})
+    for name in ["n4/t1w_corrected.nii.gz", "copy/same.nii.gz"]:  # copied with time
+        os.utime(subject_wf / "anat_preproc_wf" / name, (1600000000, 1600000000))
+    make_node(subject_wf / "bold_wf/bold_hmc", finished=False)
+    make_node(work / "fmriprep_wf/single_subject_02_wf/anat_preproc_wf/n4")
+    (work / "bids/sub-01/anat").mkdir(parents=True)
+    (work / "bids/sub-01/anat/sub-01_T1w.nii.gz").write_bytes(b"t" * 100)
+    run_dir = work / "20211201-234508_15ed4bd5-3829-4753-b85d-7090847bbead"
+    run_dir.mkdir()
+    (run_dir / "config.toml").write_text("[execution]")
+    os.symlink("n4/t1w_corrected.nii.gz", subject_wf / "anat_preproc_wf/link.nii.gz")
+    yield tmp_path
+
+
+def test_publish_stores_each_file_once(work_dir, tmp_path):
+
+    store = tmp_path / "store"
+    options = result_options({"output-spaces": "T1w", "n_cpus": 4, "gear-dry-run": 0})
+
+    snapshot, stats = publish_work_dir(store, str(work_dir), "work", "first", options)
+    _, again = publish_work_dir(store, str(work_dir), "work", "second", options)
+
+    assert options == {"output-spaces": "T1w"}
+    assert snapshot == store / "snapshots/first.json.gz"
+    assert LINK_MIN_SIZE <= stats["new bytes"] < stats["bytes"] - LINK_MIN_SIZE
+    assert again["new files"] == 0
+    paths = [entry["path"] for entry in read_snapshot(snapshot)["entries"]]
+    assert "fmriprep_wf/single_subject_01_wf/anat_preproc_wf/link.nii.gz" in paths
+    assert not any(path.startswith("bids") or "bold_hmc" in path for path in paths)
+
+
+def test_restore_only_finished_steps_of_the_participant(work_dir, tmp_path):
+
+    store = tmp_path / "store"
+    options = {"output-spaces": "T1w"}
+    snapshot, _ = publish_work_dir(store, str(work_dir), "work", "snap", options)
+    new_work = tmp_path / "new_work"
+    new_work.mkdir()
+
+    stats = restore_work_dir(
+        snapshot,
+        new_work,
+        subjects=["sub-01"],
+        options={"output-spaces": "MNI152NLin2009cAsym"},
+    )
+
+    anat = new_work / "fmriprep_wf/single_subject_01_wf/anat_preproc_wf"
+    original = work_dir / "work" / anat.relative_to(new_work)
+    assert (anat / "copy/same.nii.gz").read_bytes() == (
+        original / "n4/t1w_corrected.nii.gz"
+    ).read_bytes()
+    assert (anat / "link.nii.gz").is_symlink()
+    assert stats["steps"] == 2
+    assert stats["hard links"] == 2
+    assert stats["changed options"] == ["output-spaces"]
+    assert not (new_work / "fmriprep_wf/single_subject_02_wf").exists()
+    assert not (new_work / "bids").exists()
+
+
+def test_restore_from_zip(tmp_path):
+
+    with ZipFile(WORK_DIR_ZIP) as outer:
+        outer.extractall(tmp_path)
+    work_zip = next((tmp_path / "input/work-dir").glob("*.zip"))
+
+    stats = restore_work_dir(work_zip, tmp_path / "work", subjects=["TOME3024"])
+
+    assert stats["steps"] == 1
+    restored = sorted(path.name for path in (tmp_path / "work").iterdir())
+    assert restored == ["fmriprep_wf"]  # not the run's config.toml and BIDS database
+
+
+def test_select_steps():
+
+    paths = [
+        "fmriprep_wf/",
+        "fmriprep_wf/sub_01_wf/",
+        "fmriprep_wf/sub_01_wf/bold/_node.pklz",
+        "fmriprep_wf/sub_01_wf/bold/mapflow/_node0/out.nii.gz",
+        "fmriprep_wf/sub_01_wf/t1w/_node.pklz",
+        "fmriprep_wf/sub_01_wf/t1w/result_t1w.pklz",
+        "fmriprep_wf/sub_02_wf/t1w/_node.pklz",
+        "fmriprep_wf/sub_02_wf/t1w/result_t1w.pklz",
+        "bids/sub-01/anat/sub-01_T1w.nii.gz",
+    ]
+
+    wanted, stats = select_steps(paths, subjects=["01"])
+
+    assert sorted(wanted) == [
+        "fmriprep_wf/",
+        "fmriprep_wf/sub_01_wf/",
+        "fmriprep_wf/sub_01_wf/t1w/_node.pklz",
+        "fmriprep_wf/sub_01_wf/t1w/result_t1w.pklz",
+    ]
+    assert stats == {"steps": 1, "unfinished steps": 1, "other participants": 1}
+
+
+def stat_results(tree):
+    return {
+        path.relative_to(tree).as_posix(): (path.stat().st_size, path.stat().st_mtime)
+        for path in tree.rglob("*")
+        if path.is_file()
+    }
+
+
+def test_restored_files_keep_their_size_and_time(work_dir, tmp_path):
+
+    work = work_dir / "work"
+    node = work / "fmriprep_wf/single_subject_01_wf/anat_preproc_wf"
+    os.utime(node / "n4/_node.pklz", ns=(1, 1234567890123456789))
+    snapshot, _ = publish_work_dir(tmp_path / "store", str(work_dir), "work", "s", {})
+    volumes, _ = archive_work_dir(str(work_dir), "work", str(tmp_path / "w.zip"))
+
+    for name, source in [("from_store", snapshot), ("from_zip", volumes[0])]:
+        restore_work_dir(source, tmp_path / name, subjects=["01"])
+        restored = stat_results(tmp_path / name)
+        original = stat_results(work)
+
+        assert restored
+        assert restored == {path: original[path] for path in restored}
@@ -5,6 +5,7 @@ from pathlib import Path
 import pytest
 from flywheel_gear_toolkit.utils.zip_tools import unzip_archive
 
+from utils.results.pattern_index import PatternIndex
 from utils.results.zip_intermediate import zip_intermediate_selected, zip_selected
 
 
@@ -56,3 +57,44 @@ def test_zip_selected_works(create_test_files, caplog, search_caplog):
     assert search_caplog(caplog, "Zipping test/two/hee")
     assert search_caplog(caplog, "Looked for missing_file but")
     assert search_caplog(caplog, "Looked for missing_dir but")
+
+
+def test_pattern_index_matches_like_path_match():
+
+    patterns = ["hey", "two/hee", "test/one", "*.html", "sub-*/anat", "/test", "n?w"]
+    paths = [
+        "test/one/hey",
+        "test/two/hee",
+        "test/three/hee",
+        "test/one",
+        "other/test/one",
+        "test/sub-01/anat",
+        "test/sub-01/func",
+        "test/sub-01/report.html",
+        "test/one/three/now",
+        "test",
+    ]
+    index = PatternIndex(patterns)
+
+    for path in paths:
+        expected = [pattern for pattern in patterns if Path(path).match(pattern)]
+        assert sorted(index.match(Path(path).parts)) == sorted(expected), path
+
+
+def test_zip_selected_list_only(create_test_files, caplog, search_caplog):
+
+    work_dir = create_test_files
+    work_path = work_dir.parents[0]
+    (work_dir / "one/hey").write_text("12345")
+    dest_zip = work_path / "destination_zip.zip"
+
+    stats = zip_selected(
+        work_path, work_dir.name, dest_zip, ["hey"], ["else"], list_only=True
+    )
+
+    assert not dest_zip.exists()
+    assert stats["files"] == 3
+    assert stats["bytes"] == 5
+    assert stats["patterns"]["hey"] == {"files": 2, "bytes": 5}
+    assert stats["patterns"]["else"] == {"files": 1, "bytes": 0}
+    assert search_caplog(caplog, "Would zip 3 files")
@@ -0,0 +1,145 @@
+import logging
+from zipfile import ZipFile
+
+import pytest
+
+import utils.results.zip_htmls as zip_htmls_module
+from utils.results.zip_htmls import (
+    SharedFigures,
+    find_referenced_figures,
+    zip_htmls,
+    zip_it_zip_it_good,
+)
+
+REPORT = """<html><body>
+<img src="./{label}/figures/{label}_carpet.png"/>
+<object type="image/svg+xml" data="{label}/figures/{label}_dseg.svg"></object>
+<embed src="https://example.com/logo.svg">
+<img src="data:image/png;base64,AAAA">
+<img src="../../secret.png">
+</body></html>"""
+
+
+@pytest.fixture
+def fmriprep_output(tmp_path):
+    path = tmp_path / "output/5f00/fmriprep"
+    for label in ["sub-01", "sub-02"]:
+        (path / label / "figures").mkdir(parents=True)
+        (path / label / "figures" / f"{label}_dseg.svg").write_text("<svg/>" * 100)
+        (path / label / "figures" / f"{label}_carpet.png").write_bytes(b"png")
+        (path / label / "figures" / f"{label}_unused.svg").write_text("<svg/>")
+        (path / label / "anat").mkdir()
+        (path / label / "anat" / f"{label}_T1w.nii.gz").write_bytes(b"not a figure")
+        (path / f"{label}.html").write_text(REPORT.format(label=label))
+    yield tmp_path / "output", path
+
+
+def test_zip_htmls_one_archive_per_report(
+    fmriprep_output, caplog, search_caplog, monkeypatch, tmp_path
+):
+
+    caplog.set_level(logging.DEBUG)
+    output_dir, path = fmriprep_output
+    monkeypatch.chdir(tmp_path)
+
+    sizes = zip_htmls(output_dir, "5f00", path)
+
+    for label in ["sub-01", "sub-02"]:
+        with ZipFile(output_dir / f"{label}_5f00.html.zip") as zip_file:
+            assert zip_file.testzip() is None
+            assert zip_file.read("index.html").decode() == REPORT.format(label=label)
+            names = zip_file.namelist()
+        # only the figures this report uses
+        assert sorted(names) == [
+            "index.html",
+            f"{label}/figures/{label}_carpet.png",
+            f"{label}/figures/{label}_dseg.svg",
+        ]
+    assert set(sizes["archives"]) == {"sub-01_5f00.html.zip", "sub-02_5f00.html.zip"}
+    assert sizes["total bytes"] == sum(sizes["archives"].values())
+    # each report leaves out the other subject's 3 figures and its own unused one
+    assert sizes["figure bytes left out"] == 2 * (600 + 3 + 6 + 6)
+    # reports were not renamed and the working directory did not change
+    assert (path / "sub-01.html").exists()
+    assert not (path / "index.html").exists()
+    assert search_caplog(caplog, "including sub-02/figures")
+
+
+def test_zip_htmls_missing_path_logs_error(tmp_path, caplog, search_caplog):
+
+    zip_htmls(tmp_path, "5f00", tmp_path / "nope")
+
+    assert search_caplog(caplog, "Path NOT found")
+
+
+def test_find_referenced_figures_falls_back_to_all_figures(
+    fmriprep_output, caplog, search_caplog
+):
+
+    output_dir, path = fmriprep_output
+    (path / "sub-01.html").write_text("<html>no figures</html>")
+
+    assert find_referenced_figures(path, "sub-01.html") == set()
+    assert find_referenced_figures(path, "sub-02.html") == {
+        "sub-02/figures/sub-02_carpet.png",
+        "sub-02/figures/sub-02_dseg.svg",
+    }
+
+    zip_htmls(output_dir, "5f00", path)
+
+    with ZipFile(output_dir / "sub-01_5f00.html.zip") as zip_file:
+        assert len(zip_file.namelist()) == 7
+    assert search_caplog(caplog, "No figure references found in sub-01.html")
+
+
+def test_only_shared_figures_are_kept_until_written(fmriprep_output, monkeypatch):
+
+    output_dir, path = fmriprep_output
+    (path / "sub-03" / "figures").mkdir(parents=True)
+    (path / "sub-03" / "figures" / "sub-03_dseg.svg").write_text("<svg/>")
+    (path / "sub-03.html").write_text("<html/>")
+    report_figures = {
+        f"{label}.html": [f"{label}/figures/{label}_dseg.svg", "shared.svg"]
+        for label in ["sub-01", "sub-02", "sub-03"]
+    }
+    (path / "shared.svg").write_text("<svg/>" * 10)
+    prepared = []
+
+    def record(prepare, kind):
+        def recorded(full_path, rel_path):
+            prepared.append(kind + rel_path)
+            return prepare(full_path, rel_path)
+
+        return recorded
+
+    monkeypatch.setattr(
+        zip_htmls_module, "prepare_entry", record(zip_htmls_module.prepare_entry, "")
+    )
+    monkeypatch.setattr(
+        zip_htmls_module,
+        "prepare_shared_entry",
+        record(zip_htmls_module.prepare_shared_entry, "shared:"),
+    )
+    shared = SharedFigures(report_figures)
+
+    for label in ["sub-01", "sub-02"]:
+        name = f"{label}.html"
+        zip_it_zip_it_good(output_dir, "5f00", path, name, report_figures[name], shared)
+        assert list(shared.entries) == ["shared.svg"]
+    name = "sub-03.html"
+    zip_it_zip_it_good(output_dir, "5f00", path, name, report_figures[name], shared)
+
+    assert shared.entries == {}
+    assert sorted(prepared) == [
+        "index.html",
+        "index.html",
+        "index.html",
+        "shared:shared.svg",  # once for all three archives
+        "sub-01/figures/sub-01_dseg.svg",
+        "sub-02/figures/sub-02_dseg.svg",
+        "sub-03/figures/sub-03_dseg.svg",
+    ]
+    for label in ["sub-01", "sub-02", "sub-03"]:
+        with ZipFile(output_dir / f"{label}_5f00.html.zip") as zip_file:
+            assert zip_file.testzip() is None
+            assert zip_file.read("shared.svg") == b"<svg/>" * 10
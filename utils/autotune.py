@@ -0,0 +1,221 @@
+"""Pick n_cpus, omp-nthreads, mem and --low-mem from the BIDS data to process.
+
+By default fMRIPrep is told to use every cpu and all of the memory.  With
+omp-nthreads equal to n_cpus, nipype can only run one multi-threaded step at a
+time so small datasets leave most cpus idle, and big (high resolution,
+multi-echo) datasets can need more memory than there is when several runs are
+processed at once.
+
+The NIfTI headers of the BOLD runs give their size, which goes into the same
+memory estimate fMRIPrep uses for its biggest per-run steps.  From that, the
+number of runs that can be processed at the same time in the memory available
+decides n_cpus, and --low-mem is used if even one run won't fit.  The values
+from the config (already limited to what is available) are never exceeded, and
+each one that is changed is logged.  It is only used with gear-autotune.
+"""
+
+import gzip
+import logging
+import re
+import struct
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# Cost model, in the units fMRIPrep uses for its own estimates
+BASE_MB = 6000  # anatomical workflow (brain extraction, normalization)
+RECON_ALL_MB = 3000  # FreeSurfer recon-all runs next to it
+MAX_OMP_NTHREADS = 8  # ANTs and FreeSurfer don't get faster with more threads
+CPUS_PER_RUN = 2  # a BOLD run keeps about this many cpus busy
+HEADROOM = 0.9  # nipype's estimates are low, leave some memory unclaimed
+
+ECHO = re.compile(r"_echo-[0-9]+_")
+
+
+def read_nifti_shape(path):
+    """Read the image dimensions from a NIfTI-1 or NIfTI-2 header.
+
+    Args:
+        path (str): .nii or .nii.gz file
+
+    Returns:
+        shape (tuple of int): e.g. (x, y, z, timepoints) or None if unreadable
+    """
+
+    opener = gzip.open if str(path).endswith(".gz") else open
+    try:
+        with opener(path, "rb") as fp:
+            header = fp.read(540)
+    except (OSError, EOFError):
+        return None
+    if len(header) < 348:
+        return None
+
+    for endian in "<>":
+        (sizeof_hdr,) = struct.unpack(endian + "i", header[:4])
+        if sizeof_hdr == 348:
+            dims = struct.unpack(endian + "8h", header[40:56])
+            break
+        if sizeof_hdr == 540 and len(header) == 540:
+            dims = struct.unpack(endian + "8q", header[16:80])
+            break
+    else:
+        return None
+
+    ndim = dims[0]
+    if not 1 <= ndim <= 7:
+        return None
+    return tuple(max(1, d) for d in dims[1 : ndim + 1])
+
+
+def find_bold_runs(bids_dir):
+    """Find the BOLD runs and their sizes.
+
+    Args:
+        bids_dir (Path): the downloaded BIDS data
+
+    Returns:
+        runs (list of dict): "file", "voxels", "timepoints", "echoes" for each
+            run (the echoes of a multi-echo run count as one run)
+    """
+
+    runs = {}
+    for path in sorted(Path(bids_dir).glob("sub-*/**/func/*_bold.nii*")):
+        shape = read_nifti_shape(path)
+        if shape is None:
+            log.warning("Could not read the NIfTI header of %s", path.name)
+            continue
+        voxels = shape[0] * shape[1] * shape[2] if len(shape) >= 3 else shape[0]
+        timepoints = shape[3] if len(shape) >= 4 else 1
+        key = ECHO.sub("_", path.name)
+        if key in runs:
+            runs[key]["echoes"] += 1
+        else:
+            runs[key] = {
+                "file": path.name,
+                "voxels": voxels,
+                "timepoints": timepoints,
+                "echoes": 1,
+            }
+    return list(runs.values())
+
+
+def run_mem_mb(run):
+    """Memory needed to process one BOLD run, in MB.
+
+    This is fMRIPrep's estimate for its biggest per-run steps ("largemem" in
+    init_func_preproc_wf()), for all echoes.
+    """
+
+    size_gb = run["voxels"] * run["timepoints"] * 4 / 1024**3 * run["echoes"]
+    return size_gb * (max(run["timepoints"] / 100, 1.0) + 4) * 1024
+
+
+def will_run_recon_all(config, fs_subjects_dir=None):
+    """True unless FreeSurfer surface reconstruction is turned off or provided.
+
+    Args:
+        config (dict): run-time options
+        fs_subjects_dir (str): path of the fs-subjects-dir input, if any
+    """
+
+    if config.get("fs-no-reconall") or "--fs-no-reconall" in str(
+        config.get("bids_app_args", "")
+    ):
+        return False
+    return not fs_subjects_dir
+
+
+def autotune(bids_dir, config, fs_subjects_dir=None):
+    """Choose n_cpus, omp-nthreads, mem and low-mem for the data in bids_dir.
+
+    Args:
+        bids_dir (Path): the downloaded BIDS data
+        config (dict): "n_cpus", "omp-nthreads" and "mem" are the most that
+            may be used (from the user or all available); these and "low-mem"
+            are changed
+        fs_subjects_dir (str): path of the fs-subjects-dir input, if any
+
+    Returns:
+        tuning (dict): what was found and chosen, and why
+    """
+
+    max_cpus = config["n_cpus"]
+    max_omp = config["omp-nthreads"]
+    max_mem = config["mem"]
+
+    runs = find_bold_runs(bids_dir)
+    recon_all = will_run_recon_all(config, fs_subjects_dir)
+    per_run_mb = max([run_mem_mb(run) for run in runs], default=0)
+    base_mb = BASE_MB + (RECON_ALL_MB if recon_all else 0)
+    usable_mb = max_mem * HEADROOM
+
+    reasons = []
+    omp_nthreads = min(max_omp, MAX_OMP_NTHREADS, max_cpus)
+    useful_cpus = CPUS_PER_RUN * len(runs) + omp_nthreads
+    n_cpus = min(max_cpus, useful_cpus)
+    reasons.append(
+        f"{len(runs)} BOLD runs keep about {useful_cpus} cpus busy, "
+        f"using {n_cpus} of {max_cpus}"
+    )
+
+    low_mem = bool(config.get("low-mem"))
+    if runs:
+        if usable_mb - base_mb >= per_run_mb:
+            concurrent = int((usable_mb - base_mb) // per_run_mb)
+        else:
+            concurrent = 1
+            low_mem = True
+            reasons.append(
+                f"one run needs {per_run_mb:.0f} MB but only "
+                f"{usable_mb - base_mb:.0f} MB is left so using --low-mem"
+            )
+        if concurrent < len(runs):
+            limited = max(omp_nthreads, CPUS_PER_RUN * concurrent)
+            if limited < n_cpus:
+                n_cpus = limited
+                reasons.append(
+                    f"memory for {concurrent} runs at a time "
+                    f"({per_run_mb:.0f} MB each) so using {n_cpus} cpus"
+                )
+    omp_nthreads = min(omp_nthreads, n_cpus)
+    mem = int(usable_mb)
+
+    for key, value in [
+        ("n_cpus", n_cpus),
+        ("omp-nthreads", omp_nthreads),
+        ("mem", mem),
+    ]:
+        if config[key] != value:
+            log.warning(
+                "autotune: changing %s from %s to %s (gear-autotune is on)",
+                key,
+                config[key],
+                value,
+            )
+            config[key] = value
+    if low_mem and not config.get("low-mem"):
+        log.warning("autotune: adding --low-mem (gear-autotune is on)")
+        config["low-mem"] = True
+
+    tuning = {
+        "bold runs": len(runs),
+        "largest run MB": round(per_run_mb),
+        "echoes": max([run["echoes"] for run in runs], default=0),
+        "recon-all": recon_all,
+        "n_cpus": n_cpus,
+        "omp-nthreads": omp_nthreads,
+        "mem": mem,
+        "low-mem": low_mem,
+        "reasons": reasons,
+    }
+    for reason in reasons:
+        log.info("autotune: %s", reason)
+    log.info(
+        "autotune: n_cpus=%d, omp-nthreads=%d, mem=%d MB%s",
+        n_cpus,
+        omp_nthreads,
+        mem,
+        ", --low-mem" if low_mem else "",
+    )
+    return tuning
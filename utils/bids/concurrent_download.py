@@ -0,0 +1,354 @@
+"""Download many files at the same time over a pool of HTTP connections.
+
+flywheel_bids downloads BIDS data one file after another, each with a new
+request through the SDK, so for a project with thousands of small files the
+time is mostly spent waiting for each request to start.  Here flywheel_bids
+still decides what goes where (the curation, which files are excluded and the
+sidecars it writes), but the session and acquisition files it would download
+are collected by a DeferredDownloads standing in for the Flywheel client and
+are then fetched by a few threads sharing one requests.Session:
+
+    .. code-block:: python
+
+        downloads = DeferredDownloads(fw)
+        download_bids_dir(downloads, container_id, "project", bids_dir)
+        report = downloads.run()
+
+Each file is written to a hidden temporary name next to where it goes and is
+renamed into place only after its size has been checked, so an interrupted
+download never leaves a partial file that looks finished.  Requests that fail
+in ways that can go away (connection problems, 429 and 5xx responses, a wrong
+size) are tried again after a random wait that doubles each time ("full
+jitter"), so threads that failed together don't all try again together.
+
+Project files are still downloaded by flywheel_bids, there are few of them and
+zipped ones are unzipped right after they are downloaded.
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+N_CONNECTIONS = 8
+RETRIES = 4  # tries after the first one
+BACKOFF_SECONDS = 0.5  # most to wait before the first retry
+MAX_BACKOFF_SECONDS = 30
+TIMEOUT = (10, 300)  # seconds to connect, seconds between bytes received
+CHUNK_BYTES = 1024**2
+PARTIAL_SUFFIX = ".part"
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """Files could not be downloaded.
+
+    Args:
+        message (str): what went wrong
+        paths (list of Path): where the files would have gone
+    """
+
+    def __init__(self, message, paths=None):
+        super().__init__(message)
+        self.paths = paths or []
+
+
+class FileDownload:
+    """A file to download.
+
+    Args:
+        url (str): where to get it
+        path (Path): where to put it
+        size (int): expected number of bytes, None if not known
+        mtime (float): modification time to give the file, None to leave it
+    """
+
+    def __init__(self, url, path, size=None, mtime=None):
+        self.url = url
+        self.path = Path(path)
+        self.size = size
+        self.mtime = mtime
+
+
+def make_session(n_connections=N_CONNECTIONS, headers=None):
+    """A requests.Session that keeps enough connections open for every thread.
+
+    Args:
+        n_connections (int): number of threads that will use it
+        headers (dict): sent with every request, e.g. Authorization
+
+    Returns:
+        session (requests.Session)
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=n_connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(headers or {})
+    return session
+
+
+def backoff_seconds(attempt, base=BACKOFF_SECONDS, cap=MAX_BACKOFF_SECONDS):
+    """Random time to wait before trying again, up to twice as long each time.
+
+    Args:
+        attempt (int): 0 before the first retry
+        base (float): most to wait before the first retry
+        cap (float): most to ever wait
+    """
+
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Nearest-rank percentiles.
+
+    Args:
+        values (list of float): measurements
+        points (tuple of int): which percentiles
+
+    Returns:
+        percentiles (dict): "p50" etc.: value, empty if there are no values
+    """
+
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    result = {}
+    for point in points:
+        rank = max(1, -(-point * len(ordered) // 100))  # ceiling
+        result[f"p{point}"] = ordered[rank - 1]
+    return result
+
+
+def fetch_file(session, download, timeout=TIMEOUT):
+    """Download one file to a temporary name and rename it into place.
+
+    Args:
+        session (requests.Session): with the connection pool
+        download (FileDownload): what to get
+        timeout (tuple): seconds to connect, seconds to wait for data
+
+    Returns:
+        n_bytes (int): size of the file
+
+    Raises:
+        requests.RequestException: the request failed
+        DownloadError: the file is not the expected size
+    """
+
+    download.path.parent.mkdir(parents=True, exist_ok=True)
+    partial = download.path.with_name(
+        f".{download.path.name}.{uuid.uuid4().hex[:8]}{PARTIAL_SUFFIX}"
+    )
+    n_bytes = 0
+    try:
+        with session.get(download.url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            expected = response.headers.get("Content-Length")
+            with open(partial, "wb") as fp:
+                for chunk in response.iter_content(CHUNK_BYTES):
+                    fp.write(chunk)
+                    n_bytes += len(chunk)
+        for what, size in [("Content-Length", expected), ("size", download.size)]:
+            if size is not None and int(size) != n_bytes:
+                raise DownloadError(
+                    f"{download.path.name}: got {n_bytes} bytes, its {what} is {size}"
+                )
+        if download.mtime is not None:
+            os.utime(partial, (download.mtime, download.mtime))
+        os.replace(partial, download.path)
+    finally:
+        if partial.exists():
+            partial.unlink()
+    return n_bytes
+
+
+def is_retryable(exc):
+    """Whether trying again might work."""
+
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and exc.response.status_code in RETRY_STATUS
+    return isinstance(exc, (requests.RequestException, DownloadError))
+
+
+def download_files(session, downloads, n_workers=N_CONNECTIONS, retries=RETRIES):
+    """Download files at the same time.
+
+    Args:
+        session (requests.Session): made by make_session() for n_workers
+        downloads (list of FileDownload): what to get
+        n_workers (int): number of files to download at once
+        retries (int): times to try a file again
+
+    Returns:
+        report (dict): "files", "MB", "seconds", "MB/s", "retries" and the
+            percentiles of the seconds each file took ("latency s")
+
+    Raises:
+        DownloadError: some files could not be downloaded, after trying to
+            download all of the others
+    """
+
+    lock = threading.Lock()
+    seconds = []
+    counts = {"bytes": 0, "retries": 0}
+
+    def fetch(download):
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            try:
+                n_bytes = fetch_file(session, download)
+            except Exception as exc:
+                if attempt == retries or not is_retryable(exc):
+                    raise
+                wait = backoff_seconds(attempt)
+                log.warning(
+                    "Downloading %s failed (%s), trying again in %.1f s",
+                    download.path.name,
+                    exc,
+                    wait,
+                )
+                with lock:
+                    counts["retries"] += 1
+                time.sleep(wait)
+                continue
+            with lock:
+                seconds.append(time.perf_counter() - start)
+                counts["bytes"] += n_bytes
+            return n_bytes
+
+    start = time.perf_counter()
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        futures = {executor.submit(fetch, download): download for download in downloads}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as exc:
+                log.error("Could not download %s: %s", futures[future].path, exc)
+                failed.append(futures[future].path)
+    elapsed = time.perf_counter() - start
+
+    mb = counts["bytes"] / 1024**2
+    report = {
+        "files": len(seconds),
+        "MB": round(mb, 1),
+        "seconds": round(elapsed, 2),
+        "MB/s": round(mb / max(elapsed, 1e-6), 1),
+        "retries": counts["retries"],
+        "latency s": {
+            name: round(value, 3) for name, value in percentiles(seconds).items()
+        },
+    }
+    log.info("Downloaded %s", report)
+    if failed:
+        names = ", ".join(sorted(path.name for path in failed))
+        raise DownloadError(f"Could not download {len(failed)} files: {names}", failed)
+    return report
+
+
+class DeferredDownloads:
+    """Stand in for the Flywheel client, collecting files instead of downloading them.
+
+    Everything except downloading session and acquisition files is passed on
+    to the client.  Those are collected, and an empty file is left where each
+    one goes so that flywheel_bids can set its modification time and sees that
+    it exists.  run() downloads them all.
+
+    Args:
+        fw (flywheel.Client): Flywheel client
+    """
+
+    def __init__(self, fw):
+        self._fw = fw
+        self._sizes = {}  # (container id, file name): bytes
+        self._queued = []  # (container type, container id, file name, path)
+
+    def __getattr__(self, name):
+        return getattr(self._fw, name)
+
+    def _remember_sizes(self, container):
+        for file_entry in container.get("files") or []:
+            self._sizes[(container["_id"], file_entry["name"])] = file_entry.get("size")
+        return container
+
+    def get_session(self, session_id, **kwargs):
+        return self._remember_sizes(self._fw.get_session(session_id, **kwargs))
+
+    def get_acquisition(self, acquisition_id, **kwargs):
+        return self._remember_sizes(self._fw.get_acquisition(acquisition_id, **kwargs))
+
+    def _queue(self, container_type, container_id, file_name, dest_file):
+        Path(dest_file).touch()
+        self._queued.append((container_type, container_id, file_name, dest_file))
+
+    def download_file_from_session(self, session_id, file_name, dest_file):
+        self._queue("session", session_id, file_name, dest_file)
+
+    def download_file_from_acquisition(self, acquisition_id, file_name, dest_file):
+        self._queue("acquisition", acquisition_id, file_name, dest_file)
+
+    def file_downloads(self, host):
+        """What to download.
+
+        A file whose empty stand-in has been written to since (flywheel_bids
+        writes sidecars after downloading, so they would have replaced it) is
+        left out.
+
+        Args:
+            host (str): the Flywheel API's URL, e.g. https://x.flywheel.io/api
+
+        Returns:
+            downloads (list of FileDownload)
+        """
+
+        downloads = []
+        for container_type, container_id, file_name, dest_file in self._queued:
+            stat = os.stat(dest_file)
+            if stat.st_size:
+                log.info("Not downloading %s, it has been replaced", dest_file)
+                continue
+            url = (
+                f"{host.rstrip('/')}/{container_type}s/{container_id}/files/"
+                f"{quote(file_name, safe='')}"
+            )
+            size = self._sizes.get((container_id, file_name))
+            downloads.append(FileDownload(url, dest_file, size, stat.st_mtime))
+        return downloads
+
+    def run(self, n_workers=N_CONNECTIONS):
+        """Download the files that were collected.
+
+        Returns:
+            report (dict): see download_files(), None if there was nothing
+        """
+
+        if not self._queued:
+            return None
+        configuration = self._fw.api_client.configuration
+        headers = {
+            "Authorization": configuration.get_api_key_with_prefix("Authorization"),
+            "Accept-Encoding": "identity",  # so Content-Length is the file's size
+        }
+        downloads = self.file_downloads(configuration.host)
+        self._queued = []
+        log.info("Downloading %d files, %d at a time", len(downloads), n_workers)
+        with make_session(n_workers, headers) as session:
+            try:
+                return download_files(session, downloads, n_workers)
+            except DownloadError as exc:
+                for path in exc.paths:  # don't leave empty stand-ins behind
+                    path.unlink()
+                raise
@@ -10,6 +10,7 @@ from flywheel import ApiException
 from flywheel_bids.export_bids import download_bids_dir
 from flywheel_bids.supporting_files.errors import BIDSExportError
 
+from .concurrent_download import DeferredDownloads, DownloadError
 from .tree import tree_bids
 from .validate import validate_bids
 
@@ -80,6 +81,21 @@ def fix_dataset_description(bids_path):
             json.dump(data, outfile)
 
 
+def report_download(gtk_context, report):
+    """Save how quickly the BIDS data was downloaded in the analysis' metadata.
+
+    Args:
+        gtk_context (gear_toolkit.GearToolkitContext): flywheel gear context
+        report (dict): from DeferredDownloads.run(), None if nothing was
+            downloaded
+    """
+
+    if report:
+        gtk_context.metadata.update_container(
+            gtk_context.destination["type"], info={"bids download": report}
+        )
+
+
 def download_bids_for_runlevel(
     gtk_context,
     hierarchy,
@@ -118,6 +134,7 @@ def download_bids_for_runlevel(
             24   - destination does not exist
             25   - download_bids_dir() ApiException
             26   - no BIDS data was downloaded
+            27   - some files could not be downloaded
 
     Note: information on BIDS "folders" (used to limit what is downloaded)
     can be found at https://bids-specification.readthedocs.io/en/stable/99-appendices/04-entity-table.html.
@@ -218,13 +235,24 @@ def download_bids_for_runlevel(
                         if "session" in k and v is not None
                     ]
 
-                    bids_path = gtk_context.download_project_bids(
+                    destination = gtk_context.client.get(gtk_context.destination["id"])
+                    project_id = destination.get("parents", {}).get("project")
+                    if not dry_run:  # for dataset_description.json
+                        bids_dir.mkdir(parents=True)
+                    bids_path = bids_dir
+                    downloads = DeferredDownloads(gtk_context.client)
+                    download_bids_dir(
+                        downloads,
+                        project_id,
+                        "project",
+                        bids_dir,
                         src_data=src_data,
                         folders=folders,
                         dry_run=dry_run,
                         subjects=subjects,
                         sessions=sessions,
                     )
+                    report_download(gtk_context, downloads.run())
 
             elif run_level == "acquisition":
 
@@ -252,8 +280,9 @@ def download_bids_for_runlevel(
                         )
                     else:
                         # only download acquisition data
+                        downloads = DeferredDownloads(gtk_context.client)
                         download_bids_dir(
-                            gtk_context.client,
+                            downloads,
                             gtk_context.destination["id"],
                             "acquisition",
                             bids_dir,
@@ -261,6 +290,7 @@ def download_bids_for_runlevel(
                             folders=folders,
                             dry_run=dry_run,
                         )
+                        report_download(gtk_context, downloads.run())
 
             else:
                 msg = (
@@ -284,6 +314,12 @@ def download_bids_for_runlevel(
             bids_path = None
             err_code = 25  # download_bids_dir() ApiException
 
+        except DownloadError as err:
+            log.critical(err)
+            extra_tree_text += f"ERROR: {err}\n"
+            bids_path = None
+            err_code = 27  # some files could not be downloaded
+
     if bids_path:  # then the string was set so check if the directory exists
 
         if Path(bids_path).exists():
@@ -0,0 +1,131 @@
+"""Run the BIDS App command and keep what is needed to tell why it failed."""
+
+import logging
+import subprocess as sp
+import threading
+from collections import deque
+
+from .log_pump import LogPump
+from .supervisor import clean_up_after, register, unregister, wait_exited
+
+log = logging.getLogger(__name__)
+
+STDERR_LINES = 2000  # only the end of stderr is kept
+
+
+class CommandFailed(RuntimeError):
+    """The command returned a non-zero exit status.
+
+    Args:
+        command (list of str): the command that was run
+        returncode (int): exit status, 128 + N if it was killed by signal N
+        stderr (str): the end of what it wrote to stderr
+    """
+
+    def __init__(self, command, returncode, stderr):
+        super().__init__("The following command has failed: \n{}".format(command))
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+def run_command(
+    command,
+    environ=None,
+    dry_run=False,
+    shell=False,
+    prefix="",
+    log_file=None,
+    watchdog=None,
+):
+    """Run a command, printing its output as it comes.
+
+    This works like flywheel_gear_toolkit's exec_command(cont_output=True) but
+    the exception it raises has the exit status and the end of stderr, and
+    stderr is read while the command runs so it can't fill up the pipe.  The
+    command is started in its own session and when it ends, anything it started
+    that is still running is stopped (see utils.supervisor).
+
+    Args:
+        command (list of str): the command to run
+        environ (dict): environment variables for the command
+        dry_run (bool): if True, don't actually run it
+        shell (bool): run command as a single shell string (allows redirects)
+        prefix (str): put this in front of every line of output, e.g. to tell
+            apart commands that are running at the same time
+        log_file (str): instead of printing it, save the output (stdout and
+            stderr) in gzipped segments of this file with LogPump and only
+            print the end of it if the command fails
+        watchdog (RunWatchdog): sees every line of output and may stop the
+            command if it stops making progress
+
+    Returns:
+        returncode (int): 0
+
+    Raises:
+        CommandFailed: if the exit status is not zero
+    """
+
+    log.info("Executing command: \n %s \n\n", " ".join(command))
+    if dry_run:
+        return 0
+
+    proc = sp.Popen(
+        " ".join(command) if shell else command,
+        stdout=sp.PIPE,
+        stderr=sp.PIPE,
+        universal_newlines=True,
+        env=environ,
+        shell=shell,
+        start_new_session=True,
+    )
+    register(proc)
+
+    stderr = deque(maxlen=STDERR_LINES)
+    pump = LogPump(log_file) if log_file else None
+
+    if watchdog:
+        watchdog.attach(proc)
+
+    def read_stderr():
+        for line in proc.stderr:
+            stderr.append(line)
+            if pump:
+                pump.write(line)
+            if watchdog:
+                watchdog.observe(line)
+
+    reader = threading.Thread(target=read_stderr, daemon=True)
+    reader.start()
+    for line in proc.stdout:
+        if pump:
+            pump.write(line)
+        else:
+            print(prefix + line.rstrip())
+        if watchdog:
+            watchdog.observe(line)
+    wait_exited(proc)
+    unregister(proc)
+    if watchdog:
+        watchdog.detach(proc)
+    clean_up_after(proc.pid)
+    returncode = proc.wait()  # only now its pid may be used again
+    reader.join()
+    if pump:
+        pump.close()
+    if returncode < 0:  # killed by a signal, report it the way a shell does
+        returncode = 128 - returncode
+
+    log.info("Command return code: %s", returncode)
+
+    if returncode != 0:
+        if pump:
+            # stdout and stderr together show what it was doing when it failed
+            stderr = pump.tail()
+            log.error("End of the output saved in %s:\n%s", log_file, stderr)
+        else:
+            stderr = "".join(stderr)
+            log.error(stderr)
+        raise CommandFailed(command, returncode, stderr)
+
+    return returncode
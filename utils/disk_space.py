@@ -0,0 +1,374 @@
+"""Forecast how much disk space a run needs, and keep it from running out.
+
+Jobs used to die late, while zipping, because the work directory, the output
+and the archives of both did not fit on the scratch disk.  Before the BIDS data
+is downloaded, the sizes of the images that will be downloaded (from Flywheel)
+give a rough forecast of the peak disk use:
+
+- the BIDS data
+- the work directory: several times the size of each BOLD run, more for each
+  output space, plus the anatomical processing
+- the output: the BOLD runs resampled into each output space, the anatomical
+  derivatives and the FreeSurfer subject directories
+- the archives: the zipped output (the output is removed only after it is
+  zipped) and the zipped work directory if it is saved
+
+The factors are rough (fMRIPrep's work directory is typically 5-20 times the
+size of the data it processes), the forecast is meant to catch runs that
+can't fit, not to be exact.
+
+While fMRIPrep runs, a SpaceGuard watches the free space where the work
+directory is.  When it gets low, the work directories of participants that
+have finished (fMRIPrep wrote their HTML report since the try started) are
+removed, as nothing will use them again, so the other participants can go on.
+Nothing is removed if the work directory is saved after running.
+"""
+
+import logging
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from .results.work_store import SUBJECT_WF
+from .scheduler import find_finished_participants
+
+log = logging.getLogger(__name__)
+
+GB = 1024**3
+
+# work directory, times the size of the (compressed) images
+WORK_PER_BOLD = 6
+WORK_PER_BOLD_SPACE = 3
+WORK_PER_ANAT = 20
+RECON_ALL_WORK_GB = 1.0  # per subject
+# output, times the size of the (compressed) images
+OUTPUT_PER_BOLD_SPACE = 1.5
+OUTPUT_PER_ANAT = 4
+CIFTI_PER_BOLD = 0.5
+RECON_ALL_OUTPUT_GB = 0.5  # per subject, without fsaverage
+ZIPPED_WORK = 0.8  # a zipped work directory compared to the work directory
+SURFACE_SPACE = 0.2  # fsnative or fsaverage* compared to a volume space
+DEFAULT_SPACES = ["MNI152NLin2009cAsym"]
+HEADROOM = 1.1
+
+NIFTI = re.compile(r"\.nii(\.gz)?$")
+BIDS_SUBJECT = re.compile(r"^sub-([a-zA-Z0-9]+)")
+
+
+def count_output_spaces(config):
+    """Number of volume spaces fMRIPrep will resample into.
+
+    Surface spaces count as SURFACE_SPACE of a volume space.
+    """
+
+    spaces = str(config.get("output-spaces") or "").split() or DEFAULT_SPACES
+    count = 0
+    for space in spaces:
+        name = space.split(":")[0]
+        if name.startswith(("fsnative", "fsaverage")):
+            count += SURFACE_SPACE
+        else:
+            count += 1
+    if config.get("use-aroma"):
+        count += 1  # ICA-AROMA works in MNI152NLin6Asym
+    return count
+
+
+def list_input_images(fw, destination_id, folders):
+    """Find the BIDS images of the container the analysis runs on.
+
+    Args:
+        fw (flywheel.Client): Flywheel client
+        destination_id (str): the analysis
+        folders (list of str): BIDS folders that will be downloaded, empty for all
+
+    Returns:
+        images (list of tuple): (BIDS file name, BIDS folder, size in bytes)
+    """
+
+    parent = fw.get(fw.get(destination_id).parent.id)
+    if parent.container_type == "acquisition":
+        acquisitions = [parent]
+    else:
+        if parent.container_type == "session":
+            sessions = [parent]
+        else:  # project or subject
+            sessions = parent.sessions.iter()
+        acquisitions = (acq for ses in sessions for acq in ses.acquisitions.iter())
+
+    images = []
+    for acquisition in acquisitions:
+        for file_entry in acquisition.files:
+            bids = (file_entry.info or {}).get("BIDS")
+            if not isinstance(bids, dict) or bids.get("ignore"):
+                continue
+            name = bids.get("Filename") or ""
+            folder = bids.get("Folder") or ""
+            if NIFTI.search(name) and (not folders or folder in folders):
+                images.append((name, folder, file_entry.size or 0))
+    return images
+
+
+def forecast_disk_use(images, config, recon_all=True):
+    """Estimate the most disk space a run will use.
+
+    Args:
+        images (list of tuple): (BIDS file name, BIDS folder, size in bytes)
+        config (dict): the gear's configuration
+        recon_all (bool): FreeSurfer's recon-all will be run
+
+    Returns:
+        forecast (dict): GB of "bids", "work", "output" and "archives", and
+            the numbers the estimate is based on
+    """
+
+    bold = sum(size for name, _, size in images if "_bold." in name)
+    anat = sum(size for _, folder, size in images if folder == "anat")
+    subjects = {
+        match.group(1)
+        for match in (BIDS_SUBJECT.match(name) for name, _, _ in images)
+        if match
+    }
+    spaces = count_output_spaces(config)
+    n_recon = len(subjects) if recon_all else 0
+
+    work = (
+        bold * (WORK_PER_BOLD + WORK_PER_BOLD_SPACE * spaces)
+        + anat * WORK_PER_ANAT
+        + n_recon * RECON_ALL_WORK_GB * GB
+    )
+    output = (
+        bold * OUTPUT_PER_BOLD_SPACE * spaces
+        + anat * OUTPUT_PER_ANAT
+        + n_recon * RECON_ALL_OUTPUT_GB * GB
+    )
+    if config.get("cifti-output"):
+        output += bold * CIFTI_PER_BOLD
+    archives = output
+    if config.get("gear-save-intermediate-output"):
+        archives += work * ZIPPED_WORK
+
+    return {
+        "bids GB": round(sum(size for _, _, size in images) / GB, 1),
+        "work GB": round(work / GB, 1),
+        "output GB": round(output / GB, 1),
+        "archives GB": round(archives / GB, 1),
+        "bold runs": sum(1 for name, _, _ in images if "_bold." in name),
+        "subjects": len(subjects),
+        "output spaces": spaces,
+    }
+
+
+def check_free_space(forecast, work_dir, output_dir):
+    """Compare the forecast with the free space where it will be written.
+
+    The BIDS data and the work directory are in work_dir, the output and the
+    archives in output_dir, which may or may not be on the same file system.
+
+    Returns:
+        problems (list of str): one message for each file system without room
+    """
+
+    needed = {}
+    where = {}
+    for path, gb in [
+        (work_dir, forecast["bids GB"] + forecast["work GB"]),
+        (output_dir, forecast["output GB"] + forecast["archives GB"]),
+    ]:
+        path = Path(path).resolve()
+        device = path.stat().st_dev
+        needed[device] = needed.get(device, 0) + gb * HEADROOM
+        where.setdefault(device, path)
+
+    problems = []
+    for device, gb in needed.items():
+        free = shutil.disk_usage(where[device]).free / GB
+        log.info(
+            "Forecast needs %.1f GB in %s, %.1f GB are free", gb, where[device], free
+        )
+        if gb > free:
+            problems.append(
+                f"The run is expected to need {gb:.0f} GB in {where[device]} but "
+                f"only {free:.0f} GB are free"
+            )
+    return problems
+
+
+def work_is_saved(config):
+    """True if the work directory is saved after running, so it must be kept.
+
+    Args:
+        config (dict): the gear's configuration
+    """
+
+    return any(
+        config.get(key)
+        for key in [
+            "gear-save-intermediate-output",
+            "gear-work-store",
+            "gear-intermediate-files",
+            "gear-intermediate-folders",
+        ]
+    )
+
+
+def finished_work_dirs(work_dir, output_dir, since=None):
+    """Work directories of participants fMRIPrep has finished.
+
+    A report from before since (e.g. unzipped from previous-results) does not
+    count: fMRIPrep may be running that participant again.
+
+    Args:
+        work_dir (Path): the gear's work directory
+        output_dir (Path): fMRIPrep's output directory (output/<destination_id>)
+        since (float): time the reports must have been written after, None
+            for any report
+
+    Returns:
+        dirs (list of Path): participants' work directories (from the
+            scheduler) and subject workflows, that exist
+    """
+
+    finished = set()
+    for label in find_finished_participants(output_dir):
+        reports = Path(output_dir).glob(f"*/sub-{label}.html")
+        if since is None or any(path.stat().st_mtime >= since for path in reports):
+            finished.add(label)
+    dirs = []
+    for label in sorted(finished):
+        participant = Path(work_dir) / "participants" / f"sub-{label}" / "work"
+        if participant.is_dir():
+            dirs.append(participant)
+    for workflow in sorted(Path(work_dir).glob("*/*_wf")):
+        match = SUBJECT_WF.match(workflow.name)
+        if match and match.group(1) in finished and workflow.is_dir():
+            dirs.append(workflow)
+    return dirs
+
+
+class SpaceGuard:
+    """Remove what is no longer needed when the work directory's disk gets full.
+
+    Args:
+        work_dir (Path): the gear's work directory
+        output_dir (Path): fMRIPrep's output directory (output/<destination_id>)
+        min_free_gb (float): prune when there is less free space than this
+        interval (float): seconds between looking at the free space
+        prune (bool): False to only watch, e.g. when the work directory is saved
+    """
+
+    def __init__(self, work_dir, output_dir, min_free_gb, interval=60, prune=True):
+        self.work_dir = Path(work_dir)
+        self.output_dir = Path(output_dir)
+        self.min_free_gb = min_free_gb
+        self.interval = interval
+        self.prune = prune
+        self.started = time.time()
+
+        self.lowest_free_gb = None
+        self.pruned = []  # names of directories removed
+        self.pruned_gb = 0
+
+        self._warned = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start watching in the background."""
+
+        if not self.min_free_gb:
+            return
+        self._stop.clear()  # it is started again for each try
+        self.started = time.time()  # only reports written from now on count
+        self._thread = threading.Thread(
+            target=self._run, name="space guard", daemon=True
+        )
+        self._thread.start()
+        if self.prune:
+            log.info(
+                "Will remove finished participants' work directories when less "
+                "than %s GB are free",
+                self.min_free_gb,
+            )
+        else:
+            log.info(
+                "The work directory is saved after running, so nothing will be "
+                "removed from it when less than %s GB are free",
+                self.min_free_gb,
+            )
+
+    def stop(self):
+        """Stop watching."""
+
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:  # never let this kill the gear
+                log.exception("Problem in space guard")
+
+    def free_gb(self):
+        """Free space where the work directory is."""
+
+        return shutil.disk_usage(self.work_dir.resolve()).free / GB
+
+    def check(self):
+        """Prune if there is too little free space.
+
+        Returns:
+            free_gb (float): free space after pruning
+        """
+
+        free = self.free_gb()
+        if self.lowest_free_gb is None or free < self.lowest_free_gb:
+            self.lowest_free_gb = free
+        if free >= self.min_free_gb:
+            return free
+
+        finished = []
+        if self.prune:
+            finished = finished_work_dirs(self.work_dir, self.output_dir, self.started)
+        for path in finished:
+            log.warning(
+                "Only %.1f GB free, removing %s (its participant has finished)",
+                free,
+                path,
+            )
+            shutil.rmtree(path, ignore_errors=True)
+            self.pruned.append(str(path.relative_to(self.work_dir)))
+            now = self.free_gb()
+            self.pruned_gb += max(now - free, 0)
+            free = now
+            if free >= self.min_free_gb:
+                break
+        else:
+            if not self._warned:
+                log.warning(
+                    "Only %.1f GB free and nothing more can be removed, fMRIPrep "
+                    "may run out of space",
+                    free,
+                )
+                self._warned = True
+        return free
+
+    def summary(self):
+        """What the guard saw and did.
+
+        Returns:
+            summary (dict)
+        """
+
+        return {
+            "lowest free GB": (
+                None if self.lowest_free_gb is None else round(self.lowest_free_gb, 1)
+            ),
+            "pruned": self.pruned,
+            "pruned GB": round(self.pruned_gb, 1),
+        }
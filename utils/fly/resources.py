@@ -0,0 +1,205 @@
+"""Find how many cpus and how much memory this job may actually use.
+
+The number of cpus (sched_getaffinity) and available memory (psutil) are what
+the host has, but inside a container or a job on a cluster the job is allowed
+much less: a cgroup (Docker, Kubernetes) limits the cpu time and memory, and
+LSF and Slurm say what was allocated in environment variables.  Using the host
+numbers tells fMRIPrep it has e.g. 256 GB when it may only use 16 GB so it gets
+killed when it goes over.  The tightest of all of these limits is used.
+"""
+
+import logging
+import os
+import re
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+PROC_CGROUP = "/proc/self/cgroup"
+UNLIMITED = 2**60  # cgroup v1 says "no limit" with a huge number
+LSF_RAM = re.compile(r"mem=([0-9.]+)")
+
+
+def read_value(path):
+    """First line of a (cgroup) file, or None if it can't be read."""
+
+    try:
+        with open(path) as fp:
+            return fp.readline().strip()
+    except OSError:
+        return None
+
+
+def cgroup_dirs(root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP):
+    """Directories of the cgroups this process is in, and their parents.
+
+    Limits on a parent cgroup apply to its children so all of them are checked.
+
+    Args:
+        root (str): where the cgroup file systems are mounted
+        proc_cgroup (str): the file that lists this process' cgroups
+
+    Returns:
+        dirs (list of tuple): directory and how many levels it is above this
+            process' cgroup, for cgroup v2 and the v1 cpu and memory controllers
+    """
+
+    paths = []
+    try:
+        with open(proc_cgroup) as fp:
+            for line in fp:
+                _, controllers, path = line.rstrip("\n").split(":", 2)
+                if controllers == "":  # cgroup v2
+                    paths.append((root, path))
+                for controller in controllers.split(","):
+                    if controller in ("cpu", "memory"):
+                        paths.append((os.path.join(root, controller), path))
+    except (OSError, ValueError):
+        pass
+    if not paths:
+        paths = [(root, "/"), (os.path.join(root, "cpu"), "/")]
+        paths.append((os.path.join(root, "memory"), "/"))
+
+    dirs = []
+    for mount, path in paths:
+        # inside a container the cgroup is usually mounted as the root
+        parts = [part for part in path.split("/") if part]
+        if not os.path.isdir(os.path.join(mount, *parts)):
+            parts = []
+        up = 0
+        while True:
+            dirs.append((os.path.join(mount, *parts), up))
+            if not parts:
+                break
+            parts.pop()
+            up += 1
+    return dirs
+
+
+def limit_name(file_name, up):
+    """Name a cgroup limit without dots (they can't be used in metadata keys)."""
+
+    name = "cgroup " + file_name.replace(".", " ")
+    return f"{name} {up} up" if up else name
+
+
+def read_cgroup_limits(root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP):
+    """Cpu and memory limits set by cgroups (v1 and v2).
+
+    Args:
+        root (str): where the cgroup file systems are mounted
+        proc_cgroup (str): the file that lists this process' cgroups
+
+    Returns:
+        cpus (dict): limit name: number of cpus allowed
+        mem_mb (dict): limit name: MB of memory allowed
+    """
+
+    cpus = {}
+    mem_mb = {}
+    for cgroup_dir, up in cgroup_dirs(root, proc_cgroup):
+
+        quota = period = None
+        value = read_value(os.path.join(cgroup_dir, "cpu.max"))  # v2
+        if value:
+            quota, _, period = value.partition(" ")
+        else:  # v1
+            quota = read_value(os.path.join(cgroup_dir, "cpu.cfs_quota_us"))
+            period = read_value(os.path.join(cgroup_dir, "cpu.cfs_period_us"))
+        try:
+            if int(quota) > 0 and int(period) > 0:
+                name = limit_name("cpu.max" if value else "cpu.cfs_quota_us", up)
+                cpus[name] = max(1, int(quota) // int(period))
+        except (TypeError, ValueError):  # "max" or missing
+            pass
+
+        for name in ["memory.max", "memory.high", "memory.limit_in_bytes"]:
+            value = read_value(os.path.join(cgroup_dir, name))
+            try:
+                if 0 < int(value) < UNLIMITED:
+                    mem_mb[limit_name(name, up)] = int(value) // 1024**2
+            except (TypeError, ValueError):  # "max" or missing
+                pass
+
+    return cpus, mem_mb
+
+
+def read_job_limits(environ, config=None):
+    """Cpus and memory allocated by LSF or Slurm.
+
+    Args:
+        environ (dict): environment variables
+        config (dict): run-time options, "lsf-ram" is what was requested from LSF
+
+    Returns:
+        cpus (dict): where it came from: number of cpus allowed
+        mem_mb (dict): where it came from: MB of memory allowed
+    """
+
+    cpus = {}
+    mem_mb = {}
+    config = config or {}
+
+    for name in ["LSB_DJOB_NUMPROC", "SLURM_CPUS_ON_NODE"]:
+        if environ.get(name, "").isdigit() and int(environ[name]) > 0:
+            cpus[name] = int(environ[name])
+
+    if "LSB_JOBID" in environ and config.get("lsf-ram"):
+        match = LSF_RAM.search(str(config["lsf-ram"]))
+        if match:
+            mem_mb["lsf-ram"] = int(float(match.group(1)))
+
+    if environ.get("SLURM_MEM_PER_NODE", "").isdigit():
+        mem_mb["SLURM_MEM_PER_NODE"] = int(environ["SLURM_MEM_PER_NODE"])
+    elif (
+        environ.get("SLURM_MEM_PER_CPU", "").isdigit() and "SLURM_CPUS_ON_NODE" in cpus
+    ):
+        mem_mb["SLURM_MEM_PER_CPU"] = (
+            int(environ["SLURM_MEM_PER_CPU"]) * cpus["SLURM_CPUS_ON_NODE"]
+        )
+
+    # 0 means no limit to Slurm
+    mem_mb = {name: value for name, value in mem_mb.items() if value > 0}
+    return cpus, mem_mb
+
+
+def detect_resources(config=None, environ=None, root=CGROUP_ROOT):
+    """The tightest of all of the limits on cpus and memory.
+
+    Args:
+        config (dict): run-time options (for "lsf-ram")
+        environ (dict): environment variables, default os.environ
+        root (str): where the cgroup file systems are mounted
+
+    Returns:
+        resources (dict): "n_cpus" and "mem_mb" that may be used, which limit
+            each came from and all of the limits found
+    """
+
+    environ = os.environ if environ is None else environ
+
+    try:
+        cpus = {"affinity": len(os.sched_getaffinity(0))}
+    except AttributeError:
+        cpus = {"cpu count": os.cpu_count()}
+    mem_mb = {"available memory": int(psutil.virtual_memory().available / 1024**2)}
+
+    cgroup_cpus, cgroup_mem_mb = read_cgroup_limits(root)
+    job_cpus, job_mem_mb = read_job_limits(environ, config)
+    cpus.update(cgroup_cpus)
+    cpus.update(job_cpus)
+    mem_mb.update(cgroup_mem_mb)
+    mem_mb.update(job_mem_mb)
+
+    cpus_from = min(cpus, key=cpus.get)
+    mem_from = min(mem_mb, key=mem_mb.get)
+    return {
+        "n_cpus": cpus[cpus_from],
+        "n_cpus from": cpus_from,
+        "mem_mb": mem_mb[mem_from],
+        "mem_mb from": mem_from,
+        "cpu limits": cpus,
+        "mem_mb limits": mem_mb,
+    }
@@ -1,12 +1,11 @@
 import logging
-import os
 
-import psutil
+from .resources import detect_resources
 
 log = logging.getLogger(__name__)
 
 
-def set_n_cpus(n_cpus, omp_nthreads):
+def set_n_cpus(n_cpus, omp_nthreads, available=None):
     """Set --n_cpus (number of threads) to pass to BIDS App.
 
     Use the given number unless it is too big.  Use the max available if zero.
@@ -16,41 +15,42 @@ def set_n_cpus(n_cpus, omp_nthreads):
 
     Args:
         n_cpus (int): number of cpus to use from config.json
+        omp_nthreads (int): number of threads for each process from config.json
+        available (int): number of cpus this job may use, default is what
+            detect_resources() finds
 
     Returns:
         n_cpus (int) which will become part of the command line command
     """
 
-    try:
-        os_cpu_count = len(os.sched_getaffinity(0))
-    except AttributeError:
-        os_cpu_count = os.cpu_count()
-    log.info("os.cpu_count() = %d", os_cpu_count)
+    if available is None:
+        available = detect_resources()["n_cpus"]
+    log.info("cpus available = %d", available)
     if n_cpus:
-        if n_cpus > os_cpu_count:
-            log.warning("n_cpus > number available, using max %d", os_cpu_count)
-            n_cpus = os_cpu_count
+        if n_cpus > available:
+            log.warning("n_cpus > number available, using max %d", available)
+            n_cpus = available
         else:
             log.info("n_cpus using %d from config", n_cpus)
     else:  # Default is to use all cpus available
-        n_cpus = os_cpu_count  # zoom zoom
-        log.info("using n_cpus = %d (maximum available)", os_cpu_count)
+        n_cpus = available  # zoom zoom
+        log.info("using n_cpus = %d (maximum available)", available)
 
     # Do the same for omp-nthreads
     if omp_nthreads:
-        if omp_nthreads > os_cpu_count:
-            log.warning("omp-nthreads > number available, using max %d", os_cpu_count)
-            omp_nthreads = os_cpu_count
+        if omp_nthreads > available:
+            log.warning("omp-nthreads > number available, using max %d", available)
+            omp_nthreads = available
         else:
             log.info("omp-nthreads using %d from config", omp_nthreads)
     else:  # Default is to use all cpus available
-        omp_nthreads = os_cpu_count  # zoom zoom
-        log.info("using omp-nthreads = %d (maximum available)", os_cpu_count)
+        omp_nthreads = available  # zoom zoom
+        log.info("using omp-nthreads = %d (maximum available)", available)
 
     return n_cpus, omp_nthreads
 
 
-def set_mem_mb(mem_mb):
+def set_mem_mb(mem_mb, available=None):
     """Set --mem (maximum memory to use in MB) to pass to BIDS App.
 
     Use the given number unless it is too big.  Use the max available if zero.
@@ -60,21 +60,24 @@ def set_mem_mb(mem_mb):
 
     Args:
         mem_mb (float) number of MB to use
+        available (int) MB of memory this job may use, default is what
+            detect_resources() finds
 
     Returns:
         mem_mb (float) which will become part of the command line command
     """
 
-    psutil_mem_mb = int(psutil.virtual_memory().available / (1024**2))
-    log.info("psutil.virtual_memory().available= {:5.2f} MiB".format(psutil_mem_mb))
+    if available is None:
+        available = detect_resources()["mem_mb"]
+    log.info("memory available = {:5.2f} MiB".format(available))
     if mem_mb:
-        if mem_mb > psutil_mem_mb:
-            log.warning("mem > number available, using max %d", psutil_mem_mb)
-            mem_mb = psutil_mem_mb
+        if mem_mb > available:
+            log.warning("mem > number available, using max %d", available)
+            mem_mb = available
         else:
             log.info("mem using %d from config", mem_mb)
     else:  # Default is to use all memory available
-        mem_mb = psutil_mem_mb
-        log.info("using mem = %d (maximum available)", psutil_mem_mb)
+        mem_mb = available
+        log.info("using mem = %d (maximum available)", available)
 
     return mem_mb
@@ -0,0 +1,153 @@
+"""Save a command's output in gzipped log files without holding it in memory.
+
+fMRIPrep's output can be gigabytes (e.g. with -vvv), most of it nipype saying
+the same thing over and over while it waits for jobs to finish.  Each line is
+written as it comes into a gzipped file that is started again as a new
+"segment" when it gets big, so no one file is huge and nothing is kept in
+memory but the last lines.  Lines that only differ in their numbers (times,
+free memory, counts) from the line before them are collapsed into the first
+and last of them and a count.  The last lines are kept so they can be shown in
+the job log if the command fails.
+
+Example:
+    .. code-block:: python
+
+        with LogPump("output/log1.txt") as pump:
+            for line in proc.stdout:
+                pump.write(line)
+        print(pump.tail())
+"""
+
+import gzip
+import logging
+import threading
+from collections import deque
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+SEGMENT_BYTES = 256 * 1024**2  # start a new file after this much (uncompressed)
+TAIL_LINES = 200  # lines to keep to show when something goes wrong
+BUFFER_BYTES = 65536  # compress this much at a time, it is much faster than by line
+COMPRESS_LEVEL = 6
+DIGITS = b"0123456789"
+
+
+def segment_name(file_name, number):
+    """Name of a log segment, e.g. log1.txt -> log1.txt.gz, log1.001.txt.gz"""
+
+    path = Path(file_name)
+    if number == 0:
+        return path.with_name(path.name + ".gz")
+    return path.with_name(f"{path.stem}.{number:03d}{path.suffix}.gz")
+
+
+class LogPump:
+    """Write lines of output to gzipped segments, keeping only the last lines.
+
+    write() can be called from several threads (e.g. reading stdout and stderr).
+
+    Args:
+        file_name (str): e.g. "output/log1.txt", segments are saved as
+            "output/log1.txt.gz", "output/log1.001.txt.gz", ...
+        segment_bytes (int): start a new segment after this many bytes
+        tail_lines (int): number of lines to keep for tail()
+    """
+
+    def __init__(self, file_name, segment_bytes=SEGMENT_BYTES, tail_lines=TAIL_LINES):
+        self.file_name = file_name
+        self.segment_bytes = segment_bytes
+        self.segments = []
+        self.lines = 0  # lines written, not counting collapsed ones
+        self.collapsed = 0  # lines left out because they repeat the one before
+
+        self._tail = deque(maxlen=tail_lines)
+        self._lock = threading.Lock()
+        self._fp = None
+        self._bytes = 0
+        self._buffer = []
+        self._buffered = 0
+        self._last_key = None
+        self._held = None  # latest line like the one before, not written yet
+        self._held_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, line):
+        """Save one line of output."""
+
+        if not line.endswith("\n"):
+            line += "\n"
+        data = line.encode(errors="replace")
+        key = data.translate(None, DIGITS)  # much faster than re.sub()
+        with self._lock:
+            if key == self._last_key:
+                self._held = data
+                self._held_count += 1
+                return
+            self._flush_held()
+            self._last_key = key
+            self._write(data)
+
+    def _flush_held(self):
+        # write the last of the similar lines, and how many were left out
+        if self._held_count > 1:
+            self._write(f"[... {self._held_count - 1} similar lines ...]\n".encode())
+            self.collapsed += self._held_count - 1
+        if self._held:
+            self._write(self._held)
+        self._held = None
+        self._held_count = 0
+
+    def _write(self, data):
+        if self._fp is None or self._bytes >= self.segment_bytes:
+            self._next_segment()
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= BUFFER_BYTES:
+            self._flush_buffer()
+        self._bytes += len(data)
+        self.lines += 1
+        self._tail.append(data)
+
+    def _flush_buffer(self):
+        self._fp.write(b"".join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+
+    def _next_segment(self):
+        if self._fp:
+            self._flush_buffer()
+            self._fp.close()
+        name = segment_name(self.file_name, len(self.segments))
+        self._fp = gzip.open(name, "wb", compresslevel=COMPRESS_LEVEL)
+        self._bytes = 0
+        self.segments.append(name)
+
+    def tail(self):
+        """The last lines that were written."""
+
+        with self._lock:
+            lines = list(self._tail) + ([self._held] if self._held else [])
+        return b"".join(lines).decode(errors="replace")
+
+    def close(self):
+        """Write what is left and close the file."""
+
+        with self._lock:
+            self._flush_held()
+            if self._fp:
+                self._flush_buffer()
+                self._fp.close()
+                self._fp = None
+        if self.segments:
+            log.info(
+                "Saved %d lines of output in %s (%d similar lines collapsed)",
+                self.lines,
+                ", ".join(str(name) for name in self.segments),
+                self.collapsed,
+            )
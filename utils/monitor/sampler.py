@@ -0,0 +1,274 @@
+"""Sample the resources used by every process the gear starts.
+
+A background thread walks the tree of processes below the gear every few
+seconds and, for each command name (e.g. "antsRegistration", "recon-all",
+"mcflirt"), adds up cpu %, resident (RSS) and proportional (PSS) memory, bytes
+read and written and the number of threads.  Each sample is a row per command
+plus a "*" row for the whole tree in a gzipped, tab separated file, so it shows
+when memory peaked, which command caused it and how often all of the cpus were
+busy.
+
+This replaces running the BIDS App under "/usr/bin/time -v".  The same
+"resources used" summary is made from getrusage() of the gear's children.
+
+Example:
+    .. code-block:: python
+
+        sampler = ProcessTreeSampler(output_dir / "resources.tsv.gz", 10, n_cpus)
+        sampler.start()
+        # run the BIDS App...
+        sampler.stop()
+        metadata = {"resources used": sampler.resources_used(command, exit_status)}
+"""
+
+import gzip
+import logging
+import os
+import resource
+import threading
+import time
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+COLUMNS = [
+    "seconds",
+    "command",
+    "processes",
+    "threads",
+    "cpu_percent",
+    "rss_bytes",
+    "pss_bytes",
+    "read_bytes",
+    "write_bytes",
+]
+ALL = "*"  # command name of the row for the whole process tree
+SATURATED = 0.95  # all cpus are busy if the tree uses this much of them
+
+# What "/usr/bin/time -v" reports, in its order and with its names.
+RUSAGE_KEYS = [
+    ("Average shared text size (kbytes)", None),
+    ("Average unshared data size (kbytes)", None),
+    ("Average stack size (kbytes)", None),
+    ("Average total size (kbytes)", None),
+    ("Maximum resident set size (kbytes)", "ru_maxrss"),
+    ("Average resident set size (kbytes)", None),
+    ("Major (requiring I/O) page faults", "ru_majflt"),
+    ("Minor (reclaiming a frame) page faults", "ru_minflt"),
+    ("Voluntary context switches", "ru_nvcsw"),
+    ("Involuntary context switches", "ru_nivcsw"),
+    ("Swaps", "ru_nswap"),
+    ("File system inputs", "ru_inblock"),
+    ("File system outputs", "ru_oublock"),
+    ("Socket messages sent", "ru_msgsnd"),
+    ("Socket messages received", "ru_msgrcv"),
+    ("Signals delivered", "ru_nsignals"),
+]
+
+
+def format_elapsed(seconds):
+    """Format wall clock time like "/usr/bin/time": h:mm:ss or m:ss.ss"""
+
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{int(hours)}:{int(minutes):02d}:{int(seconds):02d}"
+    return f"{int(minutes)}:{seconds:05.2f}"
+
+
+class ProcessTreeSampler:
+    """Sample the resources used by the children of this process.
+
+    Args:
+        file_name (Path): where to save the samples, a .tsv.gz file
+        interval (float): seconds between samples, 0 to not sample
+        n_cpus (int): number of cpus the gear may use
+    """
+
+    def __init__(self, file_name, interval, n_cpus):
+        self.file_name = file_name
+        self.interval = interval
+        self.n_cpus = n_cpus
+        self.samples = 0
+        self.saturated = 0  # number of samples where all cpus were busy
+        self.peak = {"rss_bytes": 0, "seconds": 0, "command": ""}
+        self.started = None
+        self.elapsed = 0
+
+        self._procs = {}  # pid: psutil.Process, keeps cpu_percent() state
+        self._pss = True
+        self._start_usage = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._fp = None
+
+    def start(self):
+        """Start sampling in the background."""
+
+        self.started = time.monotonic()
+        self._start_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if self.interval <= 0:
+            return
+        self._fp = gzip.open(self.file_name, "wt")
+        self._fp.write("\t".join(COLUMNS) + "\n")
+        self._thread = threading.Thread(
+            target=self._run, name="resource-sampler", daemon=True
+        )
+        self._thread.start()
+        log.info("Sampling resources every %s s into %s", self.interval, self.file_name)
+
+    def stop(self):
+        """Stop sampling and close the file."""
+
+        self.elapsed = time.monotonic() - self.started if self.started else 0
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+            log.info(
+                "All %d cpus were busy in %d of %d samples.  Peak memory was "
+                "%.1f GiB at %d s, mostly used by %s",
+                self.n_cpus,
+                self.saturated,
+                self.samples,
+                self.peak["rss_bytes"] / 1024**3,
+                self.peak["seconds"],
+                self.peak["command"],
+            )
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:  # never let this kill the gear
+                log.exception("Problem sampling resources")
+
+    def _memory(self, proc):
+        if self._pss:
+            try:
+                info = proc.memory_full_info()
+                return info.rss, info.pss
+            except psutil.AccessDenied:
+                self._pss = False  # don't keep trying
+        return proc.memory_info().rss, 0
+
+    def sample(self):
+        """Take one sample of every process in the tree and write it.
+
+        Returns:
+            totals (dict): command name: measurements, including ALL
+        """
+
+        seconds = round(time.monotonic() - self.started, 1)
+        children = psutil.Process().children(recursive=True)
+        procs = {}
+        totals = {}
+        for child in children:
+            proc = self._procs.get(child.pid, child)
+            try:
+                with proc.oneshot():
+                    name = proc.name()
+                    cpu = proc.cpu_percent(None)  # 0.0 the first time
+                    rss, pss = self._memory(proc)
+                    threads = proc.num_threads()
+                    try:
+                        io = proc.io_counters()
+                        read_bytes, write_bytes = io.read_bytes, io.write_bytes
+                    except (psutil.AccessDenied, AttributeError):
+                        read_bytes = write_bytes = 0
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                continue
+            procs[child.pid] = proc
+            for key in [name, ALL]:
+                total = totals.setdefault(key, dict.fromkeys(COLUMNS[2:], 0))
+                total["processes"] += 1
+                total["threads"] += threads
+                total["cpu_percent"] += cpu
+                total["rss_bytes"] += rss
+                total["pss_bytes"] += pss
+                total["read_bytes"] += read_bytes
+                total["write_bytes"] += write_bytes
+        self._procs = procs
+
+        self.samples += 1
+        if not totals:
+            return totals
+        if totals[ALL]["cpu_percent"] >= SATURATED * 100 * self.n_cpus:
+            self.saturated += 1
+        if totals[ALL]["rss_bytes"] > self.peak["rss_bytes"]:
+            biggest = max(
+                (name for name in totals if name != ALL),
+                key=lambda name: totals[name]["rss_bytes"],
+            )
+            self.peak = {
+                "rss_bytes": totals[ALL]["rss_bytes"],
+                "seconds": seconds,
+                "command": biggest,
+            }
+
+        if self._fp:
+            for name in sorted(totals):
+                values = [seconds, name] + [
+                    round(totals[name][column], 1) for column in COLUMNS[2:]
+                ]
+                self._fp.write("\t".join(str(value) for value in values) + "\n")
+            self._fp.flush()
+        return totals
+
+    def resources_used(self, command, exit_status):
+        """Summarize like "/usr/bin/time -v" did, with the same names.
+
+        Args:
+            command (list of str): the command that was run
+            exit_status (int): what it returned
+
+        Returns:
+            resources (dict): name: value as a string
+        """
+
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        user = usage.ru_utime - self._start_usage.ru_utime
+        system = usage.ru_stime - self._start_usage.ru_stime
+        elapsed = self.elapsed
+        percent = round(100 * (user + system) / elapsed) if elapsed else 0
+
+        resources = {
+            "Command being timed": " ".join(command),
+            "User time (seconds)": f"{user:.2f}",
+            "System time (seconds)": f"{system:.2f}",
+            "Percent of CPU this job got": f"{percent}%",
+            "Elapsed (wall clock) time (h:mm:ss or m:ss)": format_elapsed(elapsed),
+        }
+        for key, field in RUSAGE_KEYS:
+            if field is None:
+                value = 0
+            elif field == "ru_maxrss":  # a peak, not a count
+                value = usage.ru_maxrss
+            else:
+                value = getattr(usage, field) - getattr(self._start_usage, field)
+            resources[key] = str(value)
+        resources["Page size (bytes)"] = str(os.sysconf("SC_PAGE_SIZE"))
+        resources["Exit status"] = str(exit_status)
+        return resources
+
+    def summary(self):
+        """What the samples showed.
+
+        Returns:
+            summary (dict)
+        """
+
+        return {
+            "samples": self.samples,
+            "interval s": self.interval,
+            "cpus saturated fraction": (
+                round(self.saturated / self.samples, 3) if self.samples else 0
+            ),
+            "peak tree rss GiB": round(self.peak["rss_bytes"] / 1024**3, 2),
+            "peak at s": self.peak["seconds"],
+            "peak command": self.peak["command"],
+        }
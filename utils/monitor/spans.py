@@ -0,0 +1,242 @@
+"""Record how long each phase of the gear takes and what resources it uses.
+
+The gear runs one phase after another (download, run the BIDS App, zip, ...)
+so a new phase simply ends the one before it:
+
+    .. code-block:: python
+
+        phases = PhaseRecorder()
+        phases.phase("download")
+        ...
+        phases.phase("zip output")
+        ...
+        phases.stop()
+        phases.write_chrome_trace(output_dir / "trace.json")
+        summary = phases.summary()
+
+For each phase, wall time, cpu time (of this process and any children that
+finished during the phase), bytes read from and written to storage by this
+process (from /proc/self/io) and peak resident memory are recorded.  The trace
+can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+Steps that run at the same time (in threads) are recorded with span(), each on
+its own row of the trace.  Their cpu time and bytes are of the whole process
+while they ran, so they include what the other steps did.
+"""
+
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+PROC_IO = "/proc/self/io"
+PROC_STATUS = "/proc/self/status"
+PROC_CLEAR_REFS = "/proc/self/clear_refs"
+
+
+def read_io():
+    """Bytes read from and written to storage by this process so far.
+
+    Returns:
+        (read_bytes, write_bytes) or (None, None) if /proc/self/io can't be read
+    """
+
+    try:
+        with open(PROC_IO) as fp:
+            values = dict(line.split(":") for line in fp if ":" in line)
+        return int(values["read_bytes"]), int(values["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def reset_peak_rss():
+    """Start measuring peak resident memory from now (Linux only).
+
+    Returns:
+        True if the peak was reset
+    """
+
+    try:
+        with open(PROC_CLEAR_REFS, "w") as fp:
+            fp.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss():
+    """Peak resident memory of this process in bytes.
+
+    This is since the last reset_peak_rss() if that worked, else since starting.
+    """
+
+    try:
+        with open(PROC_STATUS) as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Phase:
+    """Measurements of one phase.
+
+    Args:
+        name (str): what is being done
+        tid (int): row of the trace to show it in, default is the process id
+        reset_peak (bool): measure peak memory from the start of this phase,
+            don't for phases inside others
+    """
+
+    def __init__(self, name, tid=None, reset_peak=True):
+        self.name = name
+        self.tid = tid or os.getpid()
+        self.start = time.time()
+        self._wall = time.perf_counter()
+        times = os.times()
+        self._cpu = times.user + times.system
+        self._children_cpu = times.children_user + times.children_system
+        self._read, self._write = read_io()
+        if reset_peak:
+            reset_peak_rss()
+
+        self.wall = None
+        self.cpu = None
+        self.children_cpu = None
+        self.read_bytes = None
+        self.write_bytes = None
+        self.peak_rss = None
+
+    def end(self):
+        """Finish measuring."""
+
+        self.wall = time.perf_counter() - self._wall
+        times = os.times()
+        self.cpu = times.user + times.system - self._cpu
+        self.children_cpu = times.children_user + times.children_system
+        self.children_cpu -= self._children_cpu
+        read_bytes, write_bytes = read_io()
+        if read_bytes is not None and self._read is not None:
+            self.read_bytes = read_bytes - self._read
+            self.write_bytes = write_bytes - self._write
+        self.peak_rss = read_peak_rss()
+
+    def summary(self):
+        """Measurements rounded to be easy to read.
+
+        Returns:
+            summary (dict)
+        """
+
+        summary = {
+            "wall s": round(self.wall, 2),
+            "cpu s": round(self.cpu, 2),
+            "children cpu s": round(self.children_cpu, 2),
+            "peak rss MiB": round(self.peak_rss / 1024**2, 1),
+        }
+        if self.read_bytes is not None:
+            summary["read MiB"] = round(self.read_bytes / 1024**2, 1)
+            summary["write MiB"] = round(self.write_bytes / 1024**2, 1)
+        return summary
+
+
+class PhaseRecorder:
+    """Record a series of phases, one after another."""
+
+    def __init__(self):
+        self.phases = []
+        self._current = None
+        self._lock = threading.Lock()
+
+    def phase(self, name):
+        """End the current phase (if any) and start a new one.
+
+        Args:
+            name (str): what is being done
+        """
+
+        self.stop()
+        log.debug("Starting phase %s", name)
+        self._current = Phase(name)
+
+    def stop(self):
+        """End the current phase."""
+
+        if self._current:
+            self._current.end()
+            with self._lock:
+                self.phases.append(self._current)
+            log.debug("Phase %s took %.1f s", self._current.name, self._current.wall)
+            self._current = None
+
+    @contextmanager
+    def span(self, name):
+        """Record a step that runs at the same time as others, in a thread.
+
+        Args:
+            name (str): what is being done
+        """
+
+        span = Phase(name, tid=threading.get_ident(), reset_peak=False)
+        try:
+            yield span
+        finally:
+            span.end()
+            with self._lock:
+                self.phases.append(span)
+
+    def summary(self):
+        """Measurements of every phase.
+
+        Returns:
+            summary (dict): phase name: measurements, in the order they ran.
+                If a phase ran more than once, the measurements are added up
+                except for peak rss, which is the largest.
+        """
+
+        summary = {}
+        for phase in self.phases:
+            this = phase.summary()
+            if phase.name in summary:
+                for key, value in this.items():
+                    if key == "peak rss MiB":
+                        summary[phase.name][key] = max(summary[phase.name][key], value)
+                    else:
+                        summary[phase.name][key] = round(
+                            summary[phase.name].get(key, 0) + value, 2
+                        )
+            else:
+                summary[phase.name] = this
+        return summary
+
+    def write_chrome_trace(self, file_name):
+        """Save the phases in the Chrome trace event format.
+
+        Args:
+            file_name (Path): where to save the json file
+        """
+
+        pid = os.getpid()
+        events = [
+            {
+                "name": phase.name,
+                "cat": "phase",
+                "ph": "X",
+                "ts": round(phase.start * 1e6),
+                "dur": round(phase.wall * 1e6),
+                "pid": pid,
+                "tid": phase.tid,
+                "args": phase.summary(),
+            }
+            for phase in self.phases
+        ]
+        with open(file_name, "w") as fp:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp, indent=1)
+        log.info("Saved timing of %d phases in %s", len(events), file_name)
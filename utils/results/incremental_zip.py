@@ -0,0 +1,184 @@
+"""Zip the output of participants as soon as they are finished.
+
+fMRIPrep writes the HTML report for a participant (output/<destination_id>/
+fmriprep/sub-<label>.html) after everything else for that participant is done.
+While the BIDS App is still running, a background thread polls for new reports
+and, once a report has stopped changing, adds that participant's fmriprep and
+freesurfer output to the final archive(s) at idle cpu and I/O priority.  After
+the BIDS App finishes, only what has not been archived yet is zipped, along
+with files that have changed since they were archived (e.g. a report that was
+written again when the BIDS App was tried again).
+
+Example:
+    .. code-block:: python
+
+        archiver = OutputArchiver(output_dir, destination_id, zip_names, n_cpus)
+        archiver.start()
+        # run the BIDS App...
+        archiver.stop()
+        archiver.finish()
+"""
+
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from .parallel_zip import ParallelZipFile, lower_priority, walk_tree
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 60  # seconds between looking for finished participants
+SUB_DIRS = ["fmriprep", "freesurfer"]
+
+
+class OutputArchiver:
+    """Archive output/<destination_id>, partly while the BIDS App is running.
+
+    Args:
+        output_dir (Path): the gear's output directory
+        destination_id (str): the output to archive is in output_dir/destination_id
+        zip_names (dict): maps "fmriprep" and "freesurfer" to the names of
+            separate archives for each, or maps None to the name of a single
+            archive of everything
+        n_workers (int): number of compressing threads for the final pass
+        poll_interval (float): seconds between looking for finished participants
+    """
+
+    def __init__(
+        self, output_dir, destination_id, zip_names, n_workers, poll_interval=None
+    ):
+        self.output_dir = Path(output_dir)
+        self.destination_id = destination_id
+        self.n_workers = n_workers
+        self.poll_interval = poll_interval or POLL_INTERVAL
+        self.archived = []  # labels of participants that have been archived
+
+        self._zips = {}
+        self._by_sub_dir = {}
+        for sub_dir, zip_name in zip_names.items():
+            if zip_name not in self._zips:
+                log.info("Zipping output file %s", zip_name)
+                self._zips[zip_name] = ParallelZipFile(
+                    self.output_dir / zip_name, n_workers
+                )
+            self._by_sub_dir[sub_dir] = self._zips[zip_name]
+
+        self._started = time.time()
+        self._seen = {}  # report path: (size, mtime) at last poll
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start looking for finished participants in the background."""
+
+        self._started = time.time()
+        self._thread = threading.Thread(
+            target=self._run, name="output-archiver", daemon=True
+        )
+        self._thread.start()
+        log.info(
+            "Archiving finished participants every %d s while running",
+            self.poll_interval,
+        )
+
+    def stop(self):
+        """Stop the background thread (waits for the current participant)."""
+
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        lower_priority()
+        while not self._stop.wait(self.poll_interval):
+            try:
+                for label in self.finished_participants():
+                    self.archive_participant(label)
+            except Exception:  # never let this kill the gear, finish() will catch up
+                log.exception("Problem archiving output while running")
+
+    def finished_participants(self):
+        """Find participants whose report was written since starting and is stable.
+
+        Returns:
+            labels (list of str): e.g. ["sub-01"]
+        """
+
+        finished = []
+        fmriprep_dir = self.output_dir / self.destination_id / "fmriprep"
+        for report in sorted(fmriprep_dir.glob("sub-*.html")):
+            label = report.name[: -len(".html")]
+            if label in self.archived:
+                continue
+            try:
+                st = report.stat()
+            except FileNotFoundError:
+                continue
+            if st.st_mtime < self._started:  # e.g. from previous-results
+                continue
+            state = (st.st_size, st.st_mtime)
+            if self._seen.get(report) == state:
+                finished.append(label)
+            self._seen[report] = state
+        return finished
+
+    def _archive_items(self, sub_dir, rel_path):
+        return walk_tree(self.output_dir, f"{self.destination_id}/{sub_dir}/{rel_path}")
+
+    def archive_participant(self, label):
+        """Add the fmriprep and freesurfer output of one participant.
+
+        Args:
+            label (str): e.g. "sub-01"
+        """
+
+        start = time.monotonic()
+        count = 0
+        for sub_dir in SUB_DIRS:
+            zip_file = self._by_sub_dir.get(sub_dir, self._by_sub_dir.get(None))
+            if zip_file is None:
+                continue
+            items = list(self._archive_items(sub_dir, label))
+            if sub_dir == "fmriprep":
+                arcname = f"{self.destination_id}/fmriprep/{label}.html"
+                items.append((str(self.output_dir / arcname), arcname))
+            count += zip_file.write_paths(items, n_workers=1, low_priority=True)
+        self.archived.append(label)
+        log.info(
+            "Archived %d files for finished participant %s in %.1f s",
+            count,
+            label,
+            time.monotonic() - start,
+        )
+
+    def finish(self):
+        """Zip everything that has not been archived yet or has changed since.
+
+        Then close the archives.
+        """
+
+        self.stop()
+        start = time.monotonic()
+        count = 0
+        for sub_dir, zip_file in self._by_sub_dir.items():
+            source_dir = self.destination_id
+            if sub_dir:
+                source_dir += "/" + sub_dir
+            count += zip_file.write_paths(walk_tree(self.output_dir, source_dir))
+        for zip_name, zip_file in self._zips.items():
+            zip_file.close()
+            log.info(
+                "Wrote %s (%.1f MiB)",
+                zip_name,
+                os.path.getsize(self.output_dir / zip_name) / 1024**2,
+            )
+        log.info(
+            "Zipped %d remaining files and directories in %.1f s after running "
+            "(%d participants were archived while running)",
+            count,
+            time.monotonic() - start,
+            len(self.archived),
+        )
@@ -0,0 +1,639 @@
+"""Write zip archives using all available cpus.
+
+Python's ZipFile compresses one member at a time.  Here, members are
+compressed by a pool of threads (zlib releases the GIL) into temporary spool
+files and a single writer appends them to the archive in order.  Only a
+bounded number of compressed members are held at once, and spools larger than
+SPOOL_SIZE go to disk, so memory use does not depend on the size of the data.
+Files that are already compressed (e.g. .nii.gz) are stored as they are.
+
+The archives are ordinary zip files (with Zip64 extensions when needed) that
+can be read by ZipFile, unzip, and the Flywheel platform.
+
+Example:
+    .. code-block:: python
+
+        parallel_zip_output(output_dir, destination_id, zip_file_name, n_workers=8)
+"""
+
+import ctypes
+import logging
+import os
+import platform
+import shutil
+import stat
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Files with these extensions are already compressed so they are stored
+STORED_EXTENSIONS = (
+    ".gz",
+    ".png",
+    ".h5",
+    ".zip",
+    ".mgz",
+    ".pklz",
+    ".jpg",
+    ".jpeg",
+    ".bz2",
+    ".xz",
+)
+
+CHUNK_SIZE = 1024 * 1024
+SPOOL_SIZE = 4 * 1024 * 1024  # compressed data larger than this is spooled to disk
+READ_TRIES = 3  # times to read a file that keeps changing
+
+# Beyond these, Zip64 extensions are needed
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# ioprio_set() has no Python wrapper so it is called by number
+IOPRIO_SET_SYSCALL = {"x86_64": 251, "aarch64": 30}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_IDLE = 3 << 13  # IOPRIO_CLASS_IDLE
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+END_RECORD_64 = struct.Struct("<IQHHIIQQQQ")
+END_LOCATOR_64 = struct.Struct("<IIQI")
+
+
+def lower_priority():
+    """Make the calling thread run at the lowest cpu and I/O priority.
+
+    This can't be undone by an unprivileged process, so only call it in threads
+    that exist just for background work.
+    """
+
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except OSError as err:
+        log.debug("Could not lower cpu priority: %s", err)
+
+    syscall = IOPRIO_SET_SYSCALL.get(platform.machine())
+    if syscall:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syscall(syscall, IOPRIO_WHO_PROCESS, tid, IOPRIO_IDLE) != 0:
+            log.debug("Could not lower I/O priority: errno %d", ctypes.get_errno())
+
+
+class ZipEntry:
+    """A member that is ready to be appended to an archive.
+
+    Attributes:
+        arcname (str): name in the archive ("/" at the end for directories)
+        method (int): ZIP_STORED or ZIP_DEFLATED
+        crc (int): CRC-32 of the uncompressed data
+        file_size (int): size of the uncompressed data
+        compress_size (int): size of the data as stored in the archive
+        date_time (tuple): modification time (year, month, day, hour, min, sec)
+        mode (int): st_mode of the original file
+        mtime_ns (int): exact modification time of the original file, None for
+            directories and links
+        path (str): file to copy the data from if data is None
+        data (file object): compressed data, positioned at the start
+        blob (bytes): data as stored, for entries written to several archives
+    """
+
+    def __init__(self, arcname, date_time, mode):
+        self.arcname = arcname
+        self.date_time = date_time
+        self.mode = mode
+        self.mtime_ns = None
+        self.method = ZIP_STORED
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.path = None
+        self.data = None
+        self.blob = None
+
+
+def _stamp(st):
+    return st.st_size, st.st_mtime_ns
+
+
+def _date_time(mtime):
+    """Zip archives can't hold times before 1980."""
+
+    date_time = time.localtime(mtime)[0:6]
+    if date_time[0] < 1980:
+        date_time = (1980, 1, 1, 0, 0, 0)
+    return date_time
+
+
+def is_stored(name):
+    """True if the file is already compressed so compressing it again is a waste."""
+
+    return name.lower().endswith(STORED_EXTENSIONS)
+
+
+class FileChangedError(OSError):
+    """A file changed between being checksummed and being written."""
+
+
+def _checksum(fp, compress):
+    """Read a file, compressing it if asked to.
+
+    Returns:
+        crc (int): CRC-32 of what was read
+        n_bytes (int): number of bytes read
+        spool (file object): the compressed data, None if not compressed
+    """
+
+    crc = n_bytes = 0
+    spool = compressor = None
+    if compress:
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+        crc = zlib.crc32(chunk, crc)
+        n_bytes += len(chunk)
+        if compressor:
+            spool.write(compressor.compress(chunk))
+    if compressor:
+        spool.write(compressor.flush())
+    return crc, n_bytes, spool
+
+
+def prepare_entry(path, arcname):
+    """Compress (or just checksum) a file so the writer only has to copy bytes.
+
+    This runs in the worker threads.  The sizes and checksum are those of the
+    bytes that were read, and a file that changes while it is read (e.g. one
+    the BIDS App is still writing) is read again, up to READ_TRIES times.
+
+    Args:
+        path (str): file or directory to add
+        arcname (str): name in the archive
+
+    Returns:
+        entry (ZipEntry)
+    """
+
+    st = os.stat(path)
+    if stat.S_ISDIR(st.st_mode):
+        entry = ZipEntry(arcname, _date_time(st.st_mtime), st.st_mode)
+        if not entry.arcname.endswith("/"):
+            entry.arcname += "/"
+        return entry
+
+    compress = not is_stored(path) and st.st_size > 0
+    for _ in range(READ_TRIES):
+        with open(path, "rb") as fp:
+            st = os.fstat(fp.fileno())
+            crc, n_bytes, spool = _checksum(fp, compress)
+            after = os.fstat(fp.fileno())
+        if n_bytes == after.st_size and _stamp(st) == _stamp(after):
+            break
+        log.debug("%s changed while zipping it", path)
+        if spool:
+            spool.close()
+        spool = None
+
+    entry = ZipEntry(arcname, _date_time(st.st_mtime), st.st_mode)
+    entry.path = path
+    entry.mtime_ns = st.st_mtime_ns
+    entry.crc = crc
+    entry.file_size = entry.compress_size = n_bytes
+    if spool is None:
+        return entry
+
+    if spool.tell() >= n_bytes:  # not worth it, store instead
+        spool.close()
+        return entry
+
+    entry.compress_size = spool.tell()
+    spool.seek(0)
+    entry.method = ZIP_DEFLATED
+    entry.data = spool
+    return entry
+
+
+def prepare_shared_entry(path, arcname):
+    """Compress a file once so that it can be written to several archives.
+
+    Args:
+        path (str): file to add
+        arcname (str): name in the archives
+
+    Returns:
+        entry (ZipEntry) with the data held in memory
+    """
+
+    entry = prepare_entry(path, arcname)
+    if entry.data is not None:
+        entry.blob = entry.data.read()
+        entry.data.close()
+        entry.data = None
+    elif entry.path is not None:
+        with open(entry.path, "rb") as fp:
+            entry.blob = fp.read()
+    entry.path = None
+    return entry
+
+
+def link_entry(arcname, target, mtime):
+    """Make an entry for a symbolic link, which unzip restores as a link.
+
+    Args:
+        arcname (str): name in the archive
+        target (str): what the link points to
+        mtime (float): modification time
+
+    Returns:
+        entry (ZipEntry)
+    """
+
+    entry = ZipEntry(arcname, _date_time(mtime), stat.S_IFLNK | 0o777)
+    entry.blob = target.encode("utf-8")
+    entry.crc = zlib.crc32(entry.blob)
+    entry.file_size = entry.compress_size = len(entry.blob)
+    return entry
+
+
+def data_entry(arcname, data, mtime):
+    """Make an entry for a file that is only in memory.
+
+    Args:
+        arcname (str): name in the archive
+        data (bytes): contents of the file
+        mtime (float): modification time
+
+    Returns:
+        entry (ZipEntry)
+    """
+
+    entry = ZipEntry(arcname, _date_time(mtime), stat.S_IFREG | 0o644)
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    entry.blob = compressor.compress(data) + compressor.flush()
+    entry.method = ZIP_DEFLATED
+    entry.crc = zlib.crc32(data)
+    entry.file_size = len(data)
+    entry.compress_size = len(entry.blob)
+    return entry
+
+
+def prepare_entries(items, n_workers, low_priority=False, prepare=prepare_entry):
+    """Prepare entries on a pool of threads and yield them in the order given.
+
+    Only a few more entries than there are threads are held at once, so this
+    bounds the number of spools waiting to be written.
+
+    Args:
+        items (iterable of tuple): arguments for prepare, e.g. (path, arcname)
+        n_workers (int): number of compressing threads
+        low_priority (bool): run the compressing threads at idle cpu and
+            I/O priority so they don't slow down anything else
+        prepare (function): makes a ZipEntry from the items
+
+    Yields:
+        entry (ZipEntry)
+    """
+
+    window = n_workers + 2
+    initializer = lower_priority if low_priority else None
+    with ThreadPoolExecutor(max_workers=n_workers, initializer=initializer) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(prepare, *item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class ParallelZipFile:
+    """Zip archive that is written by a pool of compressing threads.
+
+    Args:
+        file_name (str): path of the archive to create
+        n_workers (int): number of compressing threads, default is number of cpus
+    """
+
+    def __init__(self, file_name, n_workers=None):
+        self.file_name = file_name
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.names = set()
+        self._stamps = {}  # arcname: (size, mtime) of the file that was written
+        self._central = []
+        self._fp = open(file_name, "wb")
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_paths(self, items, n_workers=None, low_priority=False):
+        """Compress and add files to the archive.
+
+        Members are written in the order given, skipping names already written
+        unless the file has changed since (a different size or modification
+        time).  The central directory then points at the new copy, and the old
+        one is left in the archive, unused.
+
+        Args:
+            items (iterable of tuple): (path, arcname) pairs
+            n_workers (int): number of compressing threads, default is the
+                number given when the archive was created
+            low_priority (bool): run the compressing threads at idle cpu and
+                I/O priority so they don't slow down anything else
+
+        Returns:
+            count (int): number of members written
+        """
+
+        def new_items():
+            for path, arcname in items:
+                st = os.stat(path)
+                stamp = (st.st_size, st.st_mtime_ns)
+                if arcname in self.names:
+                    if self._stamps.get(arcname, stamp) == stamp:
+                        continue
+                    log.info("Zipping %s again, it has changed", arcname)
+                    self._central = [
+                        record
+                        for record in self._central
+                        if record[0].arcname != arcname
+                    ]
+                self.names.add(arcname)
+                if stat.S_ISREG(st.st_mode):
+                    self._stamps[arcname] = stamp
+                yield path, arcname
+
+        count = 0
+        with self._lock:
+            for entry in prepare_entries(
+                new_items(), n_workers or self.n_workers, low_priority=low_priority
+            ):
+                self.write_entry(entry)
+                count += 1
+        return count
+
+    def tell(self):
+        """Number of bytes written to the archive so far."""
+
+        return self._fp.tell()
+
+    def write_entry(self, entry):
+        """Append a prepared entry to the archive.
+
+        A file that is not compressed is read again to copy it, so if it has
+        changed since it was prepared, it is prepared again.
+
+        Args:
+            entry (ZipEntry): as returned by prepare_entry()
+
+        Returns:
+            entry (ZipEntry): what was written
+        """
+
+        for attempt in range(READ_TRIES):
+            try:
+                self._write_entry(entry)
+                return entry
+            except FileChangedError as exc:
+                if attempt == READ_TRIES - 1:
+                    raise
+                log.info("%s, zipping it again", exc)
+                entry = prepare_entry(entry.path, entry.arcname)
+
+    def _write_entry(self, entry):
+        offset = self._fp.tell()
+        name = entry.arcname.encode("utf-8")
+        flags = 0x800 if not entry.arcname.isascii() else 0
+        dos_time = (
+            entry.date_time[3] << 11 | entry.date_time[4] << 5 | entry.date_time[5] // 2
+        )
+        dos_date = (
+            (entry.date_time[0] - 1980) << 9
+            | entry.date_time[1] << 5
+            | entry.date_time[2]
+        )
+
+        zip64 = entry.file_size >= ZIP64_LIMIT or entry.compress_size >= ZIP64_LIMIT
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, entry.file_size, entry.compress_size)
+            file_size = compress_size = 0xFFFFFFFF
+            version = 45
+        else:
+            extra = b""
+            file_size, compress_size = entry.file_size, entry.compress_size
+            version = 20
+
+        self._fp.write(
+            LOCAL_HEADER.pack(
+                0x04034B50,
+                version,
+                flags,
+                entry.method,
+                dos_time,
+                dos_date,
+                entry.crc,
+                compress_size,
+                file_size,
+                len(name),
+                len(extra),
+            )
+        )
+        self._fp.write(name)
+        self._fp.write(extra)
+
+        if entry.blob is not None:
+            self._fp.write(entry.blob)
+        elif entry.data is not None:
+            shutil.copyfileobj(entry.data, self._fp, CHUNK_SIZE)
+            entry.data.close()
+        elif entry.path is not None:
+            crc = n_bytes = 0
+            with open(entry.path, "rb") as src:
+                while n_bytes < entry.compress_size:
+                    chunk = src.read(min(CHUNK_SIZE, entry.compress_size - n_bytes))
+                    if not chunk:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+                    n_bytes += len(chunk)
+                    self._fp.write(chunk)
+            if (n_bytes, crc) != (entry.compress_size, entry.crc):
+                self._fp.seek(offset)
+                self._fp.truncate()
+                raise FileChangedError(f"{entry.path} changed after it was read")
+
+        external_attr = (entry.mode & 0xFFFF) << 16
+        if entry.arcname.endswith("/"):
+            external_attr |= 0x10  # MS-DOS directory flag
+        self._central.append(
+            (entry, name, flags, dos_time, dos_date, version, external_attr, offset)
+        )
+        log.debug("Zipped %s", entry.arcname)
+
+    def close(self):
+        """Write the central directory and close the archive."""
+
+        if self._fp is None:
+            return
+
+        cd_offset = self._fp.tell()
+        for (
+            entry,
+            name,
+            flags,
+            dos_time,
+            dos_date,
+            version,
+            attr,
+            offset,
+        ) in self._central:
+            sizes = [entry.file_size, entry.compress_size, offset]
+            extra_values = [v for v in sizes if v >= ZIP64_LIMIT]
+            if extra_values:
+                extra = struct.pack(
+                    "<HH" + "Q" * len(extra_values),
+                    1,
+                    8 * len(extra_values),
+                    *extra_values,
+                )
+                version = 45
+            else:
+                extra = b""
+            file_size, compress_size, offset = [
+                0xFFFFFFFF if v >= ZIP64_LIMIT else v for v in sizes
+            ]
+            self._fp.write(
+                CENTRAL_HEADER.pack(
+                    0x02014B50,
+                    3 << 8 | version,  # made by unix
+                    version,
+                    flags,
+                    entry.method,
+                    dos_time,
+                    dos_date,
+                    entry.crc,
+                    compress_size,
+                    file_size,
+                    len(name),
+                    len(extra),
+                    0,
+                    0,
+                    0,
+                    attr,
+                    offset,
+                )
+            )
+            self._fp.write(name)
+            self._fp.write(extra)
+
+        cd_end = self._fp.tell()
+        cd_size = cd_end - cd_offset
+        count = len(self._central)
+        zip64 = (
+            count >= ZIP_FILECOUNT_LIMIT
+            or cd_offset >= ZIP64_LIMIT
+            or cd_size >= ZIP64_LIMIT
+        )
+        if zip64:
+            self._fp.write(
+                END_RECORD_64.pack(
+                    0x06064B50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset
+                )
+            )
+            self._fp.write(END_LOCATOR_64.pack(0x07064B50, 0, cd_end, 1))
+        self._fp.write(
+            END_RECORD.pack(
+                0x06054B50,
+                0,
+                0,
+                0xFFFF if zip64 else count,
+                0xFFFF if zip64 else count,
+                0xFFFFFFFF if zip64 else cd_size,
+                0xFFFFFFFF if zip64 else cd_offset,
+                0,
+            )
+        )
+        self._fp.close()
+        self._fp = None
+
+
+def walk_tree(root_dir, source_dir, exclude_files=None):
+    """List (path, arcname) for everything under source_dir like zip_output() does.
+
+    Args:
+        root_dir (str): The root directory to zip relative to.
+        source_dir (str): subdirectory (of <root_dir>) to zip.
+        exclude_files (list, optional): paths relative to root_dir to leave out
+
+    Yields:
+        (path, arcname) for every file and directory
+    """
+
+    exclude = set(exclude_files or [])
+    for root, subdirs, files in os.walk(os.path.join(root_dir, source_dir)):
+        rel_root = os.path.relpath(root, root_dir)
+        for name in files + subdirs:
+            arcname = os.path.join(rel_root, name)
+            if arcname not in exclude:
+                yield os.path.join(root, name), arcname
+
+
+def parallel_zip_output(
+    root_dir,
+    source_dir,
+    output_zip_filename,
+    dry_run=False,
+    exclude_files=None,
+    n_workers=None,
+):
+    """Zip an output directory using several threads.
+
+    This is a drop-in replacement for flywheel_gear_toolkit's zip_output() that
+    does not change the current working directory.
+
+    Args:
+        root_dir (str): The root directory to zip relative to.
+        source_dir (str): subdirectory (of <root_dir>) to zip.
+        output_zip_filename (str): path of the resultant output zip file, relative
+            paths are relative to root_dir.
+        dry_run (boolean, optional): if True, don't actually create the archive
+        exclude_files (list, optional): Files in <root_dir>/<source_dir> to exclude
+            from the zip file. Defaults to `None`.
+        n_workers (int): number of compressing threads, default is number of cpus
+
+    Raises:
+        FileNotFoundError: If `root_dir` does not exist.
+    """
+
+    if not os.path.exists(root_dir):
+        raise FileNotFoundError(f"The directory, {root_dir}, does not exist.")
+
+    log.info("Zipping output file %s", output_zip_filename)
+    if dry_run:
+        return
+
+    zip_path = os.path.join(root_dir, output_zip_filename)
+    if os.path.exists(zip_path):
+        os.remove(zip_path)
+
+    start = time.monotonic()
+    with ParallelZipFile(zip_path, n_workers) as outzip:
+        count = outzip.write_paths(walk_tree(root_dir, source_dir, exclude_files))
+    log.info(
+        "Zipped %d files and directories into %.1f MiB using %d threads in %.1f s",
+        count,
+        os.path.getsize(zip_path) / 1024**2,
+        outzip.n_workers,
+        time.monotonic() - start,
+    )
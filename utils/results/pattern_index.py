@@ -0,0 +1,71 @@
+"""Match paths against many file and directory patterns at once."""
+
+import re
+from fnmatch import translate
+from pathlib import PurePosixPath
+
+GLOB_CHARACTERS = re.compile(r"[*?[]")
+
+
+class PatternIndex:
+    """Match paths against many patterns the way Path.match() does, but quickly.
+
+    Path.match() compares a relative pattern with the end of a path, one part
+    at a time, so "two/hee" matches "test/two/hee" and "hey" matches any file
+    named "hey".  Patterns without wildcards are stored in a trie keyed by their
+    parts from last to first so a path is matched against all of them by
+    following its parts backwards, which costs the depth of the path instead of
+    the number of patterns.  Patterns with wildcards are checked only if the last
+    part of the path matches one regular expression made from all of their last
+    parts.
+
+    Args:
+        patterns (list of str): file or directory names or partial paths
+    """
+
+    def __init__(self, patterns):
+        self.trie = {}
+        self.globs = []  # (pattern, compiled regex for each part)
+        last_parts = []
+        for pattern in patterns:
+            parts = PurePosixPath(pattern).parts
+            if not parts or PurePosixPath(pattern).is_absolute():
+                continue  # never matches a relative path, as with Path.match()
+            if GLOB_CHARACTERS.search(pattern):
+                regexes = [re.compile(translate(part)) for part in parts]
+                self.globs.append((pattern, regexes))
+                last_parts.append(translate(parts[-1]))
+            else:
+                node = self.trie
+                for part in reversed(parts):
+                    node = node.setdefault(part, {})
+                node.setdefault(None, []).append(pattern)
+        self.last_part = re.compile("|".join(last_parts)) if last_parts else None
+
+    def match(self, parts):
+        """Find the patterns that match a path.
+
+        Args:
+            parts (tuple of str): the parts of a relative path
+
+        Returns:
+            matched (list of str): the patterns that match
+        """
+
+        matched = []
+        node = self.trie
+        for part in reversed(parts):
+            node = node.get(part)
+            if node is None:
+                break
+            matched.extend(node.get(None, []))
+
+        if self.last_part and parts and self.last_part.match(parts[-1]):
+            for pattern, regexes in self.globs:
+                if len(regexes) <= len(parts) and all(
+                    regex.match(part)
+                    for regex, part in zip(reversed(regexes), reversed(parts))
+                ):
+                    matched.append(pattern)
+
+        return matched
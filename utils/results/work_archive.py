@@ -0,0 +1,423 @@
+"""Archive the whole work/ directory into size-capped volumes.
+
+The nipype work directory can be tens of GB.  It is zipped by a pool of
+compressing threads into volumes, and a file is stored only once in each
+volume: hard links and files with identical content (e.g. copies of the same
+report) are stored as symbolic links to the first copy in the same volume, so
+each volume unzips on its own.  Symbolic links that were already in work/ are
+kept as they are, so they may point into another volume.  A policy decides what
+regenerable caches to leave out.
+
+Zip archives keep modification times only to 2 seconds, but nipype compares
+the exact time of a step's input files to decide whether to run it again, so
+each volume also has <source_dir>/.mtimes.json with the exact times of the
+files in it.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .parallel_zip import (
+    CHUNK_SIZE,
+    ParallelZipFile,
+    data_entry,
+    link_entry,
+    prepare_entries,
+    prepare_entry,
+)
+from .pattern_index import PatternIndex
+
+log = logging.getLogger(__name__)
+
+DEDUP_MIN_SIZE = 4096  # smaller identical files are not worth a link
+QUICK_BYTES = 64 * 1024  # read from each end of a file before reading all of it
+MTIMES_FILE = ".mtimes.json"  # arcname: st_mtime_ns of the files in a volume
+
+# What to leave out: (file patterns, directory patterns) as for gear-intermediate-*
+POLICIES = {
+    "everything": ([], []),
+    "no-result-caches": (["*.pklz", "*.pyc"], ["__pycache__"]),
+    "resumable": (["*.pyc"], ["__pycache__"]),
+}
+# Policies that keep only what lets fMRIPrep skip finished steps when it is run
+# again: not the downloaded BIDS data and not nipype nodes that didn't finish
+RESUMABLE = {"resumable"}
+NODE_FILE = "_node.pklz"
+RESULT_FILE = re.compile(r"^result_.*\.pklz$")
+
+
+def unfinished_node(files):
+    """True if a directory is a nipype node that did not finish.
+
+    Args:
+        files (list of str): names of the files in the directory
+    """
+
+    return NODE_FILE in files and not any(RESULT_FILE.match(name) for name in files)
+
+
+def _dir_size(path):
+    """Number of files and bytes in a directory tree."""
+
+    count = size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+                count += 1
+            except OSError:
+                pass
+    return count, size
+
+
+class WorkItem:
+    """Something to put in the archive.
+
+    Args:
+        path (str): where it is
+        arcname (str): name in the archive
+        size (int): size in bytes, 0 for directories and links
+        target (str): what a link points to or None to store the contents
+        first (str): arcname of the copy a link to an identical file (or hard
+            link) points to, None for other items
+    """
+
+    def __init__(self, path, arcname, size=0, target=None, first=None):
+        self.path = path
+        self.arcname = arcname
+        self.size = size
+        self.target = target
+        self.first = first
+
+
+def _link_to(arcname, first_arcname):
+    """Relative link target from arcname to first_arcname."""
+
+    return os.path.relpath(first_arcname, os.path.dirname(arcname))
+
+
+def plan_work_archive(root_dir, source_dir, policy="everything", n_workers=None):
+    """Walk source_dir and decide how to store everything in it.
+
+    Args:
+        root_dir (str): directory that contains source_dir
+        source_dir (str): name of the directory to archive
+        policy (str): key of POLICIES, what to leave out
+        n_workers (int): number of files to read at once to compare them
+
+    Returns:
+        items (list of WorkItem): in the order to write them
+        stats (dict): counts and bytes of what is linked and left out
+    """
+
+    file_patterns, dir_patterns = POLICIES[policy]
+    skip_files = PatternIndex(file_patterns)
+    skip_dirs = PatternIndex(dir_patterns)
+    real_source = os.path.realpath(os.path.join(root_dir, source_dir))
+
+    stats = {
+        "files": 0,
+        "bytes": 0,
+        "links": 0,
+        "linked bytes": 0,
+        "skipped": 0,
+        "skipped bytes": 0,
+    }
+    items = []
+    inodes = {}  # (st_dev, st_ino): arcname of first hard link
+    for root, dirs, files in os.walk(os.path.join(root_dir, source_dir)):
+        dirs.sort()
+        rel_root = os.path.relpath(root, root_dir)
+        if policy in RESUMABLE and (
+            rel_root == os.path.join(source_dir, "bids") or unfinished_node(files)
+        ):
+            count, size = _dir_size(root)
+            stats["skipped"] += count
+            stats["skipped bytes"] += size
+            dirs[:] = []
+            continue
+        items.append(WorkItem(root, rel_root))
+        dir_skipped = bool(skip_dirs.match(Path(rel_root).parts))
+        for name in sorted(files) + [
+            d for d in dirs if os.path.islink(os.path.join(root, d))
+        ]:
+            path = os.path.join(root, name)
+            arcname = os.path.join(rel_root, name)
+            try:
+                st = os.lstat(path)
+                if os.path.islink(path):
+                    real = os.path.realpath(path)
+                    if not os.path.exists(real):  # broken, keep it that way
+                        items.append(WorkItem(path, arcname, target=os.readlink(path)))
+                        continue
+                    if real == real_source or real.startswith(real_source + os.sep):
+                        target = os.path.normpath(
+                            os.path.join(source_dir, os.path.relpath(real, real_source))
+                        )
+                        items.append(
+                            WorkItem(path, arcname, target=_link_to(arcname, target))
+                        )
+                        stats["links"] += 1
+                        continue
+                    if os.path.isdir(real):
+                        continue  # like os.walk(), links to outside dirs are ignored
+                    st = os.stat(path)  # store what it points to
+            except OSError as exc:
+                log.warning("Could not archive %s: %s", arcname, exc)
+                continue
+
+            if dir_skipped or skip_files.match(Path(arcname).parts):
+                stats["skipped"] += 1
+                stats["skipped bytes"] += st.st_size
+                continue
+
+            key = (st.st_dev, st.st_ino)
+            if st.st_nlink > 1 and key in inodes:
+                target = _link_to(arcname, inodes[key])
+                items.append(WorkItem(path, arcname, st.st_size, target, inodes[key]))
+                stats["links"] += 1
+                stats["linked bytes"] += st.st_size
+                continue
+            inodes[key] = arcname
+            items.append(WorkItem(path, arcname, st.st_size))
+
+    _link_identical(items, stats, n_workers)
+
+    for item in items:
+        if item.target is None and item.size:
+            stats["files"] += 1
+            stats["bytes"] += item.size
+    return items, stats
+
+
+def file_digest(path):
+    """Hash the contents of a file."""
+
+    digest = hashlib.blake2b()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def quick_digest(path):
+    """Hash the beginning and the end of a file."""
+
+    digest = hashlib.blake2b()
+    with open(path, "rb") as fp:
+        digest.update(fp.read(QUICK_BYTES))
+        fp.seek(max(fp.tell(), os.fstat(fp.fileno()).st_size - QUICK_BYTES))
+        digest.update(fp.read(QUICK_BYTES))
+    return digest.digest()
+
+
+def _same_digest(groups, digest, n_workers):
+    """Split groups of files by a digest of their contents.
+
+    Args:
+        groups (list of list of WorkItem): files that might be identical
+        digest (function): path: digest
+        n_workers (int): number of files to read at once
+
+    Returns:
+        groups (list of list of WorkItem): files with the same digest, only
+            groups of more than one
+    """
+
+    candidates = [item for group in groups for item in group]
+    if not candidates:
+        return []
+    with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+        digests = executor.map(digest, [item.path for item in candidates])
+        by_digest = {}
+        for item, value in zip(candidates, digests):
+            by_digest.setdefault((item.size, value), []).append(item)
+    return [group for group in by_digest.values() if len(group) > 1]
+
+
+def _link_identical(items, stats, n_workers=None):
+    """Turn later copies of a file into links to the first copy.
+
+    Only files that are as big as some other file are compared, first by
+    their beginning and end, and only if those are the same by all of their
+    contents, so files that just happen to be the same size (e.g. images of
+    the same dimensions) are not read twice.
+    """
+
+    by_size = {}
+    for item in items:
+        if item.target is None and item.size >= DEDUP_MIN_SIZE:
+            by_size.setdefault(item.size, []).append(item)
+    groups = [same for same in by_size.values() if len(same) > 1]
+    groups = _same_digest(groups, quick_digest, n_workers)
+    groups = _same_digest(
+        [group for group in groups if group[0].size > 2 * QUICK_BYTES],
+        file_digest,
+        n_workers,
+    ) + [group for group in groups if group[0].size <= 2 * QUICK_BYTES]
+
+    order = {id(item): number for number, item in enumerate(items)}
+    for group in groups:
+        group.sort(key=lambda item: order[id(item)])
+        first = group[0]  # the first copy in the archive is the one stored
+        for item in group[1:]:
+            item.target = _link_to(item.arcname, first.arcname)
+            item.first = first.arcname
+            stats["links"] += 1
+            stats["linked bytes"] += item.size
+
+
+def _prepare(item):
+    if item.target is not None:
+        return link_entry(item.arcname, item.target, os.lstat(item.path).st_mtime)
+    return prepare_entry(item.path, item.arcname)
+
+
+class Volume:
+    """The volume being written and which copies of files are in it.
+
+    Args:
+        file_name (str): path of the archive
+        n_workers (int): number of compressing threads
+        source_dir (str): name of the directory being archived
+    """
+
+    def __init__(self, file_name, n_workers, source_dir):
+        self.zip = ParallelZipFile(file_name, n_workers)
+        self.source_dir = source_dir
+        self.stored = 0  # bytes of file data
+        self.copies = {}  # arcname of the first copy: arcname of a copy in here
+        self.mtimes = {}  # arcname: exact modification time
+
+    def write(self, entry):
+        """Append an entry to the volume."""
+
+        self.zip.names.add(entry.arcname)
+        entry = self.zip.write_entry(entry)
+        self.stored += entry.compress_size
+        if entry.mtime_ns is not None:
+            self.mtimes[entry.arcname] = entry.mtime_ns
+
+    def close(self):
+        """Write the exact modification times and close the volume."""
+
+        if self.mtimes:
+            data = json.dumps(self.mtimes).encode()
+            self.zip.write_entry(
+                data_entry(f"{self.source_dir}/{MTIMES_FILE}", data, time.time())
+            )
+            self.mtimes = {}
+        self.zip.close()
+
+    def resolve(self, item, entry):
+        """Make a link to an identical file point to a copy in this volume.
+
+        If there is none, the file is stored and later links point to it.
+
+        Returns:
+            entry (ZipEntry): what to write
+            stored_again (bool): the file is stored instead of linked
+        """
+
+        if item.first is None:
+            if item.target is None:
+                self.copies[item.arcname] = item.arcname
+            return entry, False
+        copy = self.copies.get(item.first)
+        if copy is None:
+            self.copies[item.first] = item.arcname
+            return prepare_entry(item.path, item.arcname), True
+        if copy != item.first:
+            mtime = os.lstat(item.path).st_mtime
+            entry = link_entry(item.arcname, _link_to(item.arcname, copy), mtime)
+        return entry, False
+
+
+def volume_name(dest_zip, number):
+    """Name of a volume: the first is dest_zip, then <dest_zip>_vol2.zip, etc."""
+
+    if number == 1:
+        return dest_zip
+    return f"{dest_zip[:-len('.zip')]}_vol{number}.zip"
+
+
+def archive_work_dir(
+    root_dir, source_dir, dest_zip, n_workers=None, volume_gb=0, policy="everything"
+):
+    """Zip a directory into one or more size-capped volumes.
+
+    Each volume is a complete zip archive.  A member is never split across
+    volumes so a volume can be bigger than volume_gb if one file is.  A file
+    that is linked to from a later volume is stored again in that volume.
+
+    Args:
+        root_dir (str): directory that contains source_dir
+        source_dir (str): name of the directory to archive
+        dest_zip (str): path of the (first) archive, must end with ".zip"
+        n_workers (int): number of compressing threads, default is number of cpus
+        volume_gb (float): maximum size of each volume, 0 for no limit
+        policy (str): key of POLICIES, what to leave out
+
+    Returns:
+        volumes (list of str): paths of the archives written
+        stats (dict): what was stored, linked and left out
+    """
+
+    start = time.monotonic()
+    n_workers = n_workers or os.cpu_count() or 1
+    max_bytes = int(volume_gb * 1024**3)
+
+    items, stats = plan_work_archive(root_dir, source_dir, policy, n_workers)
+    log.info(
+        "Archiving %d files (%.1f GiB), %d links to identical files (%.1f GiB not "
+        "stored again), leaving out %d files (%.1f GiB) by policy %s",
+        stats["files"],
+        stats["bytes"] / 1024**3,
+        stats["links"],
+        stats["linked bytes"] / 1024**3,
+        stats["skipped"],
+        stats["skipped bytes"] / 1024**3,
+        policy,
+    )
+
+    volumes = [volume_name(dest_zip, 1)]
+    volume = Volume(volumes[-1], n_workers, source_dir)
+    stats["stored again"] = 0
+    try:
+        entries = prepare_entries(
+            ((item,) for item in items), n_workers, prepare=_prepare
+        )
+        for item, prepared in zip(items, entries):
+            entry, again = volume.resolve(item, prepared)
+            size = entry.compress_size
+            if max_bytes and volume.stored and volume.zip.tell() + size > max_bytes:
+                if again:  # it will be stored in the next volume instead
+                    del volume.copies[item.first]
+                    if entry.data is not None:
+                        entry.data.close()
+                volume.close()
+                volumes.append(volume_name(dest_zip, len(volumes) + 1))
+                log.info("Starting volume %s", volumes[-1])
+                volume = Volume(volumes[-1], n_workers, source_dir)
+                entry, again = volume.resolve(item, prepared)
+            if again:
+                stats["stored again"] += 1
+            volume.write(entry)
+    finally:
+        volume.close()
+
+    stats["volumes"] = len(volumes)
+    stats["seconds"] = round(time.monotonic() - start, 1)
+    log.info(
+        "Wrote %d volume(s), %.1f GiB, in %.1f s",
+        len(volumes),
+        sum(os.path.getsize(volume) for volume in volumes) / 1024**3,
+        stats["seconds"],
+    )
+    return volumes, stats
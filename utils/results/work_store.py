@@ -0,0 +1,439 @@
+"""Keep nipype work directories in a content-addressed store to resume from.
+
+Re-running fMRIPrep with only its previous results repeats hours of
+registration and surface reconstruction when a run stopped late.  nipype skips
+a step when its directory in the work directory holds the results of a run
+with the same inputs (the hash in its "_0x<hash>.json" file), so restoring the
+finished steps of an earlier run lets the new run use them instead.
+
+A store is a directory, e.g. on a shared file system:
+
+- objects/<2 hex digits>/<rest of the hex digest>: the contents of each file,
+  stored once no matter how many snapshots or directories have it
+- snapshots/<name>.json.gz: the files, links and directories of one work
+  directory, with the digest and modification time of each file and the
+  fMRIPrep options it was made with
+
+Only what the "resumable" policy of work_archive keeps is published (not the
+BIDS data and not the steps that did not finish).  A snapshot, or a zipped work
+directory, is restored by hard linking (big files) or copying from the store, or
+extracting from the zip, only the finished steps of the participants in this
+run.  Files get back their exact modification times because nipype hashes
+input files by size and modification time.  nipype then compares each step's
+hash with the new configuration and runs the steps whose inputs have changed
+again.
+"""
+
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zipfile import ZipFile
+
+from ..unzip_selected import ZipHandles, bids_label, extract_member, make_symlink
+from .work_archive import (
+    MTIMES_FILE,
+    NODE_FILE,
+    file_digest,
+    plan_work_archive,
+    unfinished_node,
+)
+
+log = logging.getLogger(__name__)
+
+OBJECTS = "objects"
+SNAPSHOTS = "snapshots"
+SNAPSHOT_SUFFIX = ".json.gz"
+DIGEST_CHARS = 64  # hex digits of the digest used as an object's name
+LINK_MIN_SIZE = 1024**2  # smaller files are copied, nipype rewrites some of them
+
+# fMRIPrep makes these again each run: the BIDS data and <date-time>_<uuid>/
+# with its config.toml and BIDS database
+RUN_DIR = re.compile(r"^[0-9]{8}-[0-9]{6}_[0-9a-f-]{36}$")
+SUBJECT_WF = re.compile(r"^(?:single_subject|sub)_([a-zA-Z0-9]+)_wf$")
+
+# options that don't change fMRIPrep's results, only how it is run
+RUN_OPTIONS = {
+    "n_cpus",
+    "omp-nthreads",
+    "mem",
+    "mem_mb",
+    "low-mem",
+    "work-dir",
+    "participant-label",
+    "resource-monitor",
+    "notrack",
+    "stop-on-first-crash",
+    "verbose",
+}
+GEAR_OPTIONS = re.compile("gear-|lsf-|singularity-")
+
+
+def result_options(config):
+    """The fMRIPrep options that change what it computes.
+
+    Args:
+        config (dict): the gear's configuration
+
+    Returns:
+        options (dict): option name and value (as str if not a JSON type)
+    """
+
+    options = {}
+    for key, val in sorted(config.items()):
+        if key in RUN_OPTIONS or GEAR_OPTIONS.match(key):
+            continue
+        if not isinstance(val, (str, int, float, bool)):
+            val = str(val)
+        options[key] = val
+    return options
+
+
+def object_path(store_dir, digest):
+    """Where the contents of a file with this (hex) digest are stored."""
+
+    return Path(store_dir) / OBJECTS / digest[:2] / digest[2:]
+
+
+def snapshot_path(store_dir, name):
+    """Where the snapshot with this name is stored."""
+
+    return Path(store_dir) / SNAPSHOTS / (name + SNAPSHOT_SUFFIX)
+
+
+def _store_object(path, dest):
+    """Put a file in the store under the name dest.
+
+    Returns:
+        stored (bool): False if the store already had it
+    """
+
+    if dest.exists():
+        return False
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(f"{dest.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        os.link(path, tmp)  # the work directory is on the same file system
+    except OSError:
+        shutil.copy2(path, tmp)  # with its modification time, as a link has
+    os.chmod(tmp, 0o444)  # restored hard links must not be changed
+    os.replace(tmp, dest)  # another job may be storing the same file
+    return True
+
+
+def publish_work_dir(store_dir, root_dir, source_dir, name, options, n_workers=None):
+    """Store the finished steps in a work directory as a snapshot.
+
+    Args:
+        store_dir (Path): the store, created if needed
+        root_dir (str): directory that contains source_dir
+        source_dir (str): name of the work directory
+        name (str): name of the snapshot, e.g. the name the zip of it would have
+        options (dict): what result_options() found in the configuration
+        n_workers (int): number of files to hash and store at once
+
+    Returns:
+        snapshot (Path): the snapshot's file in the store
+        stats (dict): numbers of files, new files and bytes
+    """
+
+    start = time.monotonic()
+    items, _ = plan_work_archive(
+        root_dir, source_dir, policy="resumable", n_workers=n_workers
+    )
+
+    entries = []
+    files = []
+    for item in items:
+        path = Path(os.path.relpath(item.arcname, source_dir)).as_posix()
+        if path == ".":
+            continue
+        if os.path.islink(item.path) and item.target is not None:
+            entries.append({"path": path, "target": item.target})
+        elif os.path.isdir(item.path):
+            entries.append({"path": path, "dir": True})
+        else:  # including copies plan_work_archive would store as links
+            st = os.stat(item.path)
+            entry = {
+                "path": path,
+                "size": st.st_size,
+                "mode": st.st_mode & 0o777,
+                "mtime_ns": st.st_mtime_ns,
+            }
+            entries.append(entry)
+            files.append((item.path, entry))
+
+    seen = set()  # digests of files stored by this call
+    lock = threading.Lock()
+
+    def store(path_entry):
+        path, entry = path_entry
+        digest = file_digest(path).hex()[:DIGEST_CHARS]
+        entry["object"] = digest
+        with lock:
+            if digest in seen:
+                return False
+            seen.add(digest)
+        return _store_object(path, object_path(store_dir, digest))
+
+    with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+        stored = list(executor.map(store, files))
+
+    snapshot = snapshot_path(store_dir, name)
+    snapshot.parent.mkdir(parents=True, exist_ok=True)
+    tmp = snapshot.with_name(snapshot.name + ".tmp")
+    with gzip.open(tmp, "wt") as fp:
+        json.dump(
+            {
+                "name": name,
+                "store": str(store_dir),
+                "options": options,
+                "entries": entries,
+            },
+            fp,
+        )
+    os.replace(tmp, snapshot)
+
+    stats = {
+        "snapshot": snapshot.name,
+        "files": len(files),
+        "bytes": sum(entry["size"] for _, entry in files),
+        "new files": sum(stored),
+        "new bytes": sum(
+            entry["size"] for (_, entry), new in zip(files, stored) if new
+        ),
+        "seconds": round(time.monotonic() - start, 1),
+    }
+    log.info(
+        "Published %d files (%.1f GiB) of %s to %s, %d files (%.1f GiB) were new",
+        stats["files"],
+        stats["bytes"] / 1024**3,
+        source_dir,
+        snapshot,
+        stats["new files"],
+        stats["new bytes"] / 1024**3,
+    )
+    return snapshot, stats
+
+
+def select_steps(paths, subjects=None):
+    """Decide which files and directories of a work directory to restore.
+
+    Left out are the directories fMRIPrep makes again each run, nipype steps
+    that did not finish (and everything in them) and the workflows of other
+    participants.
+
+    Args:
+        paths (list of str): relative paths of everything in the work directory,
+            directories end with "/"
+        subjects (list of str): BIDS labels of the participants in this run,
+            None for all
+
+    Returns:
+        wanted (set of str): the paths to restore
+        stats (dict): numbers of steps restored and left out
+    """
+
+    files_in = {}
+    for path in paths:
+        parent, _, name = path.rstrip("/").rpartition("/")
+        files_in.setdefault(parent, []).append(name)
+
+    subjects = set(subjects or [])
+    stats = {"steps": 0, "unfinished steps": 0, "other participants": 0}
+    skipped = {}  # directory: True if it (or a directory it is in) is left out
+
+    def is_skipped(directory):
+        if directory in skipped:
+            return skipped[directory]
+        parent, _, name = directory.rpartition("/")
+        skip = bool(parent) and is_skipped(parent)
+        if not skip and not parent:
+            skip = name == "bids" or bool(RUN_DIR.match(name))
+        match = SUBJECT_WF.match(name)
+        if not skip and match and subjects and match.group(1) not in subjects:
+            stats["other participants"] += 1
+            skip = True
+        files = files_in.get(directory, [])
+        if not skip and unfinished_node(files):
+            stats["unfinished steps"] += 1
+            skip = True
+        elif not skip and NODE_FILE in files:
+            stats["steps"] += 1
+        skipped[directory] = skip
+        return skip
+
+    wanted = set()
+    for path in paths:
+        directory = path.rstrip("/") if path.endswith("/") else path.rpartition("/")[0]
+        if not directory or not is_skipped(directory):
+            wanted.add(path)
+    return wanted, stats
+
+
+def read_snapshot(snapshot):
+    """Read a snapshot's file.
+
+    Returns:
+        snapshot (dict): "name", "store", "options" and "entries"
+    """
+
+    with gzip.open(snapshot, "rt") as fp:
+        return json.load(fp)
+
+
+def _compare_options(saved, options):
+    """Log the options that are not the same as when the snapshot was made."""
+
+    if saved is None or options is None:
+        return []
+    changed = sorted(
+        key for key in set(saved) | set(options) if saved.get(key) != options.get(key)
+    )
+    if changed:
+        log.info(
+            "Options changed since the work directory was saved: %s.  Steps that "
+            "depend on them will be run again",
+            ", ".join(changed),
+        )
+    return changed
+
+
+def _restore_file(source, dest, size, mode, mtime_ns=None):
+    """Hard link (or copy) a file from the store.
+
+    A link shares the stored file's modification time, so it is only made if
+    that is the time the file had in the work directory.
+    """
+
+    if size >= LINK_MIN_SIZE and mtime_ns in (None, os.stat(source).st_mtime_ns):
+        try:
+            os.link(source, dest)
+            return True
+        except OSError:  # e.g. the store is on another file system
+            pass
+    shutil.copyfile(source, dest)
+    os.chmod(dest, mode or 0o644)
+    if mtime_ns is not None:
+        os.utime(dest, ns=(mtime_ns, mtime_ns))
+    return False
+
+
+def _zip_mtime_ns(info):
+    """Modification time of a zip member, only to 2 seconds."""
+
+    return int(time.mktime(info.date_time + (0, 0, -1))) * 10**9
+
+
+def restore_work_dir(
+    snapshot, work_dir, store_dir=None, subjects=None, options=None, n_threads=None
+):
+    """Put the finished steps of an earlier run into the work directory.
+
+    Args:
+        snapshot (Path): a snapshot from publish_work_dir() or a zip of a work
+            directory (its first path component is the work directory)
+        work_dir (Path): where to restore to, existing files are kept
+        store_dir (Path): the store, default is where the snapshot was made
+        subjects (list of str): Flywheel labels of the participants in this run,
+            None for all
+        options (dict): what result_options() found in the configuration now
+        n_threads (int): number of files to write at once
+
+    Returns:
+        stats (dict): numbers of steps and files restored and left out
+    """
+
+    start = time.monotonic()
+    work_dir = Path(work_dir)
+    subjects = [bids_label(s) for s in subjects or [] if s] or None
+
+    mtimes = {}  # arcname: exact modification time of a zip member
+    if str(snapshot).endswith(".zip"):
+        with ZipFile(snapshot) as zip_file:
+            members = {}
+            for info in zip_file.infolist():
+                parts = Path(info.filename).parts[1:]
+                if not parts or ".." in parts or Path(info.filename).is_absolute():
+                    continue
+                if parts == (MTIMES_FILE,):
+                    mtimes = json.loads(zip_file.read(info))
+                    continue
+                members["/".join(parts) + ("/" if info.is_dir() else "")] = info
+        saved_options = None
+    else:
+        saved = read_snapshot(snapshot)
+        store_dir = Path(store_dir or saved["store"])
+        members = {
+            entry["path"] + ("/" if entry.get("dir") else ""): entry
+            for entry in saved["entries"]
+        }
+        saved_options = saved.get("options")
+
+    wanted, stats = select_steps(list(members), subjects)
+    stats["changed options"] = _compare_options(saved_options, options)
+    stats.update({"files": 0, "bytes": 0, "hard links": 0, "skipped existing": 0})
+
+    to_write = []
+    for path in sorted(wanted):
+        member = members[path]
+        dest = work_dir / path.rstrip("/")
+        if path.endswith("/"):
+            dest.mkdir(parents=True, exist_ok=True)
+        elif dest.exists() or dest.is_symlink():
+            stats["skipped existing"] += 1
+        else:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            to_write.append((member, dest))
+
+    handles = ZipHandles(snapshot)
+
+    def write(member_dest):
+        member, dest = member_dest
+        if isinstance(member, dict):
+            if "target" in member:
+                make_symlink(member["target"], dest)
+                return 0, False
+            source = object_path(store_dir, member["object"])
+            linked = _restore_file(
+                source,
+                dest,
+                member["size"],
+                member.get("mode"),
+                member.get("mtime_ns"),
+            )
+            return member["size"], linked
+        size = extract_member(handles, member, dest)
+        if not stat.S_ISLNK(member.external_attr >> 16):
+            mtime_ns = mtimes.get(member.filename) or _zip_mtime_ns(member)
+            os.utime(dest, ns=(mtime_ns, mtime_ns))
+        return size, False
+
+    with handles, ThreadPoolExecutor(
+        max_workers=n_threads or os.cpu_count()
+    ) as executor:
+        for size, linked in executor.map(write, to_write):
+            stats["files"] += 1
+            stats["bytes"] += size
+            stats["hard links"] += bool(linked)
+
+    stats["seconds"] = round(time.monotonic() - start, 1)
+    log.info(
+        "Restored %d finished steps (%d files, %.1f GiB, %d hard links) from %s, "
+        "left out %d unfinished steps and %d workflows of other participants",
+        stats["steps"],
+        stats["files"],
+        stats["bytes"] / 1024**3,
+        stats["hard links"],
+        Path(snapshot).name,
+        stats["unfinished steps"],
+        stats["other participants"],
+    )
+    return stats
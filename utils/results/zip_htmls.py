@@ -1,20 +1,183 @@
 """Compress HTML files."""
 
-import datetime
-import glob
 import logging
 import os
-import subprocess as sp
+import threading
+from collections import Counter
+from html.parser import HTMLParser
 from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+from .parallel_zip import (
+    ParallelZipFile,
+    prepare_entries,
+    prepare_entry,
+    prepare_shared_entry,
+)
 
-FWV0 = Path.cwd()
 log = logging.getLogger(__name__)
 
+# attributes of tags that pull a figure into a report
+FIGURE_ATTRIBUTES = {"img": "src", "object": "data", "embed": "src"}
+
+
+class FigureReferences(HTMLParser):
+    """Collect the figure references (img src, object data, embed src) in html."""
+
+    def __init__(self):
+        super().__init__()
+        self.references = []
+
+    def handle_starttag(self, tag, attrs):
+        attribute = FIGURE_ATTRIBUTES.get(tag)
+        if attribute:
+            for name, value in attrs:
+                if name == attribute and value:
+                    self.references.append(value)
+
+    handle_startendtag = handle_starttag
+
+
+def find_referenced_figures(path, name):
+    """Find the files under path that an html report displays.
+
+    Args:
+        path (str): where the BIDS App put its html reports
+        name (str): name of the html file at the top of path
+
+    Returns:
+        figures (set of str): paths relative to path of the existing files the
+            report refers to with <img>, <object> or <embed>
+    """
+
+    parser = FigureReferences()
+    with open(os.path.join(path, name), encoding="utf-8", errors="replace") as fp:
+        parser.feed(fp.read())
+    parser.close()
+
+    figures = set()
+    for reference in parser.references:
+        url = urlsplit(reference)
+        if url.scheme or url.netloc:  # e.g. "data:" or "https:", not a local file
+            continue
+        rel_path = os.path.normpath(unquote(url.path))
+        if rel_path.startswith("..") or os.path.isabs(rel_path):
+            continue
+        if os.path.isfile(os.path.join(path, rel_path)):
+            figures.add(rel_path)
+    return figures
+
+
+def find_reports_and_figures(path):
+    """Walk the output once to find the html reports and all figures.
+
+    Args:
+        path (str): where the BIDS App put its html reports
+
+    Returns:
+        html_files (list of str): names of html files at the top of path
+        figures (list of str): paths relative to path of every file in a
+            "figures" directory
+    """
+
+    html_files = []
+    figures = []
+    for root, dirs, files in os.walk(path):
+        rel_root = os.path.relpath(root, path)
+        if rel_root == ".":
+            html_files = sorted(name for name in files if name.endswith(".html"))
+        if "figures" in Path(rel_root).parts:
+            figures.extend(
+                os.path.relpath(os.path.join(root, name), path) for name in files
+            )
+        elif "figures" in dirs:
+            figures_path = os.path.relpath(os.path.join(root, "figures"), path)
+            log.info(f"including {figures_path}")
+
+    return html_files, sorted(figures)
+
+
+class SharedFigures:
+    """Compress figures, only once for figures that are in several reports.
+
+    Only figures that more than one report refers to are kept (in memory)
+    after they are written, and only until the last report that needs them
+    has been written, so memory does not grow with the number of reports.
+
+    Args:
+        report_figures (dict): html file name: figures it refers to
+    """
+
+    def __init__(self, report_figures):
+        self.remaining = Counter(
+            rel_path for figures in report_figures.values() for rel_path in figures
+        )
+        self.shared = {rel_path for rel_path, n in self.remaining.items() if n > 1}
+        self.entries = {}  # rel_path: ZipEntry of a shared figure
+        self._lock = threading.Lock()
+
+    def prepare(self, path, rel_path):
+        """Compress a figure, or get it if it has already been compressed.
+
+        This runs in the worker threads.
+
+        Args:
+            path (str): where the BIDS App put its html reports
+            rel_path (str): the figure, relative to path
+
+        Returns:
+            entry (ZipEntry)
+        """
+
+        with self._lock:
+            entry = self.entries.get(rel_path)
+        if entry is not None:
+            return entry
+        full_path = os.path.join(path, rel_path)
+        if rel_path not in self.shared:
+            return prepare_entry(full_path, rel_path)
+        entry = prepare_shared_entry(full_path, rel_path)
+        with self._lock:
+            self.entries[rel_path] = entry
+        return entry
 
-def zip_it_zip_it_good(output_dir, destination_id, name, path):
+    def written(self, rel_paths):
+        """Forget shared figures that no other report needs.
+
+        Args:
+            rel_paths (list of str): figures of a report that has been written
+        """
+
+        with self._lock:
+            for rel_path in rel_paths:
+                self.remaining[rel_path] -= 1
+                if self.remaining[rel_path] < 1:
+                    self.entries.pop(rel_path, None)
+
+
+def zip_it_zip_it_good(
+    output_dir, destination_id, path, name, figures, shared, n_workers=None
+):
     """Compress html file into an appropriately named archive file *.html.zip
     files are automatically shown in another tab in the browser. These are
-    saved at the top level of the output folder."""
+    saved at the top level of the output folder.
+
+    The html file is saved in the archive as "index.html".  The figures are
+    compressed by n_workers threads, only a few at a time, and figures other
+    reports use too are compressed only once.
+
+    Args:
+        output_dir (Path): where to save the archive
+        destination_id (str): ID of the destination, used in the archive name
+        path (Path): where the BIDS App put its html reports
+        name (str): name of the html file
+        figures (list of str): the figures it refers to, relative to path
+        shared (SharedFigures): compresses the figures
+        n_workers (int): number of threads, default is number of cpus
+
+    Returns:
+        dest_zip (str): path of the archive
+    """
 
     name_no_html = name[:-5]  # remove ".html" from end
 
@@ -24,70 +187,114 @@ def zip_it_zip_it_good(output_dir, destination_id, name, path):
 
     log.debug('Creating viewable archive "' + dest_zip + '"')
 
-    command = ["zip", "-q", "-r", dest_zip, "index.html"]
-
-    # find all directories called 'figures' and add them to the archive
-    for root, dirs, files in os.walk(path):
-        for name in dirs:
-            if name == "figures":
-                figures_path = root.split("/")[-1] + "/figures"
-                command.append(figures_path)
-                log.info(f"including {figures_path}")
+    def prepare(rel_path, arcname):
+        if arcname == "index.html":
+            return prepare_entry(os.path.join(path, rel_path), arcname)
+        return shared.prepare(path, rel_path)
 
-    # log command as a string separated by spaces
-    log.debug(f"pwd = %s", Path.cwd())
-    log.debug(" ".join(command))
+    items = [(name, "index.html")] + [(rel_path, rel_path) for rel_path in figures]
+    n_workers = n_workers or os.cpu_count() or 1
+    with ParallelZipFile(dest_zip, n_workers=n_workers) as outzip:
+        for entry in prepare_entries(items, n_workers, prepare=prepare):
+            outzip.write_entry(entry)
+    shared.written(figures)
 
-    result = sp.run(command, check=True)
+    return dest_zip
 
 
-def zip_htmls(output_dir, destination_id, path):
+def zip_htmls(output_dir, destination_id, path, n_workers=None):
     """Zip all .html files at the given path so they can be displayed
     on the Flywheel platform.
-    Each html file must be converted into an archive individually:
-      rename each to be "index.html", then create a zip archive from it.
-    """
-
-    log.info("Creating viewable archives for all html files")
 
-    if os.path.exists(path):
+    Each html file is put into its own archive as "index.html" along with only
+    the figures it refers to (so a subject's report does not carry every other
+    subject's figures).  The output is walked only once and a figure that is
+    in several archives is compressed only once.  Archives are built one after
+    another, each using n_workers threads.
 
-        log.debug("Found path: " + str(path))
+    Args:
+        output_dir (Path): where to save the archives
+        destination_id (str): ID of the destination, used in the archive names
+        path (Path): where the BIDS App put its html reports
+        n_workers (int): number of threads, default is number of cpus
 
-        os.chdir(path)
+    Returns:
+        sizes (dict): "archives" maps each archive name to its size in bytes,
+            "total bytes" is their sum and "figure bytes left out" is how much
+            bigger (before compression) they would have been if every archive
+            had all figures.  Empty if no archives were made.
+    """
 
-        html_files = glob.glob("*.html")
+    log.info("Creating viewable archives for all html files")
 
-        if len(html_files) > 0:
+    if not os.path.exists(path):
+        log.error("Path NOT found: " + str(path))
+        return {}
 
-            # if there is an index.html, do it first and re-name it for safe
-            # keeping
-            save_name = ""
-            if os.path.exists("index.html"):
-                log.info("Found index.html")
-                zip_it_zip_it_good(output_dir, destination_id, "index.html", path)
+    log.debug("Found path: " + str(path))
 
-                now = datetime.datetime.now()
-                save_name = now.strftime("%Y-%m-%d_%H-%M-%S") + "_index.html"
-                os.rename("index.html", save_name)
+    html_files, figures = find_reports_and_figures(path)
 
-                html_files.remove("index.html")  # don't do this one later
+    if len(html_files) == 0:
+        log.warning("No *.html files at " + str(path))
+        return {}
 
-            for h_file in html_files:
-                log.info("Found %s", h_file)
-                os.rename(h_file, "index.html")
-                zip_it_zip_it_good(output_dir, destination_id, h_file, path)
-                os.rename("index.html", h_file)
+    report_figures = {}
+    for h_file in html_files:
+        log.info("Found %s", h_file)
+        referenced = find_referenced_figures(path, h_file)
+        if not referenced and figures:
+            log.warning(
+                "No figure references found in %s, including all figures", h_file
+            )
+            referenced = set(figures)
+        report_figures[h_file] = sorted(referenced)
+        log.debug("%s refers to %d figures", h_file, len(referenced))
 
-            # restore if necessary
-            if save_name != "":
-                os.rename(save_name, "index.html")
+    needed = sorted(set().union(*report_figures.values()))
+    figure_sizes = {
+        rel_path: os.path.getsize(os.path.join(path, rel_path))
+        for rel_path in set(figures).union(needed)
+    }
+    all_figures_bytes = sum(figure_sizes[rel_path] for rel_path in figures)
 
-        else:
-            log.warning("No *.html files at " + str(path))
+    shared = SharedFigures(report_figures)
+    dest_zips = [
+        zip_it_zip_it_good(
+            output_dir,
+            destination_id,
+            path,
+            h_file,
+            report_figures[h_file],
+            shared,
+            n_workers,
+        )
+        for h_file in html_files
+    ]
 
-    else:
+    sizes = {
+        "archives": {
+            os.path.basename(dest_zip): os.path.getsize(dest_zip)
+            for dest_zip in dest_zips
+        },
+        "figure bytes left out": sum(
+            all_figures_bytes
+            - sum(figure_sizes[rel_path] for rel_path in report_figures[h_file])
+            for h_file in html_files
+        ),
+    }
+    sizes["total bytes"] = sum(sizes["archives"].values())
 
-        log.error("Path NOT found: " + str(path))
+    for name, size in sizes["archives"].items():
+        log.info("%s is %.1f MiB", name, size / 1024**2)
+    log.info(
+        "Created %d viewable archives (%.1f MiB) with %d of %d figures, "
+        "%.1f MiB of figures not duplicated across reports",
+        len(html_files),
+        sizes["total bytes"] / 1024**2,
+        len(needed),
+        len(figures),
+        sizes["figure bytes left out"] / 1024**2,
+    )
 
-    os.chdir(FWV0)
+    return sizes
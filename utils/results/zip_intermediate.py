@@ -2,15 +2,76 @@
 
 import logging
 import os
-import shutil
 from pathlib import Path
-from zipfile import ZIP_DEFLATED, ZipFile
 
-FWV0 = Path.cwd()
+from .parallel_zip import ParallelZipFile
+from .pattern_index import PatternIndex
+from .work_archive import archive_work_dir
+
 log = logging.getLogger(__name__)
 
 
-def zip_selected(root_dir, dir_name, output_filename, selected_files, selected_dirs):
+def find_selected(root_dir, dir_name, selected_files, selected_dirs):
+    """Walk dir_name once and find the files that are selected.
+
+    A file is selected if it matches one of selected_files or if the directory
+    it is in matches one of selected_dirs.  Directories are matched once, not
+    once for each file in them.
+
+    Args:
+        root_dir (Path) path to dir_name
+        dir_name (str) name of directory to find selected files/directories
+        selected_files (list) file names or partial paths to files
+        selected_dirs (list) dir names or partial paths to dirs
+
+    Yields:
+        path (str), arcname (str), size (int), patterns (list of str) that matched
+    """
+
+    file_index = PatternIndex(selected_files)
+    dir_index = PatternIndex(selected_dirs)
+
+    stack = [(os.path.join(root_dir, dir_name), (dir_name,))]
+    while stack:
+        dir_path, dir_parts = stack.pop()
+        dir_matched = dir_index.match(dir_parts)
+        try:
+            entries = sorted(os.scandir(dir_path), key=lambda entry: entry.name)
+        except OSError as exc:
+            log.warning("Could not look in %s: %s", dir_path, exc)
+            continue
+        subdirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            parts = dir_parts + (entry.name,)
+            if is_dir:
+                if not entry.is_symlink():  # like os.walk(), don't follow links
+                    subdirs.append((entry.path, parts))
+                continue
+            matched = file_index.match(parts) or dir_matched
+            if not matched:
+                continue
+            try:
+                size = entry.stat().st_size
+            except OSError as exc:
+                log.warning("Could not zip %s: %s", "/".join(parts), exc)
+                continue
+            yield entry.path, "/".join(parts), size, matched
+        stack.extend(reversed(subdirs))
+
+
+def zip_selected(
+    root_dir,
+    dir_name,
+    output_filename,
+    selected_files,
+    selected_dirs,
+    n_workers=None,
+    list_only=False,
+):
     """Zip selected files and directories into output_filename.
 
     The resulting zip file will unzip into directory dir_name and will maintain the
@@ -29,45 +90,63 @@ def zip_selected(root_dir, dir_name, output_filename, selected_files, selected_d
         output_filename (Path) path and name of zip file to save
         selected_files (list) file names or partial paths to files
         selected_dirs (list) dir names or partial paths to dirs
-    """
+        n_workers (int) number of compressing threads, default is number of cpus
+        list_only (bool) only report what would be zipped, don't make the archive
 
-    os.chdir(root_dir)
+    Returns:
+        stats (dict) number of "files" and "bytes" selected in total and
+            for each pattern
+    """
 
     if Path(output_filename).exists():
         Path(output_filename).unlink()
 
-    files_found = []
-    dirs_found = []
-    with ZipFile(output_filename, "w", ZIP_DEFLATED) as outzip:
-        for root, subdirs, files in os.walk(dir_name):
-            for fl in files:
-                matched = False
-                file_path = Path(root) / fl
-                if fl in selected_files:
-                    matched = True
-                    files_found.append(fl)
-                else:
-                    for sel in selected_files:
-                        if file_path.match(sel):
-                            matched = True
-                            files_found.append(sel)
-                if not matched:
-                    for sel in selected_dirs:
-                        if Path(root).match(sel):
-                            dirs_found.append(sel)
-                            matched = True
-                if matched:
-                    log.info("Zipping %s", file_path)
-                    outzip.write(file_path)
-
-    for sel in selected_files:
-        if sel not in files_found:
-            log.warning("Looked for %s but could not find it.", sel)
-    for sel in selected_dirs:
-        if sel not in dirs_found:
+    stats = {"files": 0, "bytes": 0, "patterns": {}}
+    for sel in list(selected_files) + list(selected_dirs):
+        stats["patterns"][sel] = {"files": 0, "bytes": 0}
+
+    items = []
+    for path, arcname, size, matched in find_selected(
+        root_dir, dir_name, selected_files, selected_dirs
+    ):
+        log.debug("Zipping %s", arcname)
+        stats["files"] += 1
+        stats["bytes"] += size
+        for sel in matched:
+            stats["patterns"][sel]["files"] += 1
+            stats["patterns"][sel]["bytes"] += size
+        items.append((path, arcname))
+
+    for sel, found in stats["patterns"].items():
+        if found["files"] == 0:
             log.warning("Looked for %s but could not find it.", sel)
+        elif list_only:
+            log.info(
+                "%s matches %d files, %.1f MiB",
+                sel,
+                found["files"],
+                found["bytes"] / 1024**2,
+            )
+
+    if list_only:
+        log.info(
+            "Would zip %d files, %.1f MiB, into %s",
+            stats["files"],
+            stats["bytes"] / 1024**2,
+            output_filename,
+        )
+        return stats
+
+    with ParallelZipFile(output_filename, n_workers) as outzip:
+        outzip.write_paths(items)
+    log.info(
+        "Zipped %d files, %.1f MiB, into %s",
+        stats["files"],
+        stats["bytes"] / 1024**2,
+        output_filename,
+    )
 
-    os.chdir(FWV0)  # Get back to where you once belonged
+    return stats
 
 
 def zip_intermediate_selected(
@@ -78,6 +157,8 @@ def zip_intermediate_selected(
     output_dir,
     work_dir,
     run_label,
+    n_workers=None,
+    list_only=False,
 ):
     """Zip the listed files and folders in work/.
 
@@ -89,6 +170,8 @@ def zip_intermediate_selected(
         output_dir (str) path to where output will be written
         work_dir (str) path to temporary directory
         run_label (str) name of run to use in zip file name
+        n_workers (int) number of compressing threads, default is number of cpus
+        list_only (bool) only report what would be zipped, don't make the archive
     """
 
     do_find = False
@@ -113,34 +196,64 @@ def zip_intermediate_selected(
         dest_zip = os.path.join(output_dir, file_name)
 
         log.info('Files and folders will be zipped to "' + dest_zip + '"')
-        zip_selected(work_dir.parents[0], work_dir.name, dest_zip, files, folders)
+        zip_selected(
+            work_dir.parents[0],
+            work_dir.name,
+            dest_zip,
+            files,
+            folders,
+            n_workers=n_workers,
+            list_only=list_only,
+        )
 
     else:
         log.debug("No files or folders specified in config to zip")
 
 
 def zip_all_intermediate_output(
-    destination_id, gear_name, output_dir, work_dir, run_label
+    destination_id,
+    gear_name,
+    output_dir,
+    work_dir,
+    run_label,
+    n_workers=None,
+    volume_gb=0,
+    policy="everything",
 ):
     """Zip all intermediate output in the "work/ directory into one archive.
 
+    If the archive would be bigger than volume_gb, it is split into volumes
+    that are each a complete archive: *_vol2.zip, *_vol3.zip, etc.
+
     Args:
         destination_id (str) ID of analysis container that is the destination of the gear
         gear_name (str) name of gear from manifest "name"
         output_dir (str) path to where output will be written
         work_dir (str) path to temporary directory
         run_label (str) name of run to use in zip file name
+        n_workers (int) number of compressing threads, default is number of cpus
+        volume_gb (float) maximum size of each volume, 0 for no limit
+        policy (str) what to leave out, a key of work_archive.POLICIES
+
+    Returns:
+        stats (dict) what was stored, linked and left out
     """
 
     # Name of zip file has <subject> and <analysis>
-    file_name = f"{gear_name}_work_{run_label}_{destination_id}"
+    file_name = f"{gear_name}_work_{run_label}_{destination_id}.zip"
     dest_zip = os.path.join(output_dir, file_name)
 
     work_path, work_dir = os.path.split(work_dir)
-    os.chdir(work_path)
 
     log.info("Zipping " + work_dir + " directory to " + dest_zip + ".")
 
-    shutil.make_archive(dest_zip, "zip", work_path, work_dir)
+    volumes, stats = archive_work_dir(
+        work_path,
+        work_dir,
+        dest_zip,
+        n_workers=n_workers,
+        volume_gb=volume_gb,
+        policy=policy,
+    )
 
-    os.chdir(FWV0)
+    return stats
@@ -0,0 +1,162 @@
+"""Decide whether and how to run the BIDS App again after it fails.
+
+Running the same command again after it ran out of memory or out of time
+usually fails the same way, so the failure is classified first:
+
+- "oom": killed because memory ran out (SIGKILL plus a cgroup OOM kill or a
+  kernel OOM message, or a MemoryError or broken process pool in the output)
+- "memory cap": nipype refused to run a step that needs more than --mem
+- "timeout": stopped by "timeout" (exit status 124)
+- "killed": stopped by some other signal, e.g. the job is being cancelled
+- "error": anything else
+
+and then the next try gets fewer threads and --low-mem, a bigger memory cap, or
+is not run at all.  The work directory is kept so finished steps are not re-run.
+"""
+
+import logging
+import re
+import subprocess as sp
+
+log = logging.getLogger(__name__)
+
+TIMEOUT_STATUS = 124  # what "timeout" returns when the time runs out
+SIGKILL_STATUS = 128 + 9
+
+CGROUP_MEMORY_EVENTS = [
+    "/sys/fs/cgroup/memory.events",  # cgroup v2
+    "/sys/fs/cgroup/memory/memory.oom_control",  # cgroup v1
+]
+KERNEL_OOM = re.compile(r"Out of memory|oom-kill|Killed process", re.IGNORECASE)
+OUTPUT_OOM = re.compile(r"MemoryError|Cannot allocate memory|BrokenProcessPool")
+OUTPUT_MEMORY_CAP = re.compile(r"Insufficient resources available for job")
+
+
+def read_oom_kills():
+    """Number of processes the kernel has killed in this cgroup for memory.
+
+    Returns:
+        count (int) or None if it can't be found
+    """
+
+    for path in CGROUP_MEMORY_EVENTS:
+        try:
+            with open(path) as fp:
+                for line in fp:
+                    name, _, value = line.partition(" ")
+                    if name == "oom_kill":
+                        return int(value)
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def count_kernel_oom_messages():
+    """Number of out of memory messages in the kernel ring buffer.
+
+    Returns:
+        count (int) or None if dmesg can't be read (usually not allowed)
+    """
+
+    try:
+        result = sp.run(
+            ["dmesg"], stdout=sp.PIPE, stderr=sp.DEVNULL, timeout=10, check=True
+        )
+    except (OSError, sp.SubprocessError):
+        return None
+    return len(KERNEL_OOM.findall(result.stdout.decode(errors="replace")))
+
+
+class FailureProbe:
+    """Remember the OOM counters before a try so they can be compared after."""
+
+    def __init__(self):
+        self.oom_kills = read_oom_kills()
+        self.kernel_ooms = count_kernel_oom_messages()
+
+    def classify(self, returncode, output=""):
+        """Figure out why the command failed.
+
+        Args:
+            returncode (int): exit status, 128 + N if killed by signal N
+            output (str): the end of what the command wrote
+
+        Returns:
+            failure (str): "oom", "memory cap", "timeout", "killed" or "error"
+            evidence (str): why
+        """
+
+        if returncode == TIMEOUT_STATUS:
+            return "timeout", f"exit status {TIMEOUT_STATUS} from timeout"
+
+        oom_kills = read_oom_kills()
+        if None not in (oom_kills, self.oom_kills) and oom_kills > self.oom_kills:
+            return "oom", f"{oom_kills - self.oom_kills} cgroup OOM kill(s)"
+
+        if returncode == SIGKILL_STATUS:
+            kernel_ooms = count_kernel_oom_messages()
+            if None not in (kernel_ooms, self.kernel_ooms) and (
+                kernel_ooms > self.kernel_ooms
+            ):
+                return "oom", "killed and kernel OOM message"
+
+        match = OUTPUT_OOM.search(output)
+        if match:
+            return "oom", f'"{match.group(0)}" in output'
+
+        match = OUTPUT_MEMORY_CAP.search(output)
+        if match:
+            return "memory cap", f'"{match.group(0)}" in output'
+
+        if returncode > 128:
+            return "killed", f"killed by signal {returncode - 128}"
+
+        return "error", f"exit status {returncode}"
+
+
+def plan_retry(failure, config, available_mem_mb):
+    """Change the config for the next try, if it is worth trying again.
+
+    Args:
+        failure (str): as returned by FailureProbe.classify(), "watchdog" if
+            RunWatchdog stopped it or "deadline" if it ran out of time
+        config (dict): run-time options, "n_cpus", "omp-nthreads", "mem" and
+            "low-mem" are changed as needed
+        available_mem_mb (int): the most memory --mem can be
+
+    Returns:
+        decision (str): what was changed for the next try, or why not to try again
+        retry (bool): True to try again
+    """
+
+    if failure == "oom":
+        if config["n_cpus"] > 1 or not config.get("low-mem"):
+            config["n_cpus"] = max(1, config["n_cpus"] // 2)
+            config["omp-nthreads"] = min(config["omp-nthreads"], config["n_cpus"])
+            config["low-mem"] = True
+            return (
+                f"use n_cpus={config['n_cpus']}, "
+                f"omp-nthreads={config['omp-nthreads']} and --low-mem",
+                True,
+            )
+        return "nothing left to lower after running out of memory", False
+
+    if failure == "memory cap":
+        if config["mem"] < available_mem_mb:
+            config["mem"] = available_mem_mb
+            return f"raise --mem to {available_mem_mb} MB", True
+        return "--mem is already all available memory", False
+
+    if failure == "watchdog":
+        return "it would stall or crash the same way again", False
+
+    if failure == "deadline":
+        return "no time is left, what was done is saved to resume from", False
+
+    if failure == "timeout":
+        return "the time limit applies to each try so it would time out again", False
+
+    if failure == "killed":
+        return "it was stopped from outside the gear", False
+
+    return "try again unchanged", True
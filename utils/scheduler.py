@@ -0,0 +1,237 @@
+"""Run fMRIPrep on several participants at the same time.
+
+Instead of one fMRIPrep process for all participants (where nipype interleaves
+them under one --mem limit and one heavy participant can hold up the others),
+each participant gets its own fMRIPrep process with its own
+--participant-label, work directory, output directory and share of the cpus and
+memory.  Participants are started biggest first (by the size of their images)
+whenever a slot is free, which packs them into the slots so all of the slots
+finish at about the same time.  When a participant's process ends, its output
+is moved into the normal output/<destination_id> directory.
+"""
+
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .command import CommandFailed, run_command
+from .fly.set_performance_config import set_mem_mb, set_n_cpus
+
+log = logging.getLogger(__name__)
+
+# Don't start more participants at once than leaves each at least this much
+MIN_CPUS_PER_PARTICIPANT = 4
+MIN_MEM_MB_PER_PARTICIPANT = 8000
+
+
+def find_participants(bids_dir):
+    """Find participants in a BIDS directory and estimate how much work each is.
+
+    Args:
+        bids_dir (Path): the downloaded BIDS data
+
+    Returns:
+        costs (dict): participant label (without "sub-"): bytes of images
+    """
+
+    costs = {}
+    for sub_dir in sorted(Path(bids_dir).glob("sub-*")):
+        if not sub_dir.is_dir():
+            continue
+        size = 0
+        for root, _, files in os.walk(sub_dir):
+            for name in files:
+                if name.endswith((".nii", ".nii.gz")):
+                    size += os.path.getsize(os.path.join(root, name))
+        costs[sub_dir.name[len("sub-") :]] = size
+    return costs
+
+
+def find_finished_participants(output_dir):
+    """Participants fMRIPrep has finished, they have an HTML report.
+
+    Args:
+        output_dir (Path): fMRIPrep's output directory (output/<destination_id>)
+
+    Returns:
+        labels (list of str): participant labels (without "sub-")
+    """
+
+    return sorted(
+        path.name[len("sub-") : -len(".html")]
+        for path in Path(output_dir).glob("*/sub-*.html")
+    )
+
+
+def number_of_slots(n_participants, requested, n_cpus, mem_mb):
+    """How many participants to run at the same time.
+
+    Args:
+        n_participants (int): number of participants
+        requested (int): from config, 0 means as many as resources allow
+        n_cpus (int): cpus for all of them
+        mem_mb (int): memory for all of them
+
+    Returns:
+        slots (int)
+    """
+
+    if requested == 0:
+        requested = min(
+            n_cpus // MIN_CPUS_PER_PARTICIPANT, mem_mb // MIN_MEM_MB_PER_PARTICIPANT
+        )
+    return max(1, min(requested, n_participants, n_cpus))
+
+
+def share_resources(config, slots):
+    """Split the cpus and memory between participants running at the same time.
+
+    Args:
+        config (dict): run-time options with "n_cpus", "omp-nthreads" and "mem"
+        slots (int): number of participants running at the same time
+
+    Returns:
+        n_cpus (int), omp_nthreads (int), mem_mb (int) for each participant
+    """
+
+    n_cpus, omp_nthreads = set_n_cpus(
+        max(1, config["n_cpus"] // slots),
+        max(1, min(config["omp-nthreads"], config["n_cpus"] // slots)),
+    )
+    mem_mb = set_mem_mb(int(config["mem"] // slots))
+    return n_cpus, omp_nthreads, mem_mb
+
+
+def merge_output(src, dest):
+    """Move everything in src into dest, replacing files that are already there.
+
+    Args:
+        src (Path): a participant's output directory
+        dest (Path): the output directory for everyone
+    """
+
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        dest_root = os.path.normpath(os.path.join(dest, rel_root))
+        os.makedirs(dest_root, exist_ok=True)
+        for name in list(dirs):
+            if not os.path.lexists(os.path.join(dest_root, name)):
+                # move the whole directory at once
+                os.replace(os.path.join(root, name), os.path.join(dest_root, name))
+                dirs.remove(name)
+        for name in files:
+            dest_path = os.path.join(dest_root, name)
+            if os.path.isdir(dest_path) and not os.path.islink(dest_path):
+                shutil.rmtree(dest_path)
+            shutil.move(os.path.join(root, name), dest_path)
+    shutil.rmtree(src)
+
+
+class ParticipantScheduler:
+    """Run one fMRIPrep process for each participant, several at a time.
+
+    Args:
+        costs (dict): participant label: estimated cost, from find_participants()
+        slots (int): number of participants to run at the same time
+        base_dir (Path): where to put each participant's work and output
+            directories
+        output_dir (Path): where all of the output goes in the end
+    """
+
+    def __init__(self, costs, slots, base_dir, output_dir):
+        self.costs = costs
+        self.slots = slots
+        self.base_dir = Path(base_dir)
+        self.output_dir = Path(output_dir)
+        self.finished = []  # labels of participants that have run successfully
+        self._lock = threading.Lock()
+
+    def work_dir(self, label):
+        """The work directory for a participant."""
+
+        return self.base_dir / f"sub-{label}" / "work"
+
+    def participant_output_dir(self, label):
+        """Where a participant's fMRIPrep process writes its output."""
+
+        return self.base_dir / f"sub-{label}" / "output"
+
+    def run(self, make_command, environ, log_file=None, watchdog=None):
+        """Run every participant that has not finished yet.
+
+        Args:
+            make_command (function): given a label, a work directory and an
+                output directory, returns the command to run for that participant
+            environ (dict): environment variables for the commands
+            log_file (str): if given, save each participant's output in this
+                file (formatted with the label) instead of printing it
+            watchdog (RunWatchdog): watches all of the participants' commands
+
+        Raises:
+            CommandFailed: if any participant failed, with the largest exit
+                status of any of them and the end of their stderr
+        """
+
+        todo = sorted(
+            (label for label in self.costs if label not in self.finished),
+            key=lambda label: self.costs[label],
+            reverse=True,
+        )
+        log.info(
+            "Running %d participants, %d at a time, biggest first: %s",
+            len(todo),
+            self.slots,
+            ", ".join(
+                f"{label} ({self.costs[label] / 1024**2:.0f} MiB)" for label in todo
+            ),
+        )
+
+        failures = {}
+        with ThreadPoolExecutor(
+            max_workers=self.slots, thread_name_prefix="participant"
+        ) as executor:
+            futures = {
+                label: executor.submit(
+                    self._run_one, label, make_command, environ, log_file, watchdog
+                )
+                for label in todo
+            }
+            for label, future in futures.items():
+                exc = future.exception()
+                if exc is not None:
+                    failures[label] = exc
+
+        if failures:
+            log.error("Participants that failed: %s", ", ".join(sorted(failures)))
+            returncode = max(getattr(exc, "returncode", 1) for exc in failures.values())
+            stderr = "".join(
+                f"[sub-{label}] {getattr(exc, 'stderr', str(exc))}\n"
+                for label, exc in sorted(failures.items())
+            )
+            raise CommandFailed(sorted(failures), returncode, stderr)
+
+    def _run_one(self, label, make_command, environ, log_file, watchdog):
+        work_dir = self.work_dir(label)
+        output_dir = self.participant_output_dir(label)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        command = make_command(label, work_dir, output_dir)
+        try:
+            run_command(
+                command,
+                environ=environ,
+                shell=True,
+                prefix=f"[sub-{label}] ",
+                log_file=log_file.format(label=label) if log_file else None,
+                watchdog=watchdog,
+            )
+        finally:
+            # keep whatever it made, even if it failed, like a single run would
+            with self._lock:
+                merge_output(output_dir, self.output_dir)
+        with self._lock:
+            self.finished.append(label)
+        log.info("Participant sub-%s finished", label)
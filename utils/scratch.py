@@ -0,0 +1,251 @@
+"""Put the work directory on the fastest scratch space that can hold it.
+
+fMRIPrep's nipype work directory gets many GB and hundreds of thousands of
+small files, so it runs much faster on local NVMe or memory (tmpfs) than on
+network storage, which is where the gear's directory often is when it runs on
+an HPC cluster.  The candidates are the gear's own directory, the directories
+in gear-scratch-dirs, $TMPDIR, /dev/shm and /local*.  Each one that is writable
+is probed: free space, writing a file sequentially (with fsync) and creating,
+looking at and removing small files.  The work directory goes on the candidate
+that would be quickest for a work directory of the needed size and that has
+room for it, as a symbolic link from work/.
+
+Files on a tmpfs are kept in memory, so a tmpfs is only used if the work
+directory fits in the memory fMRIPrep is not going to use.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CANDIDATES = ["/dev/shm", "/local*"]
+WORK_PREFIX = "gear-work-"
+PROBE_BYTES = 32 * 1024**2  # written sequentially to measure the speed
+PROBE_BLOCK = 1024**2
+PROBE_FILES = 200  # small files created, looked at and removed
+PROBE_FILE_BYTES = 4096
+FILES_PER_GB = 2000  # about how many files nipype writes per GB of work dir
+HEADROOM = 1.2  # the work directory may be bigger than estimated
+MEMORY_FS = {"tmpfs", "ramfs"}
+MIN_SPEEDUP = 1.5  # how much quicker another place has to be to move there
+
+
+def find_candidates(here, configured=None, environ=None):
+    """Directories the work directory could be put in.
+
+    Only the first one on each file system is kept, so if $TMPDIR is on the
+    same disk as the gear's directory, the work directory stays where it is.
+
+    Args:
+        here (Path): the directory work/ is in
+        configured (list of str): directories from gear-scratch-dirs
+        environ (dict): environment variables, default os.environ
+
+    Returns:
+        candidates (list of Path): writable directories, "here" first
+    """
+
+    environ = os.environ if environ is None else environ
+    names = [str(here)] + list(configured or [])
+    if environ.get("TMPDIR"):
+        names.append(environ["TMPDIR"])
+    for pattern in DEFAULT_CANDIDATES:
+        if "*" in pattern:
+            names.extend(sorted(str(path) for path in Path("/").glob(pattern[1:])))
+        else:
+            names.append(pattern)
+
+    candidates = []
+    devices = set()
+    for name in names:
+        path = Path(name)
+        try:
+            device = path.stat().st_dev
+        except OSError:
+            continue
+        if not path.is_dir() or not os.access(path, os.W_OK | os.X_OK):
+            continue
+        if device not in devices:
+            devices.add(device)
+            candidates.append(path)
+    return candidates
+
+
+def filesystem_type(path):
+    """Type of the file system a path is on, e.g. "ext4", "nfs" or "tmpfs"."""
+
+    real = os.path.realpath(path)
+    best = ""
+    fstype = "unknown"
+    try:
+        partitions = psutil.disk_partitions(all=True)
+    except OSError:
+        return fstype
+    for partition in partitions:
+        mount = partition.mountpoint
+        inside = real == mount or real.startswith(mount.rstrip("/") + "/")
+        if inside and len(mount) > len(best):
+            best = mount
+            fstype = partition.fstype
+    return fstype
+
+
+def probe(path, probe_bytes=PROBE_BYTES, probe_files=PROBE_FILES):
+    """Measure the free space and speed of a directory.
+
+    Args:
+        path (Path): directory to measure
+        probe_bytes (int): size of the file to write
+        probe_files (int): number of small files to create and remove
+
+    Returns:
+        measurements (dict): "free GB", "write MB/s", "file ops/s" and "file
+            system", or None if it could not be written to
+    """
+
+    try:
+        free = shutil.disk_usage(path).free
+        probe_dir = tempfile.mkdtemp(prefix=WORK_PREFIX + "probe-", dir=path)
+    except OSError as exc:
+        log.debug("Could not probe %s: %s", path, exc)
+        return None
+    block = os.urandom(PROBE_BLOCK)
+    try:
+        start = time.perf_counter()
+        with open(os.path.join(probe_dir, "sequential"), "wb") as fp:
+            for _ in range(max(1, probe_bytes // PROBE_BLOCK)):
+                fp.write(block)
+            fp.flush()
+            os.fsync(fp.fileno())
+        write_seconds = time.perf_counter() - start
+
+        small = block[:PROBE_FILE_BYTES]
+        start = time.perf_counter()
+        for number in range(probe_files):
+            name = os.path.join(probe_dir, f"small{number}")
+            with open(name, "wb") as fp:
+                fp.write(small)
+            os.stat(name)
+        for number in range(probe_files):
+            os.unlink(os.path.join(probe_dir, f"small{number}"))
+        file_seconds = time.perf_counter() - start
+    except OSError as exc:
+        log.debug("Could not probe %s: %s", path, exc)
+        return None
+    finally:
+        shutil.rmtree(probe_dir, ignore_errors=True)
+
+    return {
+        "free GB": round(free / 1024**3, 1),
+        "write MB/s": round(probe_bytes / 1024**2 / max(write_seconds, 1e-6), 1),
+        "file ops/s": round(probe_files * 3 / max(file_seconds, 1e-6)),
+        "file system": filesystem_type(path),
+    }
+
+
+def seconds_for(measurements, work_gb):
+    """About how long writing a work directory of this size would take."""
+
+    write_seconds = work_gb * 1024 / max(measurements["write MB/s"], 1e-6)
+    file_seconds = work_gb * FILES_PER_GB * 3 / max(measurements["file ops/s"], 1e-6)
+    return write_seconds + file_seconds
+
+
+def choose_scratch(measured, work_gb, spare_memory_gb):
+    """Pick the candidate that would be quickest and has room.
+
+    The first candidate (where the work directory is) is kept unless another
+    would be MIN_SPEEDUP times quicker, so it isn't moved because of noise in
+    the measurements.
+
+    Args:
+        measured (dict): candidate path: what probe() found (or None), the
+            first is where the work directory is now
+        work_gb (float): estimated size of the work directory
+        spare_memory_gb (float): memory fMRIPrep won't use, the most a tmpfs
+            may hold
+
+    Returns:
+        path: the chosen candidate, or None if none has room
+        reasons (dict): candidate path: why it was not chosen
+    """
+
+    needed = work_gb * HEADROOM
+    first = next(iter(measured), None)
+    best = best_seconds = None
+    reasons = {}
+    for path, measurements in measured.items():
+        if measurements is None:
+            reasons[path] = "not writable"
+            continue
+        if measurements["free GB"] < needed:
+            reasons[path] = f"{measurements['free GB']} GB free, need {needed:.0f}"
+            continue
+        if measurements["file system"] in MEMORY_FS and spare_memory_gb < needed:
+            reasons[path] = f"in memory, only {spare_memory_gb:.0f} GB to spare"
+            continue
+        seconds = seconds_for(measurements, work_gb)
+        if path == first:
+            seconds /= MIN_SPEEDUP
+        if best is None or seconds < best_seconds:
+            if best is not None:
+                reasons[best] = "slower"
+            best, best_seconds = path, seconds
+        else:
+            reasons[path] = "slower"
+    return best, reasons
+
+
+def place_work_dir(work_dir, configured=None, work_gb=0, spare_memory_gb=0):
+    """Move work/ to the best scratch space and link to it from where it was.
+
+    Args:
+        work_dir (Path): the gear's (empty) work directory
+        configured (list of str): directories from gear-scratch-dirs
+        work_gb (float): estimated size of the work directory
+        spare_memory_gb (float): memory fMRIPrep won't use
+
+    Returns:
+        placed (Path): the new work directory, to remove when done, or None
+            if it was left where it is
+        report (dict): measurements of each candidate and what was chosen
+    """
+
+    work_dir = Path(work_dir)
+    here = work_dir.parent
+    candidates = find_candidates(here, configured)
+    measured = {}
+    for candidate in candidates:
+        measured[candidate] = probe(candidate)
+        log.info("Scratch candidate %s: %s", candidate, measured[candidate])
+    chosen, reasons = choose_scratch(measured, work_gb, spare_memory_gb)
+    for path, reason in reasons.items():
+        log.info("Not putting the work directory in %s: %s", path, reason)
+
+    report = {
+        "candidates": [  # a list because metadata keys can't have dots
+            dict(value or {}, path=str(path)) for path, value in measured.items()
+        ],
+        "estimated work GB": work_gb,
+        "work dir": str(work_dir),
+    }
+    if chosen is None or chosen == here:
+        log.info("Keeping the work directory in %s", here)
+        return None, report
+    if work_dir.is_symlink() or any(work_dir.iterdir()):
+        log.info("Keeping the work directory where it is because it is not empty")
+        return None, report
+
+    placed = Path(tempfile.mkdtemp(prefix=WORK_PREFIX, dir=chosen))
+    work_dir.rmdir()
+    work_dir.symlink_to(placed)
+    report["work dir"] = str(placed)
+    log.info("Put the work directory in %s (%s)", placed, measured[chosen])
+    return placed, report
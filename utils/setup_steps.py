@@ -0,0 +1,116 @@
+"""Run the gear's setup steps at the same time when they don't depend on each other.
+
+Getting the FreeSurfer license (which may ask Flywheel), copying TemplateFlow
+templates, unzipping the inputs and downloading the BIDS data mostly wait on
+storage or the network, and only a few of them need another to finish first.
+Each step is started in a thread as soon as the steps it comes after have
+finished, so setup takes about as long as the slowest chain of steps instead of
+all of them added up.
+
+A step that raises an exception is logged and the exception is added to the
+gear's list of errors, as if it had been found one step after another.  Steps
+that come after it are not run.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+log = logging.getLogger(__name__)
+
+
+class SetupStep:
+    """Something to do to set up the gear.
+
+    Args:
+        name (str): what is being done, as it will be logged
+        function (callable): does it, called without arguments
+        after (list of str): names of steps that have to finish first
+    """
+
+    def __init__(self, name, function, after=None):
+        self.name = name
+        self.function = function
+        self.after = after or []
+
+
+def run_setup_steps(steps, errors, phases=None, n_workers=None):
+    """Run setup steps, each as soon as the steps it comes after have finished.
+
+    Args:
+        steps (list of SetupStep): the steps, in the order to start them if
+            they can start at the same time
+        errors (list): exceptions of steps that failed are added to this
+        phases (PhaseRecorder): records each step as a span if given
+        n_workers (int): number of steps to run at once, default is all of them
+
+    Returns:
+        results (dict): step name: what its function returned, for steps that
+            finished without an exception
+    """
+
+    start = time.monotonic()
+    names = {step.name for step in steps}
+    for step in steps:
+        for before in step.after:
+            if before not in names:
+                raise ValueError(f"Setup step {step.name} comes after {before}")
+
+    results = {}
+    failed = set()
+    running = {}  # name: time started
+    took = {}  # name: seconds
+    lock = threading.Lock()
+
+    def run(step):
+        with lock:
+            others = sorted(running)
+            running[step.name] = time.monotonic()
+        if others:
+            log.info("Setup: %s started while %s running", step.name, ", ".join(others))
+        else:
+            log.info("Setup: %s started", step.name)
+        try:
+            if phases:
+                with phases.span(step.name):
+                    return step.function()
+            return step.function()
+        finally:
+            with lock:
+                took[step.name] = time.monotonic() - running.pop(step.name)
+
+    waiting = list(steps)
+    with ThreadPoolExecutor(max_workers=n_workers or len(steps) or 1) as executor:
+        futures = {}
+        while waiting or futures:
+            for step in list(waiting):
+                if any(before in failed for before in step.after):
+                    waiting.remove(step)
+                    failed.add(step.name)
+                    log.error(
+                        "Setup: %s was not run because a step before it failed",
+                        step.name,
+                    )
+                elif all(before in results for before in step.after):
+                    waiting.remove(step)
+                    futures[executor.submit(run, step)] = step
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = futures.pop(future)
+                try:
+                    results[step.name] = future.result()
+                    log.info("Setup: %s took %.1f s", step.name, took[step.name])
+                except Exception as exc:
+                    failed.add(step.name)
+                    errors.append(exc)
+                    log.exception("Setup: %s failed", step.name)
+
+    log.info(
+        "Setup took %.1f s, the steps would have taken %.1f s one after another",
+        time.monotonic() - start,
+        sum(took.values()),
+    )
+    return results
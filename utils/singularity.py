@@ -1,6 +1,7 @@
 """Do what it takes to be able to run gears in Singularity.
 """
 
+import json
 import logging
 import os
 import re
@@ -13,6 +14,29 @@ log = logging.getLogger(__name__)
 
 FWV0 = "/flywheel/v0"
 SCRATCH_NAME = "gear-temp-dir-"
+WRITABLE_DIR = "/var/tmp"
+
+
+def read_writable_dir(config_path="config.json"):
+    """Get gear-writable-dir from config.json without making a GearToolkitContext.
+
+    The context is made after changing to the directory the gear will run in
+    so it only has to be made once.
+
+    Args:
+        config_path (str): the gear's config.json
+
+    Returns:
+        writable_dir (str): where to run if /flywheel/v0 is not writable
+    """
+
+    try:
+        with open(config_path) as fp:
+            config = json.load(fp).get("config", {})
+    except (OSError, ValueError) as exc:
+        log.debug("Could not read %s: %s", config_path, exc)
+        config = {}
+    return config.get("gear-writable-dir") or WRITABLE_DIR
 
 
 def run_in_tmp_dir(writable_dir):
@@ -0,0 +1,304 @@
+"""Keep track of every process the BIDS App starts, and stop all of them.
+
+The BIDS App is started in its own session (setsid) so it and everything it
+starts can be found even after their parent has died: "timeout" moves the
+command into its own process group, ANTs and FreeSurfer start many more
+processes, and when a parent dies its children are given to another process.
+To keep them, the gear asks Linux to give it the orphans of its descendants
+(PR_SET_CHILD_SUBREAPER) so they show up as its own children.
+
+Signals the gear gets (e.g. when the job is cancelled) are passed on to every
+running command, and SIGTERM and SIGINT are followed by SIGKILL for whatever is
+still running after a while.  The signal handler only writes the signal to a
+pipe, a thread does the rest.  When a command has finished, anything left in
+its session is stopped the same way, so nothing keeps running while the next
+try or the post-processing starts.  The command is reaped only after that:
+until then its pid, which is the session id, can't be given to another process.
+"""
+
+import ctypes
+import logging
+import os
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+PR_SET_CHILD_SUBREAPER = 36
+TERMINATE_SECONDS = 30  # time to let processes stop before killing them
+FORWARDED_SIGNALS = [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1]
+
+# Popen objects of commands that are running.  The tuple is replaced, never
+# changed, so the signal handler can read it without taking _lock: the handler
+# runs in the main thread, which may be holding _lock when the signal comes.
+_running = ()
+_lock = threading.Lock()
+_previous_handlers = {}
+_wakeup_fd = None  # the signal handler writes the signals it gets here
+
+
+def become_subreaper():
+    """Have orphaned descendants become children of this process.
+
+    Returns:
+        ok (bool): False if it is not possible (not Linux or not allowed)
+    """
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+def register(proc):
+    """Remember a running command so signals are passed on to it."""
+
+    global _running
+    with _lock:
+        _running = _running + (proc,)
+
+
+def unregister(proc):
+    """Forget a command that has finished."""
+
+    global _running
+    with _lock:
+        _running = tuple(running for running in _running if running is not proc)
+
+
+def find_tree(session):
+    """Everything in a command's session and everything those started.
+
+    Processes are found by their session id, not by the command's pid, which
+    may belong to another process once the command has been reaped.  Zombies
+    have already ended so they are left out.
+
+    Args:
+        session (int): a command started in its own session (its pid)
+
+    Returns:
+        procs (list of psutil.Process): not including this process
+    """
+
+    me = os.getpid()
+    procs = {}
+    for proc in psutil.process_iter():
+        if proc.pid == me:
+            continue
+        try:
+            if os.getsid(proc.pid) == session and proc.status() != psutil.STATUS_ZOMBIE:
+                procs[proc.pid] = proc
+        except (OSError, psutil.NoSuchProcess):  # gone, or not allowed to know
+            pass
+    for proc in list(procs.values()):  # some may have started their own session
+        try:
+            for child in proc.children(recursive=True):
+                if child.pid != me:
+                    procs.setdefault(child.pid, child)
+        except psutil.NoSuchProcess:
+            pass
+    return list(procs.values())
+
+
+def wait_exited(proc):
+    """Wait for a command to end, without reaping it.
+
+    Args:
+        proc (subprocess.Popen): the command, proc.wait() reaps it afterwards
+    """
+
+    if not hasattr(os, "waitid"):  # not Linux
+        proc.wait()
+        return
+    try:
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+    except ChildProcessError:  # already reaped
+        pass
+
+
+def reap_orphans(session):
+    """Wait for orphans of a command that have ended.
+
+    Orphans given to this process (as subreaper) stay zombies until then.
+    Only processes in the command's session are waited for: the command itself
+    and the gear's other children belong to the subprocess calls that started
+    them, which need their exit status.
+
+    Args:
+        session (int): the command (started in its own session)
+    """
+
+    for child in psutil.Process().children():
+        if child.pid == session:
+            continue
+        try:
+            if os.getsid(child.pid) != session:
+                continue
+            if child.status() == psutil.STATUS_ZOMBIE:
+                os.waitpid(child.pid, os.WNOHANG)
+        except (psutil.NoSuchProcess, OSError):
+            pass
+
+
+def wait_gone(procs, timeout):
+    """Wait until processes have ended, without waiting for (reaping) them.
+
+    psutil.wait_procs() would reap the command itself, then subprocess could
+    not get its exit status.
+
+    Returns:
+        alive (list of psutil.Process): the ones still running
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        alive = []
+        for proc in procs:
+            try:
+                if proc.status() != psutil.STATUS_ZOMBIE:
+                    alive.append(proc)
+            except psutil.NoSuchProcess:
+                pass
+        if not alive or time.monotonic() >= deadline:
+            return alive
+        time.sleep(0.1)
+
+
+def terminate_tree(pid, grace=TERMINATE_SECONDS):
+    """Terminate a command and everything it started, kill them if they linger.
+
+    Args:
+        pid (int): the command (started in its own session)
+        grace (float): seconds to wait after SIGTERM before SIGKILL
+
+    Returns:
+        names (list of str): "name (pid)" of each process that was signalled
+    """
+
+    procs = find_tree(pid)
+    names = []
+    for proc in procs:
+        try:
+            names.append(f"{proc.name()} ({proc.pid})")
+            proc.terminate()
+        except psutil.NoSuchProcess:
+            pass
+    alive = wait_gone(procs, grace)
+    # some may have started more processes while stopping
+    alive = wait_gone(alive + find_tree(pid), 0)
+    for proc in alive:
+        try:
+            log.warning("Killing %s (%d)", proc.name(), proc.pid)
+            proc.kill()
+        except psutil.NoSuchProcess:
+            pass
+    wait_gone(alive, grace)
+    reap_orphans(pid)
+    return names
+
+
+def clean_up_after(pid, grace=TERMINATE_SECONDS):
+    """Make sure nothing a finished command started is still running.
+
+    Args:
+        pid (int): the command that has finished, better not reaped yet (see
+            wait_exited()) so no other process can have its pid
+        grace (float): seconds to wait after SIGTERM before SIGKILL
+
+    Returns:
+        leftovers (list of str): "name (pid)" of each process that was stopped
+    """
+
+    leftovers = []
+    if find_tree(pid):
+        leftovers = terminate_tree(pid, grace)
+        log.warning(
+            "%d processes were still running after the command ended, "
+            "stopped them: %s",
+            len(leftovers),
+            ", ".join(leftovers),
+        )
+    reap_orphans(pid)
+    return leftovers
+
+
+def pass_on_signal(signum):
+    """Pass a signal the gear got on to every running command.
+
+    Args:
+        signum (int): the signal
+    """
+
+    procs = _running
+    log.warning(
+        "Got %s, passing it on to %d commands", signal.Signals(signum).name, len(procs)
+    )
+    for proc in procs:
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            # SIGTERM now, SIGKILL later if needed, all commands at once
+            threading.Thread(
+                target=terminate_tree, args=(proc.pid,), daemon=True
+            ).start()
+        else:
+            try:
+                os.killpg(proc.pid, signum)
+            except OSError:
+                pass
+
+
+def _pass_on_signals(read_fd):
+    while True:
+        signums = os.read(read_fd, 64)
+        if not signums:  # closed by forward_signals()
+            return
+        for signum in signums:
+            try:
+                pass_on_signal(signum)
+            except Exception:  # keep passing on the next ones
+                log.exception("Could not pass on signal %d", signum)
+
+
+def _forward(signum, frame):
+    # This interrupts the main thread anywhere, even while it holds a lock
+    # (e.g. logging's), so it does no more than writing to a pipe.
+    if not _running:  # then it is meant for the gear itself, see _running
+        signal.signal(signum, _previous_handlers.get(signum, signal.SIG_DFL))
+        os.kill(os.getpid(), signum)
+        return
+    try:
+        os.write(_wakeup_fd, bytes([signum]))
+    except (OSError, TypeError):  # the pipe is full or closed
+        pass
+
+
+@contextmanager
+def forward_signals():
+    """Pass signals the gear gets on to all running commands.
+
+    When no command is running, the gear gets the signal as it would have
+    without this.  This has to be used in the main thread.
+    """
+
+    global _wakeup_fd
+    read_fd, _wakeup_fd = os.pipe()
+    os.set_blocking(_wakeup_fd, False)
+    thread = threading.Thread(
+        target=_pass_on_signals, args=(read_fd,), name="signals", daemon=True
+    )
+    thread.start()
+    for signum in FORWARDED_SIGNALS:
+        _previous_handlers[signum] = signal.signal(signum, _forward)
+    try:
+        yield
+    finally:
+        for signum, handler in _previous_handlers.items():
+            signal.signal(signum, handler)
+        os.close(_wakeup_fd)
+        _wakeup_fd = None
+        thread.join()
+        os.close(read_fd)
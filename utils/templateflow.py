@@ -0,0 +1,435 @@
+"""Stage the TemplateFlow templates fMRIPrep needs into a writable directory.
+
+fMRIPrep needs TEMPLATEFLOW_HOME to be writable, but the templates baked into
+the container are read-only.  Instead of copying every template, only the
+templates a job will actually use are materialized (hard linked, reflinked, or
+as a last resort copied) and everything else is symlinked to the read-only
+original.
+
+Example:
+    .. code-block:: python
+
+        required = get_required_templates(config)
+        stats = stage_templateflow(ORIG_TEMPLATEFLOW, templateflow_dir, required)
+
+When running on shared hardware, a copy of the container's templates is kept
+in a node-wide cache on the same file system as the job so that templates can
+be hard linked instead of copied.  See get_shared_templateflow().
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# fMRIPrep always uses this template (e.g. for the carpet plot)
+DEFAULT_TEMPLATES = ["MNI152NLin2009cAsym"]
+
+# Spaces that do not refer to a TemplateFlow template
+NONSTANDARD_SPACES = [
+    "anat",
+    "boldref",
+    "fsnative",
+    "func",
+    "run",
+    "sbref",
+    "T1w",
+    "T2w",
+]
+
+# Where the shared cache is kept inside the writable directory
+CACHE_DIR = "bids-fmriprep-cache/templateflow"
+MANIFEST_NAME = "manifest.json"
+LAST_USED_NAME = ".last-used"
+
+# From linux/fs.h, used to ask the file system for a copy-on-write clone
+FICLONE = 0x40049409
+
+
+def get_required_templates(config):
+    """Figure out which TemplateFlow templates the job will use.
+
+    Args:
+        config (GearToolkitContext.config): run-time options from config.json
+
+    Returns:
+        required (list of str): template directory names, e.g. "tpl-OASIS30ANTs"
+    """
+
+    names = set(DEFAULT_TEMPLATES)
+
+    skull_strip_template = config.get("skull-strip-template")
+    if skull_strip_template:
+        names.add(skull_strip_template.split(":")[0])
+
+    output_spaces = config.get("output-spaces")
+    if output_spaces:
+        for space in output_spaces.split():
+            name = space.split(":")[0]
+            if name in NONSTANDARD_SPACES or "/" in name:
+                continue  # not a template or a user-supplied template
+            if name.startswith("fsaverage"):  # e.g. legacy "fsaverage5"
+                name = "fsaverage"
+            names.add(name)
+
+    if config.get("cifti-output"):
+        names.update(["fsLR", "fsaverage", "MNI152NLin6Asym"])
+
+    if config.get("use-aroma"):
+        names.add("MNI152NLin6Asym")
+
+    required = sorted("tpl-" + name for name in names)
+    log.info("Required TemplateFlow templates: %s", " ".join(required))
+
+    return required
+
+
+def _reflink(src, dst):
+    """Make dst a copy-on-write clone of src (btrfs, xfs)."""
+
+    with open(src, "rb") as src_fp, open(dst, "wb") as dst_fp:
+        try:
+            fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+        except OSError:
+            dst_fp.close()
+            os.unlink(dst)
+            raise
+
+
+def materialize_file(src, dst):
+    """Make dst a writable file with the contents of src as cheaply as possible.
+
+    Hard links are tried first, then reflinks, and finally a real copy.
+
+    Args:
+        src (str): path to existing file
+        dst (str): path to new file
+
+    Returns:
+        method (str): "link", "reflink", or "copy"
+    """
+
+    try:
+        os.link(src, dst)
+        return "link"
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EACCES):
+            raise
+
+    try:
+        _reflink(src, dst)
+        return "reflink"
+    except OSError:
+        pass
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def _tree_size(path):
+    """Total number of bytes in all files under path."""
+
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def stage_templateflow(orig_dir, templateflow_dir, required, symlink_dir=None):
+    """Fill a writable TemplateFlow home without copying every template.
+
+    Required templates are rebuilt as real directories whose files are
+    materialized with materialize_file().  All other templates are symlinked to
+    the read-only originals.
+
+    Args:
+        orig_dir (Path): TemplateFlow home to take the templates from, either the
+            one that came with the container or a shared cache of it
+        templateflow_dir (Path): writable TemplateFlow home to fill
+        required (list of str): names of templates that need to be materialized
+        symlink_dir (Path): where templates that are not required are symlinked to,
+            default is orig_dir.  A shared cache can be evicted while the job is
+            running so the container's original should be used instead.
+
+    Returns:
+        stats (dict): bytes and files per method and the time it took
+    """
+
+    start = time.monotonic()
+
+    stats = {
+        "templates materialized": 0,
+        "templates symlinked": 0,
+        "files linked": 0,
+        "files reflinked": 0,
+        "files copied": 0,
+        "bytes copied": 0,
+        "bytes not copied": 0,
+    }
+
+    templateflow_dir = Path(templateflow_dir)
+    templateflow_dir.mkdir(parents=True, exist_ok=True)
+
+    for template in sorted(Path(orig_dir).glob("*")):
+        dest = templateflow_dir / template.name
+
+        if template.name not in required or not template.is_dir():
+            if not dest.exists():
+                dest.symlink_to(Path(symlink_dir or orig_dir) / template.name)
+            stats["templates symlinked"] += 1
+            stats["bytes not copied"] += _tree_size(template)
+            continue
+
+        stats["templates materialized"] += 1
+        for root, dirs, files in os.walk(template):
+            dest_root = dest / os.path.relpath(root, template)
+            dest_root.mkdir(exist_ok=True)
+            for name in files:
+                src = os.path.join(root, name)
+                dst = dest_root / name
+                if dst.exists():
+                    continue
+                method = materialize_file(src, dst)
+                size = os.stat(src).st_size
+                if method == "copy":
+                    stats["files copied"] += 1
+                    stats["bytes copied"] += size
+                else:
+                    stats["files " + method + "ed"] += 1
+                    stats["bytes not copied"] += size
+
+    elapsed = time.monotonic() - start
+    stats["seconds"] = round(elapsed, 2)
+
+    # Estimate time saved from how fast actual copies went, if there were any
+    if stats["bytes copied"] > 0 and elapsed > 0:
+        rate = stats["bytes copied"] / elapsed
+        stats["seconds saved (estimated)"] = round(stats["bytes not copied"] / rate, 2)
+
+    log.info(
+        "Staged TemplateFlow in %.2f s: %d templates materialized (%d linked, "
+        "%d reflinked, %d copied files), %d symlinked, %.1f MiB not copied",
+        elapsed,
+        stats["templates materialized"],
+        stats["files linked"],
+        stats["files reflinked"],
+        stats["files copied"],
+        stats["templates symlinked"],
+        stats["bytes not copied"] / 1024**2,
+    )
+    if "seconds saved (estimated)" in stats:
+        log.info(
+            "Avoided an estimated %.1f s of copying",
+            stats["seconds saved (estimated)"],
+        )
+
+    return stats
+
+
+@contextmanager
+def _locked(lock_path, operation):
+    """Hold a flock() on lock_path while in the context."""
+
+    with open(lock_path, "a") as lock_fp:
+        fcntl.flock(lock_fp.fileno(), operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_UN)
+
+
+def make_manifest(path):
+    """List every file under path and its size.
+
+    Args:
+        path (Path): top of directory tree
+
+    Returns:
+        manifest (dict): "files" maps relative paths to sizes, "bytes" is the total
+    """
+
+    files = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            full_path = os.path.join(root, name)
+            files[os.path.relpath(full_path, path)] = os.stat(full_path).st_size
+    return {"files": files, "bytes": sum(files.values())}
+
+
+def get_templateflow_version(orig_dir):
+    """Identify the contents of a TemplateFlow home so caches are not mixed up.
+
+    Args:
+        orig_dir (Path): TemplateFlow home that came with the container
+
+    Returns:
+        version (str): short hash of the names and sizes of all files
+    """
+
+    manifest = make_manifest(orig_dir)
+    listing = json.dumps(sorted(manifest["files"].items()))
+    return hashlib.sha1(listing.encode()).hexdigest()[:12]
+
+
+def is_valid_cache(entry):
+    """Check a published cache entry against its content manifest.
+
+    Args:
+        entry (Path): cache directory for one version of TemplateFlow
+
+    Returns:
+        True if every file in the manifest is present with the right size
+    """
+
+    try:
+        with open(entry / MANIFEST_NAME) as json_file:
+            manifest = json.load(json_file)
+        for rel_path, size in manifest["files"].items():
+            if os.stat(entry / "templates" / rel_path).st_size != size:
+                log.warning("TemplateFlow cache %s: wrong size for %s", entry, rel_path)
+                return False
+    except (OSError, ValueError, KeyError) as err:
+        log.warning("TemplateFlow cache %s is not valid: %s", entry, err)
+        return False
+    return True
+
+
+def _publish_cache(orig_dir, cache_root, version):
+    """Build a cache entry in a temporary directory then rename it into place.
+
+    Must be called while holding the exclusive lock for the version.
+    """
+
+    entry = cache_root / version
+
+    if entry.exists():  # left over from a crash or failed validation
+        log.info("Removing invalid TemplateFlow cache %s", entry)
+        trash = Path(tempfile.mkdtemp(prefix=f".trash-{version}-", dir=cache_root))
+        entry.rename(trash / version)
+        shutil.rmtree(trash)
+
+    log.info("Building shared TemplateFlow cache %s", entry)
+    start = time.monotonic()
+    build_dir = Path(tempfile.mkdtemp(prefix=f".build-{version}-", dir=cache_root))
+    try:
+        shutil.copytree(orig_dir, build_dir / "templates")
+        manifest = make_manifest(build_dir / "templates")
+        manifest["version"] = version
+        with open(build_dir / MANIFEST_NAME, "w") as json_file:
+            json.dump(manifest, json_file)
+        build_dir.chmod(0o755)
+        build_dir.rename(entry)  # atomic publish
+    except Exception:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    log.info(
+        "Built %.1f MiB TemplateFlow cache in %.2f s",
+        manifest["bytes"] / 1024**2,
+        time.monotonic() - start,
+    )
+
+
+def evict_templateflow_cache(cache_root, quota_bytes, keep=None):
+    """Remove least recently used cache entries until they fit in the quota.
+
+    Entries that are being staged by another job (shared lock held) are skipped.
+
+    Args:
+        cache_root (Path): directory holding all cached versions
+        quota_bytes (int): maximum total size of all cached versions
+        keep (str): version that must not be evicted
+    """
+
+    entries = []
+    for manifest_path in Path(cache_root).glob("*/" + MANIFEST_NAME):
+        entry = manifest_path.parent
+        try:
+            with open(manifest_path) as json_file:
+                size = json.load(json_file)["bytes"]
+            last_used = (entry / LAST_USED_NAME).stat().st_mtime
+        except (OSError, ValueError, KeyError):
+            size, last_used = 0, 0
+        entries.append((last_used, size, entry))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries, key=lambda e: e[0]):
+        if total <= quota_bytes:
+            break
+        if entry.name == keep:
+            continue
+        lock_path = Path(cache_root) / f"{entry.name}.lock"
+        try:
+            with _locked(lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                log.info("Evicting TemplateFlow cache %s (%d bytes)", entry, size)
+                trash = Path(tempfile.mkdtemp(prefix=".trash-", dir=cache_root))
+                entry.rename(trash / entry.name)
+                shutil.rmtree(trash)
+                total -= size
+        except BlockingIOError:
+            log.debug("TemplateFlow cache %s is in use, not evicting", entry)
+
+
+def get_shared_templateflow(
+    orig_dir, writable_dir, templateflow_dir, required, quota_gb
+):
+    """Stage TemplateFlow from a node-wide cache shared by concurrent jobs.
+
+    The container's templates are copied once per node into a versioned cache in
+    writable_dir.  Jobs running in a scratch directory on the same file system
+    can then hard link the templates they need instead of copying them.
+
+    Building the cache happens under an exclusive lock and the finished cache is
+    renamed into place so other jobs never see a partial one.  Jobs hold a shared
+    lock while staging so the cache is not evicted from under them.
+
+    Args:
+        orig_dir (Path): TemplateFlow home that came with the container
+        writable_dir (str): shared directory, e.g. config "gear-writable-dir"
+        templateflow_dir (Path): writable TemplateFlow home to fill
+        required (list of str): names of templates that need to be materialized
+        quota_gb (float): maximum size of all cached versions in GB
+
+    Returns:
+        stats (dict): see stage_templateflow(), plus whether the cache was warm
+    """
+
+    cache_root = Path(writable_dir) / CACHE_DIR
+    cache_root.mkdir(parents=True, exist_ok=True)
+
+    version = get_templateflow_version(orig_dir)
+    entry = cache_root / version
+    lock_path = cache_root / f"{version}.lock"
+
+    warm = True
+    while True:
+        with _locked(lock_path, fcntl.LOCK_SH):
+            if is_valid_cache(entry):
+                log.info("Using shared TemplateFlow cache %s", entry)
+                (entry / LAST_USED_NAME).touch()
+                stats = stage_templateflow(
+                    entry / "templates", templateflow_dir, required, orig_dir
+                )
+                break
+        warm = False
+        with _locked(lock_path, fcntl.LOCK_EX):
+            if not is_valid_cache(entry):  # another job may have just built it
+                _publish_cache(orig_dir, cache_root, version)
+
+    stats["cache warm"] = warm
+
+    evict_templateflow_cache(cache_root, int(quota_gb * 1024**3), keep=version)
+
+    return stats
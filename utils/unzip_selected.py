@@ -0,0 +1,254 @@
+"""Extract only what a job needs from an input archive.
+
+Inputs like "previous-results" and "fs-subjects-dir" can hold the results for a
+whole project.  Instead of extracting everything to a staging directory and
+then moving it into place, the zip central directory is read, members that
+belong to other subjects or sessions are dropped, and the rest are written
+directly to where they belong, several at a time.
+"""
+
+import logging
+import os
+import re
+import shutil
+import stat
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zipfile import ZipFile
+
+log = logging.getLogger(__name__)
+
+SUBJECT_PATTERN = re.compile(r"^sub-([a-zA-Z0-9]+)")
+SESSION_PATTERN = re.compile(r"(?:^|_)ses-([a-zA-Z0-9]+)")
+
+
+def bids_label(label):
+    """Turn a Flywheel container label into the label used in BIDS names.
+
+    Args:
+        label (str): e.g. "sub-TOME 3024" or "TOME3024"
+
+    Returns:
+        label (str): e.g. "TOME3024"
+    """
+
+    label = re.sub(r"^(sub|ses)-", "", label)
+    return re.sub(r"[^a-zA-Z0-9]", "", label)
+
+
+def is_wanted(parts, subjects, sessions):
+    """Decide if an archive member belongs to one of the subjects and sessions.
+
+    Path components that do not name a subject or session (e.g. "logs",
+    "dataset_description.json", "fsaverage") are always wanted.
+
+    Args:
+        parts (list of str): path components of the member
+        subjects (set of str): BIDS subject labels to keep, empty means all
+        sessions (set of str): BIDS session labels to keep, empty means all
+
+    Returns:
+        True if the member should be extracted
+    """
+
+    for part in parts:
+        match = SUBJECT_PATTERN.match(part)
+        if match and subjects and match.group(1) not in subjects:
+            return False
+        match = SESSION_PATTERN.search(part)
+        if match and sessions and match.group(1) not in sessions:
+            return False
+    return True
+
+
+def _names_subject(parts, subjects):
+    """True if one of the path components is a directory or file of a subject."""
+
+    for part in parts:
+        match = SUBJECT_PATTERN.match(part)
+        if match and match.group(1) in subjects:
+            return True
+    return False
+
+
+class ZipHandles:
+    """Open an archive once in each thread that reads from it.
+
+    Reading one ZipFile from several threads at once mixes up their reads.
+    The handles are closed when leaving the with block.
+
+    Args:
+        zip_path (Path): the archive
+    """
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self):
+        """This thread's handle on the archive."""
+
+        if not hasattr(self._local, "zip_file"):
+            self._local.zip_file = ZipFile(self.zip_path)
+            with self._lock:
+                self._handles.append(self._local.zip_file)
+        return self._local.zip_file
+
+    def close(self):
+        """Close every thread's handle."""
+
+        with self._lock:
+            for handle in self._handles:
+                handle.close()
+            self._handles = []
+
+
+def make_symlink(target, dest):
+    """Make a symbolic link, replacing whatever is at dest like open(dest, "w")."""
+
+    tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}.link")
+    os.symlink(target, tmp)
+    os.replace(tmp, dest)
+
+
+def extract_member(handles, info, dest):
+    """Write one member to dest using this thread's own handle on the archive.
+
+    Args:
+        handles (ZipHandles): the archive
+        info (ZipInfo): the member
+        dest (Path): where to write it, replaced if it exists
+
+    Returns:
+        size (int): bytes written
+    """
+
+    zip_file = handles.get()
+    mode = info.external_attr >> 16
+    if stat.S_ISLNK(mode):
+        make_symlink(zip_file.read(info).decode(), dest)
+        return 0
+
+    with zip_file.open(info) as src, open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    if mode & 0o777:
+        os.chmod(dest, mode & 0o777)
+    return info.file_size
+
+
+def unzip_selected(
+    zip_path, dest_dir, subjects=None, sessions=None, n_threads=None, strip=1
+):
+    """Extract the members of an archive for the given subjects and sessions.
+
+    Members are written directly into dest_dir after removing the first `strip`
+    path components (e.g. the analysis ID at the top of a gear's output archive).
+    Files that already exist are not overwritten, and nothing is written into
+    top level symlinks in dest_dir (like the fsaverage links in SUBJECTS_DIR).
+
+    If no member belongs to any of the subjects (e.g. because the labels in the
+    archive are not the Flywheel labels), everything is extracted.
+
+    Args:
+        zip_path (Path): archive to extract
+        dest_dir (Path): where to extract to
+        subjects (list of str): Flywheel subject labels to keep, None means all
+        sessions (list of str): Flywheel session labels to keep, None means all
+        n_threads (int): number of members to write at once, default is number of cpus
+        strip (int): number of leading path components to remove
+
+    Returns:
+        stats (dict): number of members extracted and skipped, bytes written
+    """
+
+    dest_dir = Path(dest_dir)
+    subjects = {bids_label(s) for s in subjects or [] if s}
+    sessions = {bids_label(s) for s in sessions or [] if s}
+
+    stats = {
+        "extracted": 0,
+        "skipped other subjects": 0,
+        "skipped existing": 0,
+        "bytes": 0,
+    }
+
+    linked_tops = {p.name for p in dest_dir.glob("*") if p.is_symlink()}
+
+    with ZipFile(zip_path) as zip_file:
+        members = []
+        for info in zip_file.infolist():
+            parts = Path(info.filename).parts[strip:]
+            if not parts:
+                continue
+            if ".." in parts or Path(info.filename).is_absolute():
+                log.warning("Not extracting unsafe path %s", info.filename)
+                continue
+            members.append((parts, info))
+
+    wanted = [(p, i) for p, i in members if is_wanted(p, subjects, sessions)]
+    if subjects and not any(_names_subject(p, subjects) for p, _ in wanted):
+        log.warning(
+            "Nothing in %s matches subjects %s sessions %s, extracting everything",
+            Path(zip_path).name,
+            sorted(subjects),
+            sorted(sessions),
+        )
+        wanted = members
+    stats["skipped other subjects"] = len(members) - len(wanted)
+
+    tops = set()
+    to_extract = []
+    planned = set()  # an archive can have the same name more than once
+    for parts, info in wanted:
+        if parts[0] not in tops:
+            tops.add(parts[0])
+            if parts[0] in linked_tops:
+                log.info("Found %s but using existing", parts[0])
+            else:
+                log.info("Found %s", parts[0])
+        if parts[0] in linked_tops:
+            stats["skipped existing"] += 1
+            continue
+
+        dest = dest_dir.joinpath(*parts)
+        if info.is_dir():
+            dest.mkdir(parents=True, exist_ok=True)
+        elif dest in planned or dest.exists() or dest.is_symlink():
+            stats["skipped existing"] += 1
+        else:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            planned.add(dest)
+            to_extract.append((info, dest))
+
+    with ZipHandles(zip_path) as handles, ThreadPoolExecutor(
+        max_workers=n_threads or os.cpu_count()
+    ) as executor:
+        futures = [
+            executor.submit(extract_member, handles, info, dest)
+            for info, dest in to_extract
+        ]
+        for future in futures:
+            stats["bytes"] += future.result()
+            stats["extracted"] += 1
+
+    log.info(
+        "Extracted %d files (%.1f MiB) from %s, skipped %d for other subjects or "
+        "sessions and %d that already exist",
+        stats["extracted"],
+        stats["bytes"] / 1024**2,
+        Path(zip_path).name,
+        stats["skipped other subjects"],
+        stats["skipped existing"],
+    )
+
+    return stats
@@ -0,0 +1,281 @@
+"""Stop the BIDS App early when it has stopped making progress or has crashed.
+
+Without a watchdog, the only limit is gear-timeout, so a run whose nipype graph
+has stalled, or that will fail anyway because an important step crashed, keeps
+its computer busy for hours.  While the command runs, these show progress:
+
+- nipype saying it finished a step ('[Node] Finished "..."' or "[Job N]
+  Completed") in the command's output
+- the output directory changing size (e.g. FreeSurfer's subject directory
+  during recon-all, which prints nothing for a long time)
+- files being added to the steps in nipype's work directory.  It has far too
+  many files to look at every minute, on the disk fMRIPrep is busy with, so
+  only the modification times of its first SHALLOW_DEPTH levels of
+  directories (workflows and their steps) are looked at.
+
+and nipype's crash files (crash-*.txt or crash-*.pklz) show that a step failed.
+The process tree is stopped if there has been no progress for too long, or when
+there are too many crash files, and why is saved so it can go into metadata.
+
+It also stops the command at a deadline set a little before gear-timeout would
+kill it, which leaves time to save what has been done so far.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+
+from .supervisor import terminate_tree
+
+log = logging.getLogger(__name__)
+
+FINISHED = re.compile(r"\[Node\] Finished|\[Job [0-9]+\] Completed|Finished running")
+CRASH_FILE = re.compile(r"^crash-.*\.(txt|pklz)$")
+DURATION = re.compile(r"^\s*([0-9.]+)\s*([smhd]?)\s*$")
+UNIT_SECONDS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+SHALLOW_DEPTH = 4  # e.g. work/fmriprep_wf/single_subject_01_wf/anat_preproc_wf/n4
+
+
+def scan_shallow(top, depth=SHALLOW_DEPTH):
+    """Look at only the first levels of directories in a big directory.
+
+    Args:
+        top (Path): the directory
+        depth (int): number of levels of directories to look at
+
+    Returns:
+        latest (int): latest modification time (ns) of those directories,
+            which changes when files are added to or removed from them
+        crash_files (list of str): names of crash files in them
+    """
+
+    latest = 0
+    crash_files = []
+    pending = [(str(top), 0)]
+    while pending:
+        path, level = pending.pop()
+        try:
+            latest = max(latest, os.stat(path).st_mtime_ns)
+            if level == depth:
+                continue
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append((entry.path, level + 1))
+                    elif CRASH_FILE.match(entry.name):
+                        crash_files.append(entry.name)
+        except OSError:  # removed while looking
+            continue
+    return latest, crash_files
+
+
+def parse_duration(value):
+    """Seconds in a duration as given to "timeout", e.g. "90", "45m" or "2d".
+
+    Returns:
+        seconds (float) or None if it can't be understood
+    """
+
+    match = DURATION.match(str(value))
+    if not match:
+        return None
+    return float(match.group(1)) * UNIT_SECONDS[match.group(2)]
+
+
+class RunWatchdog:
+    """Watch a running command and stop it if it stalls or crashes too often.
+
+    Args:
+        watch_dirs (list of Path): directories where output and crash files
+            are written, e.g. output/<destination_id>, every file is looked at
+        stall_seconds (float): stop if there is no progress for this long, 0 to
+            never stop because of this
+        max_crashes (int): stop when there are this many crash files, 0 to
+            never stop because of this
+        interval (float): seconds between looking at the directories
+        deadline_seconds (float): stop this long after start(), 0 for no deadline
+        shallow_dirs (list of Path): directories with too many files to look at
+            all of them, e.g. work/, see scan_shallow()
+    """
+
+    def __init__(
+        self,
+        watch_dirs,
+        stall_seconds=0,
+        max_crashes=0,
+        interval=60,
+        deadline_seconds=0,
+        shallow_dirs=(),
+    ):
+        self.watch_dirs = watch_dirs
+        self.shallow_dirs = shallow_dirs
+        self.stall_seconds = stall_seconds
+        self.max_crashes = max_crashes
+        self.interval = interval
+        self.deadline_seconds = deadline_seconds
+
+        self.reason = None  # why it stopped the command, if it did
+        self.cause = None  # "stall", "crashes" or "deadline" if it did
+        self.finished = 0  # number of "finished" messages seen
+        self.crash_files = []
+        self.longest_stall = 0
+
+        self._last_progress = None
+        self._state = None  # what scan() found last time
+        self._deadline = None
+        self._old_crash_files = set()
+        self._procs = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start watching in the background."""
+
+        self._last_progress = time.monotonic()
+        if self.deadline_seconds:
+            self._deadline = self._last_progress + self.deadline_seconds
+            log.info("Will stop the command in %d minutes", self.deadline_seconds / 60)
+        self._state, crash_files = self.scan()
+        self._old_crash_files = set(crash_files)  # e.g. from an earlier try
+        if not (self.stall_seconds or self.max_crashes or self._deadline):
+            return
+        self._thread = threading.Thread(target=self._run, name="watchdog", daemon=True)
+        self._thread.start()
+        log.info(
+            "Watchdog will stop the command after %s minutes without progress or "
+            "%s crash files (0 is never)",
+            round(self.stall_seconds / 60),
+            self.max_crashes,
+        )
+
+    def stop(self):
+        """Stop watching."""
+
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def attach(self, proc):
+        """Watch this process (a subprocess.Popen), stop its tree if needed."""
+
+        with self._lock:
+            self._procs.add(proc)
+
+    def detach(self, proc):
+        """Stop watching this process."""
+
+        with self._lock:
+            self._procs.discard(proc)
+
+    def observe(self, line):
+        """Look at one line of the command's output for progress."""
+
+        if ("Finished" in line or "Completed" in line) and FINISHED.search(line):
+            self.finished += 1
+            self._progress()
+
+    def _progress(self):
+        now = time.monotonic()
+        self.longest_stall = max(self.longest_stall, now - self._last_progress)
+        self._last_progress = now
+
+    def scan(self):
+        """Add up the size of the output, look at the work and find crash files.
+
+        Returns:
+            state (tuple): bytes in all of the watched directories and the
+                latest modification time in the shallow ones, changes when
+                there is progress
+            crash_files (list of str): names of all crash files
+        """
+
+        size = latest = 0
+        crash_files = []
+        for shallow_dir in self.shallow_dirs:
+            shallow_latest, shallow_crash_files = scan_shallow(shallow_dir)
+            latest = max(latest, shallow_latest)
+            crash_files += shallow_crash_files
+        for watch_dir in self.watch_dirs:
+            for root, _, files in os.walk(watch_dir):
+                for name in files:
+                    try:
+                        size += os.lstat(os.path.join(root, name)).st_size
+                    except OSError:
+                        continue
+                    if CRASH_FILE.match(name):
+                        crash_files.append(name)
+        return (size, latest), sorted(crash_files)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:  # never let this kill the gear
+                log.exception("Problem in watchdog")
+
+    def check(self):
+        """Look for progress and crashes and stop the command if needed.
+
+        Returns:
+            reason (str): why the command was stopped, or None
+        """
+
+        state, crash_files = self.scan()
+        if state != self._state:
+            self._state = state
+            self._progress()
+        crash_files = [
+            name for name in crash_files if name not in self._old_crash_files
+        ]
+        new_crashes = sorted(set(crash_files) - set(self.crash_files))
+        if new_crashes:
+            log.warning("New crash files: %s", ", ".join(new_crashes))
+            self.crash_files = crash_files
+
+        if self.reason:
+            return self.reason
+        now = time.monotonic()
+        stalled = now - self._last_progress
+        if self._deadline and now >= self._deadline:
+            self.trip(
+                f"deadline {self.deadline_seconds / 60:.0f} minutes after it started",
+                "deadline",
+            )
+        elif self.max_crashes and len(self.crash_files) >= self.max_crashes:
+            self.trip(
+                f"{len(self.crash_files)} crash files: {self.crash_files[-1]}",
+                "crashes",
+            )
+        elif self.stall_seconds and stalled > self.stall_seconds:
+            self.longest_stall = max(self.longest_stall, stalled)
+            self.trip(f"no progress for {stalled / 60:.0f} minutes", "stall")
+        return self.reason
+
+    def trip(self, reason, cause):
+        """Stop every attached process tree."""
+
+        self.reason = reason
+        self.cause = cause
+        log.error("Watchdog is stopping the command: %s", reason)
+        with self._lock:
+            procs = list(self._procs)
+        for proc in procs:
+            terminate_tree(proc.pid)
+
+    def summary(self):
+        """What the watchdog saw.
+
+        Returns:
+            summary (dict)
+        """
+
+        return {
+            "stopped because": self.reason,
+            "finished steps": self.finished,
+            "crash files": self.crash_files,
+            "longest minutes without progress": round(self.longest_stall / 60, 1),
+        }